@@ -0,0 +1,645 @@
+#!/usr/bin/env python3.6
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+import re
+import sys
+import time
+import random
+import logging
+from decimal import Decimal, Context, InvalidOperation, ROUND_HALF_EVEN
+from threading import RLock
+from enum import Enum
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+
+# Amounts are stored as DECIMAL(40,20) so all trade math is done on integers scaled by 10^20
+FIXED_POINT_DIGITS = 20
+FIXED_POINT_SCALE = 10 ** FIXED_POINT_DIGITS
+FIXED_POINT_CONTEXT = Context(prec=80, rounding=ROUND_HALF_EVEN)
+FIXED_POINT_CENT = FIXED_POINT_SCALE // 100
+FIXED_POINT_HALF_CENT = FIXED_POINT_CENT // 2
+
+# USD every player starts a game with
+STARTING_USD_AMOUNT = 10000
+
+# trade_rollup owner used for the game wide totals of each currency pair
+TRADE_ROLLUP_GAME_OWNER = "*"
+
+MARKET_ORDER_REGEX = r'!market[ ]+\$?(?P<quantity>(([\d]+)?(\.\d+)?%?))[ ]+(?P<buy_currency>[0-9a-zA-Z]+)[ ]+(?P<sell_currency>[0-9a-zA-Z]+)'
+LIMIT_ORDER_REGEX = r'!limit[ ]+\$?(?P<quantity>(([\d]+)?(\.\d+)?%?))[ ]+(?P<buy_currency>[0-9a-zA-Z]+)[ ]+(?P<sell_currency>[0-9a-zA-Z]+)[ ]+(?P<limit_price>(([\d]+)?(\.\d+)?))'
+
+# Number of market orders the benchmark executes when no count is given
+BENCHMARK_TRADE_COUNT = 100000
+BENCHMARK_PLAYER_COUNT = 1000
+# Number of portfolio rows the fixed point benchmark values and trades against
+BENCHMARK_ROW_COUNT = 100000
+BENCHMARK_CURRENCIES = ("BTC", "ETH", "XRP", "LTC", "ADA", "XLM", "NEO", "XMR")
+
+# Child of the bot's logger so the bot's handlers write the engine's records
+logger = logging.getLogger('cryptoTradingGameBot.engine')
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class OrderResult(Enum):
+    EXECUTED = "EXECUTED"
+    CREATED = "CREATED"
+    CANCELED = "CANCELED"
+    INVALID_ARGS = "INVALID_ARGS"
+    NO_PRICE = "NO_PRICE"
+    INSUFFICIENT_FUNDS = "INSUFFICIENT_FUNDS"
+    LIMIT_ABOVE_MARKET = "LIMIT_ABOVE_MARKET"
+    NOT_FOUND = "NOT_FOUND"
+    ALREADY_APPLIED = "ALREADY_APPLIED"
+
+
+class GameEngine(object):
+    """
+    The trading rules of a game over pluggable storage and prices. Knows nothing about Reddit, callers pass parsed
+    commands in and tell players about the returned OrderResult however they message them. Every check is made
+    before the first write so a rejected command writes nothing
+    """
+
+    def __init__(self, storage, price_source, usd_price_source = None):
+        self.storage = storage # InMemoryStorage, the processor's MySqlStorage or anything with the same methods
+        self.price_source = price_source # callable(from_symbol, to_symbol, price_time) returning a fixed point price, <= 0 on errors
+        self.usd_price_source = usd_price_source # callable(currencies) returning currency to fixed point USD price, None to skip
+
+    def onboard(self, game_id, owner):
+        """
+        Gives owner the starting USD if they have no portfolio in the game
+        :return: True if owner is a new player
+        """
+        storage = self.storage
+        with storage.transaction():
+            if storage.has_portfolio(game_id, owner):
+                return False
+
+            storage.add_amount(game_id, owner, "USD", to_fixed(STARTING_USD_AMOUNT))
+            storage.adjust_game_counters(game_id, player_delta=1, currency_holder_deltas=["USD"], currency_delta=1)
+        return True
+
+    def market_order(self, game_id, comment_id, owner, order, price_time):
+        """
+        :param order: the order parse_market_order returned
+        :param price_time: the time the order was placed
+        :return: tuple of (OrderResult, fixed point trading price or 0 if it was not priced)
+        """
+        if not is_order_valid(order):
+            return OrderResult.INVALID_ARGS, 0
+
+        buy_currency = order["buy_currency"]
+        sell_currency = order["sell_currency"]
+        # Priced before the transaction starts so nothing is held while waiting on the price source
+        trading_price = self.price_source(buy_currency, sell_currency, price_time)
+        if trading_price <= 0:
+            return OrderResult.NO_PRICE, 0
+
+        storage = self.storage
+        with storage.transaction():
+            available_funds = storage.get_amount(game_id, owner, sell_currency) or 0
+            trade_cost, quantity_bought = size_order(order, available_funds, trading_price)
+            if available_funds < trade_cost or available_funds == 0:
+                return OrderResult.INSUFFICIENT_FUNDS, trading_price
+
+            trade_applied = self._apply_trade(game_id, comment_id, owner, quantity_bought, buy_currency, trade_cost,
+                                              sell_currency, available_funds - trade_cost)
+        return (OrderResult.EXECUTED if trade_applied else OrderResult.ALREADY_APPLIED), trading_price
+
+    def limit_order(self, game_id, comment_id, owner, order, price_time):
+        """
+        Reserves the funds of a limit order until it is executed or canceled
+        :param order: the order parse_limit_order returned
+        :param price_time: the time the order was placed
+        :return: tuple of (OrderResult, fixed point current price or 0 if it was not priced, limit_order_id or None)
+        """
+        if not is_order_valid(order):
+            return OrderResult.INVALID_ARGS, 0, None
+
+        buy_currency = order["buy_currency"]
+        sell_currency = order["sell_currency"]
+        current_price = self.price_source(buy_currency, sell_currency, price_time)
+        if current_price <= 0:
+            return OrderResult.NO_PRICE, 0, None
+        if current_price < order["limit_price"]:
+            return OrderResult.LIMIT_ABOVE_MARKET, current_price, None
+
+        storage = self.storage
+        with storage.transaction():
+            available_funds = storage.get_amount(game_id, owner, sell_currency) or 0
+            trade_cost, quantity_bought = size_order(order, available_funds, order["limit_price"])
+            if available_funds < trade_cost or available_funds == 0:
+                return OrderResult.INSUFFICIENT_FUNDS, current_price, None
+
+            # The comment_id is the idempotency key so a retried command never reserves the funds twice
+            limit_order_id = storage.add_limit_order(game_id, comment_id, owner, buy_currency, quantity_bought,
+                                                     sell_currency, trade_cost, order["limit_price"])
+            if limit_order_id is None:
+                logger.info("Limit order with comment_id: {comment_id} was already created".format(comment_id=comment_id))
+                return OrderResult.ALREADY_APPLIED, current_price, None
+
+            storage.set_amount(game_id, owner, sell_currency, available_funds - trade_cost)
+            storage.adjust_game_counters(game_id, open_order_delta=1,
+                                         currency_order_deltas=[buy_currency, sell_currency], currency_delta=1)
+        return OrderResult.CREATED, current_price, limit_order_id
+
+    def cancel_limit_order(self, limit_order_id, owner):
+        """
+        Returns the reserved funds of owner's open limit order
+        :return: OrderResult
+        """
+        storage = self.storage
+        with storage.transaction():
+            limit_order = storage.get_open_limit_order(limit_order_id)
+            if limit_order is None or limit_order["owner"] != owner:
+                return OrderResult.NOT_FOUND
+
+            if storage.add_amount(limit_order["game_id"], owner, limit_order["sell_currency"], limit_order["sell_amount"]):
+                storage.adjust_game_counters(limit_order["game_id"], currency_holder_deltas=[limit_order["sell_currency"]],
+                                             currency_delta=1)
+            storage.close_limit_order(limit_order, executed=False)
+            storage.adjust_game_counters(limit_order["game_id"], open_order_delta=-1,
+                                         currency_order_deltas=[limit_order["buy_currency"], limit_order["sell_currency"]],
+                                         currency_delta=-1)
+        return OrderResult.CANCELED
+
+    def execute_limit_order(self, limit_order_id):
+        """
+        Fills an open limit order with its reserved funds
+        :return: the executed limit order or None if it was not open
+        """
+        storage = self.storage
+        with storage.transaction():
+            limit_order = storage.get_open_limit_order(limit_order_id)
+            if limit_order is None:
+                return None
+
+            game_id = limit_order["game_id"]
+            owner = limit_order["owner"]
+            if storage.get_amount(game_id, owner, limit_order["sell_currency"]) is None:
+                logger.error("Limit order {limit_order_id} has no {sell_currency} portfolio to fill from".format(
+                    limit_order_id=limit_order_id, sell_currency=limit_order["sell_currency"]))
+                return None
+
+            # The funds were already taken from the portfolio when the order was created
+            self._apply_trade(game_id, limit_order["comment_id"], owner, limit_order["buy_amount"],
+                              limit_order["buy_currency"], limit_order["sell_amount"], limit_order["sell_currency"], None)
+            storage.close_limit_order(limit_order, executed=True)
+            storage.adjust_game_counters(game_id, open_order_delta=-1,
+                                         currency_order_deltas=[limit_order["buy_currency"], limit_order["sell_currency"]],
+                                         currency_delta=-1)
+        return limit_order
+
+    def get_trade_usd_value(self, buy_quantity, buy_currency, trade_cost, sell_currency):
+        """
+        :param buy_quantity: fixed point amount of buy_currency bought
+        :param trade_cost: fixed point amount of sell_currency sold
+        :return: fixed point USD value of the trade or None if it could not be priced
+        """
+        if sell_currency == "USD":
+            return trade_cost
+        if buy_currency == "USD":
+            return buy_quantity
+        if self.usd_price_source is None:
+            return None
+
+        usd_value = self.usd_price_source([buy_currency, sell_currency])
+        if buy_currency in usd_value:
+            return fixed_mul(buy_quantity, usd_value[buy_currency])
+        if sell_currency in usd_value:
+            return fixed_mul(trade_cost, usd_value[sell_currency])
+
+        logger.error("Could not get the USD value of a {buy_currency}/{sell_currency} trade for analytics".format(
+            buy_currency=buy_currency, sell_currency=sell_currency))
+        return None
+
+    def _apply_trade(self, game_id, comment_id, owner, buy_quantity, buy_currency, trade_cost, sell_currency, sell_funds_left):
+        """
+        Records the trade and moves the funds in the caller's transaction
+        :param sell_funds_left: fixed point sell_currency left after the trade or None if it was already reserved
+        :return: False if the trade was already applied
+        """
+        storage = self.storage
+        # Priced before the trade writes anything so it holds no row locks while the price is looked up
+        trade_usd_value = self.get_trade_usd_value(buy_quantity, buy_currency, trade_cost, sell_currency)
+
+        # The comment_id is the idempotency key. If the trade was already recorded a retry must not apply it twice
+        if not storage.add_trade(game_id, comment_id, buy_currency, buy_quantity, sell_currency, trade_cost):
+            logger.info("Trade with comment_id: {comment_id} was already executed".format(comment_id=comment_id))
+            return False
+
+        if sell_funds_left is not None:
+            storage.set_amount(game_id, owner, sell_currency, sell_funds_left)
+        if storage.add_amount(game_id, owner, buy_currency, buy_quantity):
+            storage.adjust_game_counters(game_id, currency_holder_deltas=[buy_currency], currency_delta=1)
+
+        self._record_trade_analytics(game_id, owner, buy_quantity, buy_currency, trade_cost, sell_currency, trade_usd_value)
+        return True
+
+    def _record_trade_analytics(self, game_id, owner, buy_quantity, buy_currency, trade_cost, sell_currency, trade_usd_value):
+        """
+        Updates the owner's average cost basis and the trade rollups of the owner and the whole game.
+        Realized P&L is the USD value received minus the average cost of what was sold
+        :param trade_usd_value: fixed point USD value of the trade or None if it could not be priced
+        """
+        storage = self.storage
+        realized_pnl = 0
+
+        # USD is the unit of account so it has no basis and selling it never realizes anything
+        if trade_usd_value is not None:
+            if sell_currency != "USD":
+                held_quantity, held_cost = storage.get_cost_basis(game_id, owner, sell_currency)
+                sold_cost = 0
+                if held_quantity > 0:
+                    sold_cost = fixed_div(fixed_mul(held_cost, min(trade_cost, held_quantity)), held_quantity)
+                realized_pnl = trade_usd_value - sold_cost
+                storage.set_cost_basis(game_id, owner, sell_currency, max(held_quantity - trade_cost, 0),
+                                       max(held_cost - sold_cost, 0))
+
+            if buy_currency != "USD":
+                held_quantity, held_cost = storage.get_cost_basis(game_id, owner, buy_currency)
+                storage.set_cost_basis(game_id, owner, buy_currency, held_quantity + buy_quantity,
+                                       held_cost + trade_usd_value)
+
+        storage.add_trade_rollups(game_id, [owner, TRADE_ROLLUP_GAME_OWNER], buy_currency, sell_currency,
+                                  buy_quantity, trade_cost, trade_usd_value or 0, realized_pnl)
+
+
+class InMemoryStorage(object):
+    """
+    GameEngine storage in dictionaries, for the benchmark and tests. Each instance is independent so parallel test
+    workers never share state. Writes are applied immediately, the engine checks everything before its first write
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self.portfolios = {} # (game_id, owner) to currency to fixed point amount
+        self.trade_comment_ids = set() # (game_id, comment_id) of every executed trade
+        self.limit_orders = {} # limit_order_id to limit order, open or closed
+        self.limit_order_comment_ids = set() # (game_id, comment_id) of every limit order
+        self.game_stats = {} # game_id to [player_count, open_order_count]
+        self.game_currencies = {} # (game_id, currency) to [holder_count, open_order_count]
+        self.cost_basis = {} # (game_id, owner, currency) to (fixed point quantity, fixed point USD cost basis)
+        self.trade_rollups = {} # (game_id, owner, buy_currency, sell_currency) to [trade_count, buy_volume, sell_volume, volume_usd, realized_pnl_usd]
+        self._next_limit_order_id = 1
+
+    def transaction(self):
+        return self._lock
+
+    def has_portfolio(self, game_id, owner):
+        return bool(self.portfolios.get((game_id, owner)))
+
+    def get_amount(self, game_id, owner, currency):
+        portfolio = self.portfolios.get((game_id, owner))
+        if portfolio is None:
+            return None
+        return portfolio.get(currency)
+
+    def set_amount(self, game_id, owner, currency, amount):
+        self.portfolios[(game_id, owner)][currency] = amount
+
+    def add_amount(self, game_id, owner, currency, amount):
+        """
+        :return: True if owner did not hold currency before
+        """
+        portfolio = self.portfolios.setdefault((game_id, owner), {})
+        held_amount = portfolio.get(currency)
+        if held_amount is None:
+            portfolio[currency] = amount
+            return True
+        portfolio[currency] = held_amount + amount
+        return False
+
+    def add_trade(self, game_id, comment_id, buy_currency, buy_amount, sell_currency, sell_amount):
+        trade_count = len(self.trade_comment_ids)
+        self.trade_comment_ids.add((game_id, comment_id))
+        return len(self.trade_comment_ids) > trade_count
+
+    def add_limit_order(self, game_id, comment_id, owner, buy_currency, buy_amount, sell_currency, sell_amount, limit_price):
+        if (game_id, comment_id) in self.limit_order_comment_ids:
+            return None
+        self.limit_order_comment_ids.add((game_id, comment_id))
+
+        limit_order_id = self._next_limit_order_id
+        self._next_limit_order_id += 1
+        self.limit_orders[limit_order_id] = {"limit_order_id": limit_order_id, "game_id": game_id, "comment_id": comment_id,
+                                             "owner": owner, "buy_currency": buy_currency, "buy_amount": buy_amount,
+                                             "sell_currency": sell_currency, "sell_amount": sell_amount,
+                                             "limit_price": limit_price, "executed": False, "canceled": False}
+        return limit_order_id
+
+    def get_open_limit_order(self, limit_order_id):
+        limit_order = self.limit_orders.get(limit_order_id)
+        if limit_order is None or limit_order["executed"] or limit_order["canceled"]:
+            return None
+        return limit_order
+
+    def close_limit_order(self, limit_order, executed):
+        limit_order["executed" if executed else "canceled"] = True
+
+    def adjust_game_counters(self, game_id, player_delta = 0, open_order_delta = 0,
+                             currency_holder_deltas = (), currency_order_deltas = (), currency_delta = 0):
+        if player_delta or open_order_delta:
+            game_stats = self.game_stats.setdefault(game_id, [0, 0])
+            game_stats[0] += player_delta
+            game_stats[1] += open_order_delta
+        for currency in currency_holder_deltas:
+            self.game_currencies.setdefault((game_id, currency), [0, 0])[0] += currency_delta
+        for currency in currency_order_deltas:
+            self.game_currencies.setdefault((game_id, currency), [0, 0])[1] += currency_delta
+
+    def get_cost_basis(self, game_id, owner, currency):
+        return self.cost_basis.get((game_id, owner, currency), (0, 0))
+
+    def set_cost_basis(self, game_id, owner, currency, quantity, cost_basis_usd):
+        self.cost_basis[(game_id, owner, currency)] = (quantity, cost_basis_usd)
+
+    def add_trade_rollups(self, game_id, owners, buy_currency, sell_currency, buy_volume, sell_volume, volume_usd, realized_pnl_usd):
+        for owner in owners:
+            rollup_key = (game_id, owner, buy_currency, sell_currency)
+            trade_rollup = self.trade_rollups.get(rollup_key)
+            if trade_rollup is None:
+                self.trade_rollups[rollup_key] = [1, buy_volume, sell_volume, volume_usd, realized_pnl_usd]
+            else:
+                trade_rollup[0] += 1
+                trade_rollup[1] += buy_volume
+                trade_rollup[2] += sell_volume
+                trade_rollup[3] += volume_usd
+                trade_rollup[4] += realized_pnl_usd
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def to_fixed(value):
+    """
+    Converts a DB Decimal, API float, command string or int to a fixed point integer scaled by FIXED_POINT_SCALE
+    :param value: the value to convert
+    :return: the scaled integer
+    """
+    # DB Decimals are by far the most common so they skip the other checks
+    if type(value) is Decimal:
+        return int(value.scaleb(FIXED_POINT_DIGITS, FIXED_POINT_CONTEXT).to_integral_value(context=FIXED_POINT_CONTEXT))
+    if isinstance(value, int):
+        return value * FIXED_POINT_SCALE
+    if isinstance(value, float):
+        # repr gives the shortest string that round trips so 0.1 becomes exactly 0.1 instead of 0.1000000000000000055
+        value = repr(value)
+    if not isinstance(value, Decimal):
+        value = Decimal(value)
+
+    return int(value.scaleb(FIXED_POINT_DIGITS, FIXED_POINT_CONTEXT).to_integral_value(context=FIXED_POINT_CONTEXT))
+
+def from_fixed(fixed_value):
+    """
+    Converts a fixed point integer back to a Decimal suitable for a DECIMAL(40,20) column
+    :param fixed_value: the scaled integer
+    :return: the exact Decimal value
+    """
+    return Decimal(fixed_value).scaleb(-FIXED_POINT_DIGITS, FIXED_POINT_CONTEXT)
+
+def fixed_mul(fixed_a, fixed_b):
+    """
+    :return: fixed_a * fixed_b rounded half up to the nearest 10^-20
+    """
+    return (fixed_a * fixed_b + FIXED_POINT_SCALE // 2) // FIXED_POINT_SCALE
+
+def fixed_div(fixed_a, fixed_b):
+    """
+    :return: fixed_a / fixed_b rounded half up to the nearest 10^-20
+    """
+    return (fixed_a * FIXED_POINT_SCALE + fixed_b // 2) // fixed_b
+
+def fixed_percent(fixed_amount, fixed_percentage):
+    """
+    :return: fixed_percentage percent of fixed_amount. 100 percent always returns fixed_amount exactly
+    """
+    divisor = 100 * FIXED_POINT_SCALE
+    return (fixed_amount * fixed_percentage + divisor // 2) // divisor
+
+def fixed_to_cents(fixed_value):
+    """
+    :return: fixed_value rounded half up to whole cents
+    """
+    cent_scale = FIXED_POINT_SCALE // 100
+    return (fixed_value + cent_scale // 2) // cent_scale
+
+def cents_to_fixed(cents):
+    """
+    :return: the fixed point value of a whole number of cents
+    """
+    return cents * (FIXED_POINT_SCALE // 100)
+
+def format_fixed_2f(fixed_value):
+    """
+    Formats like '{:,.2f}'.format(value) without going through float. Rounds half up on the exact value so it can be
+    a cent above float formatting, which rounds the nearest binary value of a number like 862592.315 down
+    :param fixed_value: the scaled integer to format
+    :return: the formatted string
+    """
+    sign = ""
+    if fixed_value < 0:
+        sign = "-"
+        fixed_value = -fixed_value
+    total_cents = (fixed_value + FIXED_POINT_HALF_CENT) // FIXED_POINT_CENT
+    return "{}{:,}.{:02d}".format(sign, total_cents // 100, total_cents % 100)
+
+def format_fixed_6g(fixed_value):
+    """
+    Same output as '{:,.6g}'.format(value). Int true division is correctly rounded so this is display only and exact enough
+    :param fixed_value: the scaled integer to format
+    :return: the formatted string
+    """
+    return "{:,.6g}".format(fixed_value / FIXED_POINT_SCALE)
+
+def parse_market_order(body):
+    """
+    :param body: the text of the command
+    :return: the order or None if body has no valid !Market command
+    """
+    return parse_order(MARKET_ORDER_REGEX, body)
+
+def parse_limit_order(body):
+    """
+    :param body: the text of the command
+    :return: the order or None if body has no valid !Limit command
+    """
+    return parse_order(LIMIT_ORDER_REGEX, body)
+
+def parse_order(command_regex, body):
+    """
+    :return: dictionary with the fixed point quantity, is_percent, the upper case buy_currency and sell_currency, the
+    fixed point limit_price of limit orders and the quantity_text and limit_price_text as they were typed
+    """
+    match = re.search(command_regex, body, re.IGNORECASE)
+    if not (match and match.group("quantity") and match.group("buy_currency") and match.group("sell_currency")):
+        return None
+
+    quantity_text = match.group("quantity")
+    limit_price_text = match.group("limit_price") if "limit_price" in match.groupdict() else None
+    try:
+        order = {"quantity": to_fixed(quantity_text.replace("%", "")),
+                 "is_percent": "%" in quantity_text,
+                 "buy_currency": match.group("buy_currency").upper(),
+                 "sell_currency": match.group("sell_currency").upper(),
+                 "limit_price": to_fixed(limit_price_text) if limit_price_text else None,
+                 "quantity_text": quantity_text,
+                 "limit_price_text": limit_price_text}
+    except InvalidOperation:
+        # A lone % or . matches the regex but is not a number
+        return None
+
+    if "limit_price" in match.groupdict() and order["limit_price"] is None:
+        return None
+    return order
+
+def is_order_valid(order):
+    """
+    :return: False if the quantity or limit price is not positive or a percentage is over 100
+    """
+    return (order["quantity"] > 0 and
+            (order["limit_price"] is None or order["limit_price"] > 0) and
+            not (order["is_percent"] and order["quantity"] > 100 * FIXED_POINT_SCALE))
+
+def size_order(order, available_funds, price):
+    """
+    :param available_funds: fixed point amount of the sell currency the owner has
+    :param price: fixed point price of one buy currency in the sell currency
+    :return: tuple of (fixed point cost in the sell currency, fixed point quantity bought)
+    """
+    if order["is_percent"]:
+        trade_cost = fixed_percent(available_funds, order["quantity"])
+        return trade_cost, fixed_div(trade_cost, price)
+    return fixed_mul(order["quantity"], price), order["quantity"]
+
+def run_benchmark(trade_count = BENCHMARK_TRADE_COUNT):
+    """
+    Runs trade_count market orders of BENCHMARK_PLAYER_COUNT players through GameEngine on InMemoryStorage against
+    random walk prices. Every trade updates the portfolios, game counters, cost basis and rollups like the bot's
+    :return: trades per second
+    """
+    randomizer = random.Random(0)
+    usd_prices = dict((currency, to_fixed(randomizer.uniform(0.1, 1000))) for currency in BENCHMARK_CURRENCIES)
+    usd_prices["USD"] = FIXED_POINT_SCALE
+    pair_prices = {}
+
+    def update_pair_prices():
+        for currency in BENCHMARK_CURRENCIES:
+            pair_prices[(currency, "USD")] = usd_prices[currency]
+            pair_prices[("USD", currency)] = fixed_div(FIXED_POINT_SCALE, usd_prices[currency])
+
+    update_pair_prices()
+    engine = GameEngine(InMemoryStorage(), lambda from_symbol, to_symbol, price_time: pair_prices[(from_symbol, to_symbol)],
+                        lambda currencies: usd_prices)
+
+    owners = ["player{player_number}".format(player_number=player_number) for player_number in range(BENCHMARK_PLAYER_COUNT)]
+    for owner in owners:
+        engine.onboard(1, owner)
+
+    # Orders are parsed up front so only the engine is timed. Players spend 5% of their USD on a coin and sell
+    # half of a coin they hold every fourth trade so cost basis and realized P&L are exercised
+    buy_orders = [parse_market_order("!market 5% {currency} USD".format(currency=currency)) for currency in BENCHMARK_CURRENCIES]
+    sell_orders = [parse_market_order("!market 50% USD {currency}".format(currency=currency)) for currency in BENCHMARK_CURRENCIES]
+    commands = []
+    for trade_number in range(trade_count):
+        currency_index = randomizer.randrange(len(BENCHMARK_CURRENCIES))
+        order = sell_orders[currency_index] if trade_number % 4 == 3 else buy_orders[currency_index]
+        commands.append((str(trade_number), owners[randomizer.randrange(len(owners))], order))
+
+    start_time = time.perf_counter()
+    executed_count = 0
+    for trade_number, (comment_id, owner, order) in enumerate(commands):
+        if trade_number % 100 == 0:
+            for currency in BENCHMARK_CURRENCIES:
+                usd_prices[currency] = fixed_mul(usd_prices[currency], to_fixed(1 + randomizer.gauss(0, 0.001)))
+            update_pair_prices()
+        if engine.market_order(1, comment_id, owner, order, trade_number)[0] == OrderResult.EXECUTED:
+            executed_count += 1
+    elapsed_sec = time.perf_counter() - start_time
+
+    print("{executed_count} of {trade_count} market orders executed in {elapsed_sec:.2f} sec, {trades_per_sec:,.0f} trades/sec".format(
+        executed_count=executed_count,
+        trade_count=trade_count,
+        elapsed_sec=elapsed_sec,
+        trades_per_sec=trade_count / elapsed_sec))
+    return trade_count / elapsed_sec
+
+def run_fixed_point_benchmark(row_count = BENCHMARK_ROW_COUNT):
+    """
+    Times the float round trips the bot used to make against the fixed point path on the same DECIMAL(40,20) rows.
+    A valuation reads an amount, values it with a tick price and formats it. A cached valuation does the same with
+    amounts that were already converted. A trade reads an amount, subtracts a cost and writes the amount back
+    :return: dictionary of path name to (float sec, fixed point sec)
+    """
+    randomizer = random.Random(0)
+    # The DB driver returns the amounts as Decimals and the price API returns floats
+    amounts = [from_fixed(randomizer.randrange(1, 10 ** 6 * FIXED_POINT_SCALE)) for _ in range(row_count)]
+    float_prices = [randomizer.uniform(0.0001, 10000) for _ in range(row_count)]
+    fixed_prices = [to_fixed(float_price) for float_price in float_prices]
+    rows = list(zip(amounts, float_prices, fixed_prices))
+
+    timings = {}
+
+    start_time = time.perf_counter()
+    for amount, float_price, fixed_price in rows:
+        "{:,.2f}".format(float(amount) * float_price)
+    float_sec = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    for amount, float_price, fixed_price in rows:
+        format_fixed_2f(fixed_mul(to_fixed(amount), fixed_price))
+    timings["valuation"] = (float_sec, time.perf_counter() - start_time)
+
+    # Holdings are converted once when the portfolio cache loads them, so repeat valuations skip the conversion
+    float_rows = [(float(amount), float_price) for amount, float_price, fixed_price in rows]
+    fixed_rows = [(to_fixed(amount), fixed_price) for amount, float_price, fixed_price in rows]
+    start_time = time.perf_counter()
+    for float_amount, float_price in float_rows:
+        "{:,.2f}".format(float_amount * float_price)
+    float_sec = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    for fixed_amount, fixed_price in fixed_rows:
+        format_fixed_2f(fixed_mul(fixed_amount, fixed_price))
+    timings["cached valuation"] = (float_sec, time.perf_counter() - start_time)
+
+    # The old path wrote the float back, which the DB driver renders with repr
+    start_time = time.perf_counter()
+    for amount, float_price, fixed_price in rows:
+        repr(float(amount) - float_price / 1000)
+    float_sec = time.perf_counter() - start_time
+    fixed_cost_divisor = to_fixed(1000)
+    start_time = time.perf_counter()
+    for amount, float_price, fixed_price in rows:
+        str(from_fixed(to_fixed(amount) - fixed_div(fixed_price, fixed_cost_divisor)))
+    timings["trade"] = (float_sec, time.perf_counter() - start_time)
+
+    for path_name, (float_sec, fixed_sec) in sorted(timings.items()):
+        print("{path_name}: {row_count} rows, float round trips {float_sec:.3f} sec, fixed point {fixed_sec:.3f} sec, "
+              "fixed point takes {ratio:.2f}x the time".format(path_name=path_name,
+                                                               row_count=row_count,
+                                                               float_sec=float_sec,
+                                                               fixed_sec=fixed_sec,
+                                                               ratio=fixed_sec / float_sec))
+    return timings
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def main():
+    if "--benchmark" in sys.argv[1:]:
+        benchmark_args = sys.argv[sys.argv.index("--benchmark") + 1:]
+        run_benchmark(int(benchmark_args[0]) if benchmark_args and benchmark_args[0].isdigit() else BENCHMARK_TRADE_COUNT)
+    if "--benchmark-fixed-point" in sys.argv[1:]:
+        benchmark_args = sys.argv[sys.argv.index("--benchmark-fixed-point") + 1:]
+        run_fixed_point_benchmark(int(benchmark_args[0]) if benchmark_args and benchmark_args[0].isdigit() else BENCHMARK_ROW_COUNT)
+
+# =============================================================================
+# RUNNER
+# =============================================================================
+
+if __name__ == '__main__':
+    main()
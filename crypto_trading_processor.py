@@ -15,11 +15,30 @@ import time
 import os
 import sys
 import requests
+import uuid
+import signal
+import difflib
+import json
+import queue
+import smtplib
+import shutil
 from datetime import datetime
+from email.message import EmailMessage
+from types import SimpleNamespace
 from dateutil.relativedelta import relativedelta
 from praw.exceptions import APIException, PRAWException
-from threading import Thread
+from praw.models import MoreComments
+from threading import Lock, Event, current_thread
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from crypto_trading_engine import (STARTING_USD_AMOUNT, TRADE_ROLLUP_GAME_OWNER, GameEngine, OrderResult,
+                                   to_fixed, from_fixed, fixed_mul, fixed_div,
+                                   fixed_to_cents, cents_to_fixed, format_fixed_2f, format_fixed_6g,
+                                   parse_market_order, parse_limit_order)
+from crypto_trading_util import (TICK_LOAD_IDLE, TICK_LOAD_NORMAL, TICK_LOAD_BUSY,
+                                 LogFields, Metrics, LeaderBoard, TickScheduler, LimitOrderProximityIndex, ReplaySession,
+                                 to_bit_int, to_snapshot_value, write_npy_column)
 
 # =============================================================================
 # GLOBALS
@@ -56,15 +75,137 @@ if ENVIRONMENT == "DEV":
 DEV_USER_NAME = config.get("CRYPTOTRADING", "dev_user")
 
 RUNNING_FILE = "crypto_trading_processor.running"
+# How long a process started with --takeover waits for the old process to exit
+HANDOFF_TIMEOUT_SEC = 300
 SUPPORTED_COMMANDS = ("!Market {buy_amount} {buy_symbol} {sell_symbol}\n\n"
                       "!Limit {buy_amount} {buy_symbol} {sell_symbol} {limit_price}\n\n"
                       "!CancelLimit {order_id}\n\n"
-                      "!Portfolio\n\n")
+                      "!Portfolio\n\n"
+                      "!Standings {page}\n\n"
+                      "!Stats {buy_symbol} {sell_symbol}\n\n")
+
+# Inbound command queue settings
+COMMAND_QUEUE_WORKERS = config.getint("CRYPTOTRADING", "command_queue_workers", fallback=4)
+COMMAND_QUEUE_BATCH_SIZE = 20
+COMMAND_QUEUE_LEASE_SEC = 300
+COMMAND_QUEUE_MAX_ATTEMPTS = 5
+COMMAND_QUEUE_BACKOFF_SEC = 30
+COMMAND_QUEUE_MAX_BACKOFF_SEC = 3600
+COMMAND_STATUS_PENDING = "PENDING"
+COMMAND_STATUS_PROCESSING = "PROCESSING"
+DELETED_COMMENT_OWNER = "[deleted]" # owner of queued comments whose author deleted their account
+
+# Standings history resolutions with their bucket size and how long each is kept
+STANDINGS_RESOLUTION_MINUTE = "M"
+STANDINGS_RESOLUTION_HOUR = "H"
+STANDINGS_RESOLUTION_DAY = "D"
+STANDINGS_HISTORY_RESOLUTIONS = ((STANDINGS_RESOLUTION_MINUTE, 60),
+                                 (STANDINGS_RESOLUTION_HOUR, 3600),
+                                 (STANDINGS_RESOLUTION_DAY, 86400))
+STANDINGS_HISTORY_RETENTION_SEC = ((STANDINGS_RESOLUTION_MINUTE, 2 * 86400),
+                                   (STANDINGS_RESOLUTION_HOUR, 60 * 86400))
+
+# Number of players shown in the game's post
+LEADER_BOARD_POST_ROWS = 100
+
+# Completed games are moved to the *_archive tables this long after they end, ARCHIVE_CHUNK_SIZE rows per transaction
+ARCHIVE_AFTER_SEC = 86400
+ARCHIVE_CHUNK_SIZE = 1000
+ARCHIVE_TABLES = (("portfolio", "portfolio_id"),
+                  ("limit_order", "limit_order_id"),
+                  ("processed_comment", "processed_comment_id"),
+                  ("executed_trade", "executed_trade_id"),
+                  ("standings", "standings_id"))
+
+# Bounded worker pools every fan-out goes through, one per workload. The price pool bounds concurrent price API
+# calls, the db pool (COMMAND_QUEUE_WORKERS) the DB connections held by workers and the reddit pool concurrent
+# replies. Work on one pool that needs another workload waits on that pool with WorkerPool.call
+PRICE_POOL_WORKERS = config.getint("CRYPTOTRADING", "price_pool_workers", fallback=8)
+REDDIT_POOL_WORKERS = config.getint("CRYPTOTRADING", "reddit_pool_workers", fallback=4)
+
+# Comments hidden behind MoreComments are expanded with at most COMMENT_HARVEST_REQUESTS_PER_TICK requests per tick
+# across all games, COMMENT_HARVEST_BATCH_SIZE comments per request
+COMMENT_HARVEST_REQUESTS_PER_TICK = 10
+COMMENT_HARVEST_BATCH_SIZE = 100
+
+# Inbox settings
+INBOX_MAX_ATTEMPTS = 5
+INBOX_MARK_READ_BATCH_SIZE = 25
+
+# Flair templates rarely change so they are only reloaded after this long
+FLAIR_TEMPLATE_TTL_SEC = 3600
+
+# Prices older than this are refetched instead of being served from the tick's price snapshot
+PRICE_SNAPSHOT_MAX_AGE_SEC = 120
+
+# Symbols commands are validated against before any price request. The CryptoCompare coin list is reloaded after
+# COIN_LIST_TTL_SEC and saved to COIN_LIST_SNAPSHOT_FILE so a restart while the API is down still validates
+COIN_LIST_TTL_SEC = 86400
+COIN_LIST_RETRY_SEC = 300
+COIN_LIST_SNAPSHOT_FILE = "coinlist_snapshot.txt"
+FIAT_SYMBOLS = ("USD", "EUR", "GBP", "JPY", "CNY", "KRW", "CAD", "AUD")
+
+# Commands processed more than a minute after they were posted are priced from minute bars that are fetched once
+# per currency pair over the whole backlog, HISTORICAL_BARS_MAX_LIMIT bars per request
+HISTORICAL_BARS_MAX_LIMIT = 2000
+
+# Main loop phases each run on their own cadence of (base, min, max) seconds measured start to start
+TICK_INTERVALS_SEC = {"create_new_games": (60, 60, 300),
+                      "process_pms": (30, 10, 120),
+                      "process_game_messages": (30, 10, 120),
+                      "update_games_current_prices": (60, 60, 300),
+                      "update_leader_boards": (60, 60, 300),
+                      "execute_limit_orders": (30, 10, 120),
+                      "close_games": (30, 30, 120),
+                      "archive_completed_games": (3600, 3600, 3600)}
 
 common_currencies = ["ADA","BCH","BCN","BTC","BTG","BTS","DASH","ETC","ETH","LSK","LTC","MIOTA","NANO","NEO","QTUM","SC","STEEM","STRAT","WAVES","XEM","XLM","XMR","XRP","XVG","ZEC"]
 
+# Per game snapshots of the tables in SNAPSHOT_TABLES are written to SNAPSHOT_DIR as one .npy file per column.
+# Strings are stored as int32 codes into the strings list of the snapshot's manifest.json
+SNAPSHOT_DIR = config.get("CRYPTOTRADING", "snapshot_dir", fallback="snapshots")
+SNAPSHOT_TABLES = (("portfolio", (("portfolio_id", "int"), ("owner", "str"), ("currency", "str"), ("amount", "decimal"))),
+                   ("limit_order", (("limit_order_id", "int"), ("comment_id", "str"), ("owner", "str"),
+                                    ("buy_currency", "str"), ("buy_amount", "decimal"),
+                                    ("sell_currency", "str"), ("sell_amount", "decimal"),
+                                    ("limit_price", "decimal"), ("executed", "bool"), ("canceled", "bool"),
+                                    ("create_timestamp", "datetime"))),
+                   ("executed_trade", (("executed_trade_id", "int"), ("comment_id", "str"),
+                                       ("buy_currency", "str"), ("buy_amount", "decimal"),
+                                       ("sell_currency", "str"), ("sell_amount", "decimal"),
+                                       ("create_timestamp", "datetime"))),
+                   ("standings", (("owner", "str"), ("portfolio_value", "decimal"))))
+
+# When record_file is set the games, processed comments, price quotes, triggered limit orders and replies are
+# appended to it as JSON lines so the games can be replayed offline with --replay
+RECORD_FILE = config.get("CRYPTOTRADING", "record_file", fallback="")
+
+# Dev alerts with the same fingerprint are counted instead of repeated and everything raised within
+# DEV_ALERT_WINDOW_SEC is sent as one digest through the DEV_ALERT_SINK (reddit, file or smtp)
+DEV_ALERT_SINK = config.get("CRYPTOTRADING", "dev_alert_sink", fallback="reddit")
+DEV_ALERT_FILE = config.get("CRYPTOTRADING", "dev_alert_file", fallback="dev_alerts.log")
+DEV_ALERT_SMTP_HOST = config.get("CRYPTOTRADING", "dev_alert_smtp_host", fallback="localhost")
+DEV_ALERT_SMTP_PORT = config.getint("CRYPTOTRADING", "dev_alert_smtp_port", fallback=25)
+DEV_ALERT_EMAIL = config.get("CRYPTOTRADING", "dev_alert_email", fallback="root@localhost")
+DEV_ALERT_WINDOW_SEC = 300
+DEV_ALERT_MAX_BODY_CHARS = 9000
+# Alerts that share a fingerprint keep up to this many distinct texts so IDs that differ are still reported
+DEV_ALERT_MAX_DISTINCT = 20
+
+# Structured logs are JSON lines written to LOG_FILE by a background thread and rotated at LOG_MAX_BYTES.
+# Each log call site and message keeps LOG_SAMPLE_BURST records per LOG_SAMPLE_WINDOW_SEC and after that every
+# LOG_SAMPLE_EVERY-th. Numbers are masked in the message so retry counts and timestamps do not split a window
+LOG_FILE = config.get("CRYPTOTRADING", "log_file", fallback="crypto_trading_processor.json.log")
+LOG_MAX_BYTES = config.getint("CRYPTOTRADING", "log_max_bytes", fallback=10 * 1024 * 1024)
+LOG_BACKUP_COUNT = config.getint("CRYPTOTRADING", "log_backup_count", fallback=5)
+LOG_SAMPLE_BURST = 5
+LOG_SAMPLE_WINDOW_SEC = 60
+LOG_SAMPLE_EVERY = 20
+# Expired windows with nothing left to report are dropped once there are more than this many
+LOG_SAMPLE_MAX_WINDOWS = 10000
+
+# Warnings and errors are also written to stderr in this format for the restart script's log
 FORMAT = '%(asctime)-15s %(message)s'
-logging.basicConfig(format=FORMAT)
 logger = logging.getLogger('cryptoTradingGameBot')
 logger.setLevel(logging.INFO)
 
@@ -83,6 +224,8 @@ class CommandType(Enum):
     UNKNOWN = 4
     PORTFOLIO = 5
     CANCEL_LIMIT_ORDER = 6
+    STANDINGS = 7
+    STATS = 8
 
 class DbConnection(object):
     """
@@ -98,106 +241,1243 @@ class DbConnection(object):
         self.cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
 
 
+class RequestContext(object):
+    """
+    One DB connection and transaction shared by everything a single command does. Memoizes portfolios for the
+    command and holds back replies and portfolio cache invalidation until the transaction commits
+    """
+
+    def __init__(self):
+        self._db_connection = None
+        self._portfolios = {} # (game_id, username) to the portfolio rows read in this transaction
+        self._changed_portfolios = set() # (game_id, username) written in this transaction
+        self._replies = [] # (message, reply text) sent after commit
+
+    @property
+    def db_connection(self):
+        if self._db_connection is None:
+            self._db_connection = DbConnection()
+        return self._db_connection
+
+    def get_portfolio(self, game_id, username, currency = None):
+        """
+        :return: the same rows get_portfolio returns, read once per transaction and again after a write
+        """
+        portfolio_key = (game_id, username)
+        if portfolio_key not in self._portfolios:
+            query = "SELECT * FROM portfolio WHERE game_id = %s AND owner = %s ORDER BY currency ASC"
+            self.db_connection.cursor.execute(query, [game_id, username])
+            self._portfolios[portfolio_key] = self.db_connection.cursor.fetchall()
+
+        portfolio = self._portfolios[portfolio_key]
+        if currency is not None:
+            portfolio = [portfolio_currency for portfolio_currency in portfolio if portfolio_currency["currency"] == currency]
+        return portfolio
+
+    def portfolio_changed(self, game_id, username):
+        """
+        Must be called after writing to username's portfolio or limit orders in this transaction
+        """
+        self._portfolios.pop((game_id, username), None)
+        self._changed_portfolios.add((game_id, username))
+
+    def is_portfolio_changed(self, game_id, username):
+        return (game_id, username) in self._changed_portfolios
+
+    def reply(self, message, reply_text):
+        """
+        Queues a reply to message that is only sent once the command's changes are committed.
+        Every reply goes through here so the recording has all of them for replays to compare
+        """
+        self._replies.append((message, reply_text))
+
+    def commit(self):
+        """
+        Commits the transaction and then sends the queued replies
+        """
+        if self._db_connection is not None:
+            self._db_connection.connection.commit()
+        self._finish()
+
+        replies = self._replies
+        self._replies = []
+        for message, reply_text in replies:
+            input_recorder.record("reply", comment_id=message.id, text=reply_text)
+            reddit_pool.call(message.reply, reply_text)
+
+    def close(self):
+        """
+        Rolls back anything that was not committed. Safe to call after commit
+        """
+        self._replies = []
+        if self._db_connection is not None:
+            self._db_connection.connection.rollback()
+        self._finish()
+
+    def _finish(self):
+        if self._db_connection is not None:
+            self._db_connection.connection.close()
+            self._db_connection = None
+        for game_id, username in self._changed_portfolios:
+            portfolio_summary_cache.invalidate(game_id, username)
+        self._portfolios = {}
+        self._changed_portfolios = set()
+
+
+class MySqlStorage(object):
+    """
+    GameEngine storage over the MySQL tables. Everything runs in the command's RequestContext so the engine's
+    writes commit or roll back with the rest of the command, which is why transaction() does not commit on its own
+    """
+
+    def __init__(self, request_context):
+        self.request_context = request_context
+
+    def transaction(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def has_portfolio(self, game_id, owner):
+        return bool(self.request_context.get_portfolio(game_id, owner))
+
+    def get_amount(self, game_id, owner, currency):
+        portfolio_currency = self.request_context.get_portfolio(game_id, owner, currency)
+        if portfolio_currency:
+            return to_fixed(portfolio_currency[0]["amount"])
+        return None
+
+    def set_amount(self, game_id, owner, currency, amount):
+        query = "UPDATE portfolio SET amount = %s WHERE game_id = %s AND owner = %s AND currency = %s"
+        self.request_context.db_connection.cursor.execute(query, [from_fixed(amount), game_id, owner, currency])
+        self.request_context.portfolio_changed(game_id, owner)
+
+    def add_amount(self, game_id, owner, currency, amount):
+        """
+        :return: True if owner did not hold currency before
+        """
+        portfolio_currency = self.request_context.get_portfolio(game_id, owner, currency)
+        if portfolio_currency:
+            query = "UPDATE portfolio SET amount = amount + %s WHERE portfolio_id = %s"
+            query_args = [from_fixed(amount), portfolio_currency[0]["portfolio_id"]]
+        else:
+            query = "INSERT INTO portfolio (game_id, owner, currency, amount) VALUES (%s, %s, %s, %s)"
+            query_args = [game_id, owner, currency, from_fixed(amount)]
+        self.request_context.db_connection.cursor.execute(query, query_args)
+        self.request_context.portfolio_changed(game_id, owner)
+        return not portfolio_currency
+
+    def add_trade(self, game_id, comment_id, buy_currency, buy_amount, sell_currency, sell_amount):
+        query = ("INSERT IGNORE INTO executed_trade (game_id, comment_id, buy_currency, buy_amount, sell_currency, sell_amount) "
+                 "VALUES (%s, %s, %s, %s, %s, %s)")
+        rowcount = self.request_context.db_connection.cursor.execute(query, [game_id, comment_id, buy_currency, from_fixed(buy_amount),
+                                                                             sell_currency, from_fixed(sell_amount)])
+        return rowcount > 0
+
+    def add_limit_order(self, game_id, comment_id, owner, buy_currency, buy_amount, sell_currency, sell_amount, limit_price):
+        db_connection = self.request_context.db_connection
+        query = ("INSERT IGNORE INTO limit_order (game_id, comment_id, owner, buy_currency, buy_amount, sell_currency, sell_amount, limit_price, executed, canceled) "
+                 "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+        rowcount = db_connection.cursor.execute(query, [game_id, comment_id, owner, buy_currency, from_fixed(buy_amount), sell_currency,
+                                                        from_fixed(sell_amount), from_fixed(limit_price), False, False])
+        if rowcount == 0:
+            return None
+
+        self.request_context.portfolio_changed(game_id, owner)
+        return db_connection.cursor.lastrowid
+
+    def get_open_limit_order(self, limit_order_id):
+        """
+        :return: the open limit order with its amounts in fixed point, locked until the command commits, or None
+        """
+        query = "SELECT * FROM limit_order WHERE limit_order_id = %s AND executed = false AND canceled = false FOR UPDATE"
+        self.request_context.db_connection.cursor.execute(query, [limit_order_id])
+        limit_orders = self.request_context.db_connection.cursor.fetchall()
+        if not limit_orders:
+            return None
+
+        limit_order = dict(limit_orders[0])
+        for amount_column in ("buy_amount", "sell_amount", "limit_price"):
+            limit_order[amount_column] = to_fixed(limit_order[amount_column])
+        return limit_order
+
+    def close_limit_order(self, limit_order, executed):
+        query = "UPDATE limit_order SET {column} = true WHERE limit_order_id = %s".format(
+            column="executed" if executed else "canceled")
+        self.request_context.db_connection.cursor.execute(query, [limit_order["limit_order_id"]])
+        self.request_context.portfolio_changed(limit_order["game_id"], limit_order["owner"])
+
+    def adjust_game_counters(self, game_id, player_delta = 0, open_order_delta = 0,
+                             currency_holder_deltas = (), currency_order_deltas = (), currency_delta = 0):
+        adjust_game_counters(self.request_context.db_connection, game_id, player_delta, open_order_delta,
+                             currency_holder_deltas, currency_order_deltas, currency_delta)
+
+    def get_cost_basis(self, game_id, owner, currency):
+        """
+        :return: tuple of (fixed point quantity, fixed point USD cost basis), locked until the command commits
+        """
+        query = ("SELECT quantity, cost_basis_usd FROM position_cost_basis "
+                 "WHERE game_id = %s AND owner = %s AND currency = %s FOR UPDATE")
+        self.request_context.db_connection.cursor.execute(query, [game_id, owner, currency])
+        positions = self.request_context.db_connection.cursor.fetchall()
+        if positions:
+            return to_fixed(positions[0]["quantity"]), to_fixed(positions[0]["cost_basis_usd"])
+        return 0, 0
+
+    def set_cost_basis(self, game_id, owner, currency, quantity, cost_basis_usd):
+        query = ("INSERT INTO position_cost_basis (game_id, owner, currency, quantity, cost_basis_usd) VALUES (%s, %s, %s, %s, %s) "
+                 "ON DUPLICATE KEY UPDATE quantity = VALUES(quantity), cost_basis_usd = VALUES(cost_basis_usd)")
+        self.request_context.db_connection.cursor.execute(query, [game_id, owner, currency, from_fixed(quantity),
+                                                                  from_fixed(cost_basis_usd)])
+
+    def add_trade_rollups(self, game_id, owners, buy_currency, sell_currency, buy_volume, sell_volume, volume_usd, realized_pnl_usd):
+        rollup_values = [buy_currency, sell_currency, from_fixed(buy_volume), from_fixed(sell_volume),
+                         from_fixed(volume_usd), from_fixed(realized_pnl_usd)]
+        query_args = []
+        for owner in owners:
+            query_args.extend([game_id, owner] + rollup_values)
+        query = ("INSERT INTO trade_rollup (game_id, owner, buy_currency, sell_currency, trade_count, buy_volume, sell_volume, "
+                 "volume_usd, realized_pnl_usd) VALUES {rows} "
+                 "ON DUPLICATE KEY UPDATE trade_count = trade_count + 1, "
+                 "buy_volume = buy_volume + VALUES(buy_volume), "
+                 "sell_volume = sell_volume + VALUES(sell_volume), "
+                 "volume_usd = volume_usd + VALUES(volume_usd), "
+                 "realized_pnl_usd = realized_pnl_usd + VALUES(realized_pnl_usd)".format(
+            rows=", ".join(["(%s, %s, %s, %s, 1, %s, %s, %s, %s)"] * len(owners))))
+        self.request_context.db_connection.cursor.execute(query, query_args)
+
+
 class MessageRequest(object):
-    _errored_requests = []
 
     def __init__(self, message):
         self.message = message # Reddit message to process
+        self.error = None # Details of why the message could not be processed
 
     def process(self):
+        """
+        Processes the command in the message. Everything the command writes, including marking it processed,
+        is committed as one transaction before any reply is sent
+        :return: True if the message was processed False if it should be retried
+        """
+        request_context = RequestContext()
         try:
             if self.message.author is None: #could be deleted comment
                 add_to_processed(self.message.parent().id, self.message.id, self.message.body)
-                return
+                input_recorder.record_comment(self.message)
+                return True
 
             processed = False
             command = self._get_command()
 
             if command == CommandType.NEW_GAME and self.message.author.name == DEV_USER_NAME:
-                create_new_custom_game(self.message)
+                create_new_custom_game(self.message, request_context)
                 processed = True
             elif command == CommandType.MARKET_ORDER:
                 initialize_portfolio(self.message.parent().id, self.message.author.name)
-                processed = process_market_order_command(self.message)
+                processed = process_market_order_command(self.message, request_context)
             elif command == CommandType.LIMIT_ORDER:
                 initialize_portfolio(self.message.parent().id, self.message.author.name)
-                processed = process_limit_order_command(self.message)
+                processed = process_limit_order_command(self.message, request_context)
             elif command == CommandType.CANCEL_LIMIT_ORDER:
                 initialize_portfolio(self.message.parent().id, self.message.author.name)
-                processed = process_cancel_limit_order_command(self.message)
+                processed = process_cancel_limit_order_command(self.message, request_context)
             elif command == CommandType.PORTFOLIO:
                 initialize_portfolio(self.message.parent().id, self.message.author.name)
-                portfolio_summary = get_portfolio_summary(self.message.parent().id, self.message.author.name)
-                self.message.reply("Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
+                portfolio_summary = get_portfolio_summary(self.message.parent().id, self.message.author.name, request_context)
+                request_context.reply(self.message, "Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
                             portfolio_summary = portfolio_summary
                             ))
                 processed = True
+            elif command == CommandType.STANDINGS:
+                processed = process_standings_command(self.message, request_context)
+            elif command == CommandType.STATS:
+                processed = process_stats_command(self.message, request_context)
             else: #Unknown command
-                self.message.reply("I could not process your message because there were no valid commands found.")
+                request_context.reply(self.message, "I could not process your message because there were no valid commands found.")
                 processed = True
 
             if processed:
                 if self.message.parent_id is not None:
-                    add_to_processed(self.message.parent().id, self.message.id, self.message.body)
+                    add_to_processed(self.message.parent().id, self.message.id, self.message.body, request_context)
+                request_context.commit()
+                input_recorder.record_comment(self.message)
             else:
-                #Prevent sending the dev more than 1 PM for the same message
-                if self.message.id not in MessageRequest._errored_requests:
-                    MessageRequest._errored_requests.append(self.message.id)
-                    send_dev_pm("Crypto Trading Game: Could Not Process Message",
-                                "Could not   process message: {message}".format(message = str(self.message)))
+                self.error = "Could not   process message: {message}".format(message = str(self.message))
+
+            return processed
         except Exception as err:
-            #Prevent sending the dev more than 1 PM for the same message
-            if self.message.id not in MessageRequest._errored_requests:
-                logger.exception("Error in process for {message}".format(message = str(self.message)))
-                send_dev_pm("Crypto Trading Game: Could Not Process Message",
-                            "Unknown exception occured while processing message: {message}".format(message = str(self.message)))
-                MessageRequest._errored_requests.append(self.message.id)
+            logger.exception("Error in process for {message}".format(message = str(self.message)))
+            self.error = "Unknown exception occured while processing message: {message}\n\n{traceback}".format(
+                message = str(self.message),
+                traceback = traceback.format_exc())
+            return False
+        finally:
+            request_context.close()
 
     def _get_command(self):
-        message_lower = self.message.body.lower()
-        if "!newgame" in message_lower:
-            return CommandType.NEW_GAME
-        elif "!market" in message_lower:
-            return CommandType.MARKET_ORDER
-        elif "!limit" in message_lower:
-            return CommandType.LIMIT_ORDER
-        elif "!cancellimit" in message_lower:
-            return CommandType.CANCEL_LIMIT_ORDER
-        elif "!portfolio" in message_lower:
-            return CommandType.PORTFOLIO
-        else:
-            return CommandType.UNKNOWN
+        return get_command_type(self.message.body)
+
+class PlayerOnboarding(object):
+    """
+    Remembers which players already have a portfolio in each game so commands skip the check, and gives new players
+    their starting USD with one multi-row INSERT IGNORE per game. Portfolio rows are never deleted so a player
+    stays onboarded until the game is archived
+    """
+    # Commands that trade or show the portfolio so their authors need one
+    COMMAND_TYPES = (CommandType.MARKET_ORDER, CommandType.LIMIT_ORDER, CommandType.CANCEL_LIMIT_ORDER, CommandType.PORTFOLIO)
+
+    def __init__(self):
+        self._lock = Lock()
+        self._players = {} # game_id to the set of owners known to have a portfolio
+
+    def is_onboarded(self, game_id, owner):
+        with self._lock:
+            return owner in self._players.get(game_id, ())
+
+    def onboard_commenters(self, game_id, comments):
+        """
+        Onboards the authors of the comments whose commands need a portfolio
+        :param game_id: the game the comments were made in
+        :param comments: the reddit comments seen this tick
+        :return: the number of new players
+        """
+        return self.onboard(game_id, [comment.author.name for comment in comments
+                                      if comment.author is not None and get_command_type(comment.body) in self.COMMAND_TYPES])
+
+    def onboard(self, game_id, owners):
+        """
+        Creates the starting portfolio of every owner that is not known to have one. Owners that already have one
+        are skipped by the INSERT IGNORE so this is safe after a restart
+        :param game_id: the game the owners are playing
+        :param owners: usernames of the players
+        :return: the number of new players
+        """
+        with self._lock:
+            known_owners = self._players.get(game_id, ())
+            new_owners = sorted(set(owner for owner in owners if owner not in known_owners))
+        if not new_owners:
+            return 0
+
+        values_sql = ",".join(["(%s, %s, %s, %s)"] * len(new_owners))
+        sql_args = []
+        for owner in new_owners:
+            sql_args.extend([game_id, owner, "USD", STARTING_USD_AMOUNT])
+
+        db_connection = DbConnection()
+        query = "INSERT IGNORE INTO portfolio (game_id, owner, currency, amount) VALUES {values}".format(values=values_sql)
+        player_count = db_connection.cursor.execute(query, sql_args)
+        if player_count:
+            adjust_game_counters(db_connection, game_id, player_delta=player_count,
+                                 currency_holder_deltas=["USD"], currency_delta=player_count)
+        db_connection.connection.commit()
+        db_connection.connection.close()
+
+        for owner in new_owners:
+            portfolio_summary_cache.invalidate(game_id, owner)
+        with self._lock:
+            self._players.setdefault(game_id, set()).update(new_owners)
+        metrics.increment("players_onboarded", player_count)
+        return player_count
+
+    def forget_game(self, game_id):
+        with self._lock:
+            self._players.pop(game_id, None)
+
+
+class PriceSnapshot(object):
+    """
+    Fixed point USD prices captured once per tick and shared by every valuation in that tick
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._prices = {}
+        self._price_times = {}
+        self.version = 0
+
+    def update(self, prices):
+        """
+        :param prices: dictionary of currency to float USD price from the API
+        """
+        fixed_prices = to_fixed_prices(prices)
+        if not fixed_prices:
+            return
+        now = time.time()
+        with self._lock:
+            self._prices.update(fixed_prices)
+            for currency in fixed_prices:
+                self._price_times[currency] = now
+            self.version += 1
+
+    def get_prices(self, currencies):
+        """
+        Returns prices for currencies, only calling the API for currencies missing from or stale in the snapshot
+        :param currencies: the currencies to get the USD value for
+        :return: tuple of (dictionary of currency to fixed point USD price, snapshot version)
+        """
+        oldest_allowed = time.time() - PRICE_SNAPSHOT_MAX_AGE_SEC
+        with self._lock:
+            missing_currencies = [currency for currency in currencies
+                                  if self._price_times.get(currency, 0) < oldest_allowed]
+
+        if missing_currencies:
+            self.update(price_pool.call(get_currencies_current_usd_value, missing_currencies))
+
+        with self._lock:
+            prices = {}
+            for currency in currencies:
+                if currency in self._prices:
+                    prices[currency] = self._prices[currency]
+            return prices, self.version
+
+    def clear(self):
+        """
+        Drops every price so the next get_prices fetches them again
+        """
+        with self._lock:
+            self._prices = {}
+            self._price_times = {}
+            self.version += 1
+
+
+class PortfolioSummaryCache(object):
+    """
+    Per (game_id, owner) cache of portfolio holdings and rendered summaries.
+    Any trade by the owner bumps the generation so a load racing with a trade is never stored
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._holdings = {}
+        self._summaries = {}
+        self._generations = {}
+
+    def get_holdings(self, key):
+        """
+        :return: tuple of (cached holdings or None, generation to pass back to set_holdings)
+        """
+        with self._lock:
+            return self._holdings.get(key), self._generations.get(key, 0)
+
+    def set_holdings(self, key, generation, holdings):
+        with self._lock:
+            if self._generations.get(key, 0) == generation:
+                self._holdings[key] = holdings
+
+    def get_summary(self, key, price_key):
+        """
+        :param price_key: the prices of the currencies in the summary, from get_summary_price_key
+        :return: the rendered summary if it was rendered with the same prices otherwise None
+        """
+        with self._lock:
+            summary = self._summaries.get(key)
+        if summary is not None and summary[0] == price_key:
+            return summary[1]
+        return None
+
+    def set_summary(self, key, generation, price_key, summary):
+        with self._lock:
+            if self._generations.get(key, 0) == generation:
+                self._summaries[key] = (price_key, summary)
+
+    def invalidate(self, game_id, username):
+        key = (game_id, username)
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._holdings.pop(key, None)
+            self._summaries.pop(key, None)
+
+    def forget_game(self, game_id):
+        """
+        Drops every entry of a game that completed or was archived. Its portfolios no longer change so there is no
+        generation left to protect
+        """
+        with self._lock:
+            for cache in (self._generations, self._holdings, self._summaries):
+                for key in [key for key in cache if key[0] == game_id]:
+                    del cache[key]
+
+
+def get_summary_price_key(holdings, usd_value):
+    """
+    A summary only depends on the prices of its own currencies so a refresh of any other price keeps it cached
+    :param holdings: the holdings returned by get_portfolio_holdings
+    :param usd_value: dictionary of currency to fixed point USD price
+    :return: hashable key of the prices the summary is rendered with
+    """
+    return tuple(usd_value.get(currency) for currency in holdings["currencies"])
+
+
+class SubredditMetadataCache(object):
+    """
+    Caches subreddit metadata that rarely changes so each loop does a constant amount of Reddit work
+    no matter how many posts the subreddit has
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flair_choices = None
+        self._flair_choices_time = 0
+        self._newest_submission_utc = None
+        self._newest_submission_ids = set()
+
+    def get_in_progress_template_id(self, submission):
+        return self._get_flair_template_id(submission, lambda choice: choice['flair_text'] == 'In Progress')
+
+    def get_editable_template_id(self, submission):
+        return self._get_flair_template_id(submission, lambda choice: choice['flair_text_editable'])
+
+    def _get_flair_template_id(self, submission, predicate):
+        """
+        :param submission: any submission in the subreddit, used to load the flair choices
+        :param predicate: function that returns True for the wanted flair choice
+        :return: the flair_template_id of the first matching choice
+        """
+        with self._lock:
+            choices = self._flair_choices
+            if time.time() - self._flair_choices_time > FLAIR_TEMPLATE_TTL_SEC:
+                choices = None
+
+        template = None
+        if choices is not None:
+            template = next((choice for choice in choices if predicate(choice)), None)
+
+        # Reload on a miss too in case the template was added since the last load
+        if template is None:
+            choices = submission.flair.choices()
+            with self._lock:
+                self._flair_choices = choices
+                self._flair_choices_time = time.time()
+            template = next(choice for choice in choices if predicate(choice))
+
+        return template['flair_template_id']
+
+    def get_new_submissions(self, subreddit):
+        """
+        Walks the subreddit's new listing only until it reaches submissions already seen.
+        The first call after startup walks the whole listing
+        :param subreddit: the subreddit to get the submissions for
+        :return: submissions newer than the cursor, newest first
+        """
+        new_submissions = []
+        for submission in reddit.subreddit(subreddit).new(limit=None):
+            if self._newest_submission_utc is not None:
+                if submission.created_utc < self._newest_submission_utc:
+                    break
+                if submission.id in self._newest_submission_ids:
+                    continue
+            new_submissions.append(submission)
+
+        return new_submissions
+
+    def advance_submission_cursor(self, submissions):
+        """
+        Moves the cursor past submissions once they have been handled
+        :param submissions: the submissions returned by get_new_submissions
+        """
+        for submission in submissions:
+            if self._newest_submission_utc is None or submission.created_utc > self._newest_submission_utc:
+                self._newest_submission_utc = submission.created_utc
+                self._newest_submission_ids = set([submission.id])
+            elif submission.created_utc == self._newest_submission_utc:
+                self._newest_submission_ids.add(submission.id)
+
+
+class LogSampler(logging.Filter):
+    """
+    Rate limits each log call site and message so retry storms log a burst and then a sample. The next record a
+    window is allowed to log carries the number of records that were dropped before it. Records with a traceback
+    are never sampled and a different message from the same call site has its own window
+    """
+
+    def __init__(self):
+        super(LogSampler, self).__init__()
+        self._lock = Lock()
+        self._windows = {} # (pathname, lineno, masked message) to [window start, records in window, records dropped]
+
+    def filter(self, record):
+        if record.exc_info:
+            return True
+
+        call_site = (record.pathname, record.lineno, re.sub(r"\d+", "#", record.getMessage()))
+        with self._lock:
+            window = self._windows.get(call_site)
+            if window is None or record.created - window[0] >= LOG_SAMPLE_WINDOW_SEC:
+                if window is None and len(self._windows) >= LOG_SAMPLE_MAX_WINDOWS:
+                    self._windows = {key: value for key, value in self._windows.items()
+                                     if value[2] or record.created - value[0] < LOG_SAMPLE_WINDOW_SEC}
+                window = [record.created, 0, window[2] if window else 0]
+                self._windows[call_site] = window
+
+            window[1] += 1
+            if window[1] > LOG_SAMPLE_BURST and window[1] % LOG_SAMPLE_EVERY != 0:
+                window[2] += 1
+                return False
+
+            if window[2]:
+                record.suppressed = window[2]
+                window[2] = 0
+        return True
+
+
+class CorrelationFilter(logging.Filter):
+    """
+    Copies the logging thread's LogFields onto the record before it is queued
+    """
+
+    def filter(self, record):
+        record.fields = LogFields.current()
+        return True
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    Queues records for the listener thread. Only the message is rendered on the caller's thread,
+    tracebacks are formatted and written by the listener
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
 
-def add_to_processed(submission_id, comment_id, body):
+class JsonLogFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line
+    """
+
+    def format(self, record):
+        log_entry = {"time": datetime.utcfromtimestamp(record.created).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                     "level": record.levelname,
+                     "thread": record.threadName,
+                     "message": record.getMessage()}
+        log_entry.update(getattr(record, "fields", {}))
+        if getattr(record, "suppressed", 0):
+            log_entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            log_entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(log_entry, default=str)
+
+
+class RedditPmAlertSink(object):
+    """
+    Sends dev alerts as a Reddit PM to DEV_USER_NAME
+    """
+
+    def send(self, subject, body):
+        # Reddit rejects PM subjects over 100 characters
+        reddit.redditor(DEV_USER_NAME).message(subject[:100], body)
+
+
+class FileAlertSink(object):
+    """
+    Appends dev alerts to DEV_ALERT_FILE
+    """
+
+    def send(self, subject, body):
+        with open(DEV_ALERT_FILE, "a") as alert_file:
+            alert_file.write("{alert_time} UTC {subject}\n\n{body}\n\n".format(
+                alert_time=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+                subject=subject,
+                body=body))
+
+
+class SmtpAlertSink(object):
+    """
+    Emails dev alerts to DEV_ALERT_EMAIL through the SMTP server at DEV_ALERT_SMTP_HOST, usually a local relay
+    """
+
+    def send(self, subject, body):
+        email_message = EmailMessage()
+        email_message["Subject"] = subject
+        email_message["From"] = DEV_ALERT_EMAIL
+        email_message["To"] = DEV_ALERT_EMAIL
+        email_message.set_content(body)
+
+        with smtplib.SMTP(DEV_ALERT_SMTP_HOST, DEV_ALERT_SMTP_PORT, timeout=30) as smtp:
+            smtp.send_message(email_message)
+
+
+class DevAlerter(object):
+    """
+    Collects dev alerts for DEV_ALERT_WINDOW_SEC and sends them as one digest on the alert pool so callers never
+    wait on the sink. Alerts that only differ in numbers such as retry counts, timestamps and IDs share a
+    fingerprint and are reported together, with each distinct text listed once with its count
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._lock = Lock()
+        self._pending_alerts = {} # fingerprint to the first alert with that fingerprint, its count and distinct texts
+        self._flush_scheduled = False
+
+    def alert(self, subject, body):
+        """
+        :param subject: what went wrong
+        :param body: the details
+        """
+        fingerprint = re.sub(r"\d+", "#", subject + "\n" + body)
+        alert_time = time.time()
+        with self._lock:
+            pending_alert = self._pending_alerts.get(fingerprint)
+            if pending_alert is None:
+                self._pending_alerts[fingerprint] = {"subject": subject, "body": body, "count": 1,
+                                                     "first_time": alert_time, "last_time": alert_time,
+                                                     "distinct": [[subject, body, 1]], "other_count": 0}
+            else:
+                pending_alert["count"] += 1
+                pending_alert["last_time"] = alert_time
+                for distinct_alert in pending_alert["distinct"]:
+                    if distinct_alert[0] == subject and distinct_alert[1] == body:
+                        distinct_alert[2] += 1
+                        break
+                else:
+                    if len(pending_alert["distinct"]) < DEV_ALERT_MAX_DISTINCT:
+                        pending_alert["distinct"].append([subject, body, 1])
+                    else:
+                        pending_alert["other_count"] += 1
+
+            schedule_flush = not self._flush_scheduled
+            self._flush_scheduled = True
+
+        metrics.increment("dev_alerts")
+        if schedule_flush:
+            try:
+                alert_pool.submit(self._flush_after_window)
+            except RuntimeError:
+                # The alert pool was already shut down so send on this thread
+                self._flush_after_window()
+
+    def _flush_after_window(self):
+        # Shutdown wakes this early so alerts raised just before exiting are still sent
+        shutdown_requested.wait(DEV_ALERT_WINDOW_SEC)
+
+        with self._lock:
+            pending_alerts = list(self._pending_alerts.values())
+            self._pending_alerts = {}
+            self._flush_scheduled = False
+
+        if not pending_alerts:
+            return
+
+        subject, body = self._render_digest(pending_alerts)
+        try:
+            self.sink.send(subject, body)
+            metrics.increment("dev_alert_digests_sent")
+        except Exception as err:
+            logger.exception("Could not send dev alert digest: {subject}".format(subject=subject))
+
+    def _render_digest(self, pending_alerts):
+        """
+        :param pending_alerts: the alerts raised in the window, in the order they were first raised
+        :return: tuple of (subject, body)
+        """
+        if len(pending_alerts) == 1 and pending_alerts[0]["count"] == 1:
+            return pending_alerts[0]["subject"], pending_alerts[0]["body"][:DEV_ALERT_MAX_BODY_CHARS]
+
+        subject = "Crypto Trading Game: {count} alerts".format(
+            count=sum(pending_alert["count"] for pending_alert in pending_alerts))
+        body = ""
+        for pending_alert in pending_alerts:
+            body += "**{subject}** x{count}, first at {first_time} UTC, last at {last_time} UTC\n\n".format(
+                subject=pending_alert["subject"],
+                count=pending_alert["count"],
+                first_time=datetime.utcfromtimestamp(pending_alert["first_time"]).strftime("%H:%M:%S"),
+                last_time=datetime.utcfromtimestamp(pending_alert["last_time"]).strftime("%H:%M:%S"))
+
+            if len(pending_alert["distinct"]) == 1:
+                body += "{body}\n\n".format(body=pending_alert["body"])
+            else:
+                for distinct_subject, distinct_body, distinct_count in pending_alert["distinct"]:
+                    body += "* x{count} {subject}: {body}\n".format(count=distinct_count,
+                                                                   subject=distinct_subject,
+                                                                   body=distinct_body)
+                if pending_alert["other_count"]:
+                    body += "* x{count} more\n".format(count=pending_alert["other_count"])
+                body += "\n"
+            body += "---\n\n"
+
+        return subject, body[:DEV_ALERT_MAX_BODY_CHARS]
+
+
+metrics = Metrics()
+class WorkerPool(object):
+    """
+    A bounded ThreadPoolExecutor that publishes its queue depth and saturation to metrics
+    and cancels queued work on shutdown
+    """
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = Lock()
+        self._queued = 0
+        self._active = 0
+        self._futures = set()
+
+    def submit(self, fn, *args):
+        """
+        :return: a Future for fn(*args)
+        """
+        with self._lock:
+            if self._active + self._queued >= self.max_workers:
+                metrics.increment("{name}_pool_saturated_submits".format(name=self.name))
+            self._queued += 1
+            self._publish_metrics()
+        future = self._executor.submit(self._run, fn, args, LogFields.current())
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def call(self, fn, *args):
+        """
+        Runs fn(*args) on the pool and waits for it, so the workload stays bounded by this pool whichever thread
+        needs it. Calls from the pool's own threads run inline so a task never waits on its own pool
+        :return: the result of fn. Exceptions are raised
+        """
+        if current_thread().name.startswith(self.name + "_"):
+            return fn(*args)
+        return self.submit(fn, *args).result()
+
+    def run_all(self, fn, args_list):
+        """
+        Runs fn once per args in args_list and waits for all of them. Exceptions are logged not raised
+        :param fn: the function to run
+        :param args_list: list of argument lists
+        :return: list of results in args_list order. None for calls that failed or were canceled
+        """
+        futures = [self.submit(fn, *args) for args in args_list]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as err:
+                logger.exception("Unknown Exception in {name} pool task".format(name=self.name))
+                results.append(None)
+        return results
+
+    def shutdown(self):
+        """
+        Cancels work that has not started and waits for running work to finish
+        """
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def _run(self, fn, args, log_fields):
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+            self._publish_metrics()
+        try:
+            with LogFields(**log_fields):
+                return fn(*args)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._publish_metrics()
+
+    def _on_done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+            if future.cancelled():
+                self._queued -= 1
+                self._publish_metrics()
+
+    def _publish_metrics(self):
+        metrics.set_gauge("{name}_pool_queue_depth".format(name=self.name), self._queued)
+        metrics.set_gauge("{name}_pool_active".format(name=self.name), self._active)
+        metrics.set_gauge("{name}_pool_saturation".format(name=self.name), float(self._active) / self.max_workers)
+
+
+class SymbolIndex(object):
+    """
+    The set of tradable symbols with a by-length index for "did you mean" suggestions.
+    Lookups never call the API. The tick loop calls refresh_if_stale, which reloads the coin list on the price
+    pool while the old set keeps answering. Until a real coin list or snapshot is loaded the index is empty and
+    every symbol is allowed
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._symbols = frozenset()
+        self._symbols_by_length = {}
+        self._load_time = 0
+        self._loading = False
+
+    def is_supported(self, symbol):
+        """
+        :param symbol: an upper case ticker
+        :return: True if symbol can be traded. Everything is allowed if no symbol list could be loaded
+        """
+        with self._lock:
+            symbols = self._symbols
+        return not symbols or symbol in symbols
+
+    def suggest(self, symbol):
+        """
+        :param symbol: an unsupported upper case ticker
+        :return: the closest supported symbol or None
+        """
+        with self._lock:
+            candidates = []
+            # Only symbols within one character of the typo's length can be close matches
+            for length in (len(symbol) - 1, len(symbol), len(symbol) + 1):
+                candidates.extend(self._symbols_by_length.get(length, ()))
+
+        # Prefer the common currencies since a typo is far more likely to be of one of them
+        suggestions = (difflib.get_close_matches(symbol, [candidate for candidate in candidates if candidate in common_currencies], n=1, cutoff=0.6) or
+                       difflib.get_close_matches(symbol, candidates, n=1, cutoff=0.75))
+        return suggestions[0] if suggestions else None
+
+    def replace(self, symbols):
+        """
+        Swaps in symbols without calling the API. Used by replays to validate against the recorded coin list
+        """
+        with self._lock:
+            self._set_symbols(symbols)
+            self._load_time = time.time()
+
+    def refresh_if_stale(self):
+        """
+        Starts a coin list reload on the price pool once the TTL passed. Called by the tick loop so no command
+        ever waits on the API
+        """
+        with self._lock:
+            reload_needed = not self._loading and time.time() - self._load_time > COIN_LIST_TTL_SEC
+            if reload_needed:
+                self._loading = True
+            load_snapshot = reload_needed and not self._symbols
+        if not reload_needed:
+            return
+
+        if load_snapshot:
+            # The snapshot of the last successful load validates commands while the API call is in flight
+            snapshot_symbols = load_coin_list_snapshot()
+            with self._lock:
+                if not self._symbols:
+                    self._set_symbols(snapshot_symbols)
+        price_pool.submit(self._reload)
+
+    def _reload(self):
+        symbols = None
+        try:
+            symbols = load_coin_list()
+            if symbols:
+                input_recorder.record("symbols", symbols=symbols)
+        finally:
+            with self._lock:
+                if symbols:
+                    self._set_symbols(symbols)
+                    self._load_time = time.time()
+                else:
+                    # Keeps the set it has. Retry sooner than the TTL but not on every tick while the API is down
+                    self._load_time = time.time() - COIN_LIST_TTL_SEC + COIN_LIST_RETRY_SEC
+                self._loading = False
+
+    def _set_symbols(self, symbols):
+        # Fiat and the common currencies are only added to a real coin list, never used as a list on their own
+        if not symbols:
+            return
+        symbols = set(symbols)
+        symbols.update(FIAT_SYMBOLS)
+        symbols.update(common_currencies)
+        self._symbols = frozenset(symbols)
+        self._symbols_by_length = {}
+        for symbol in self._symbols:
+            self._symbols_by_length.setdefault(len(symbol), []).append(symbol)
+
+
+class CommentHarvester(object):
+    """
+    Finds a game's unprocessed top level comments, including the ones reddit hides behind MoreComments in big
+    threads. Comments are fetched newest first so new commands are on the first page, and only MoreComments
+    children that were never seen or processed are expanded, COMMENT_HARVEST_BATCH_SIZE per request. Fetched
+    comments are kept until they are processed so comments pushed behind MoreComments are never fetched twice
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._seen_comment_ids = {} # submission_id to ids of top level comments and MoreComments children already fetched
+        self._unprocessed_comments = {} # submission_id to comment_id to fetched comments that were not processed yet
+
+    def harvest(self, submission_id, processed_comment_ids, request_budget):
+        """
+        :param submission_id: the game to harvest
+        :param processed_comment_ids: set of ids of the game's processed comments
+        :param request_budget: the most MoreComments requests to make
+        :return: tuple of (unprocessed top level comments oldest first, requests made, hidden comments left to expand)
+        """
+        submission = reddit.submission(id = submission_id)
+        submission.comment_sort = 'new'
+        submission_fullname = "t3_" + submission_id
+
+        with self._lock:
+            seen_comment_ids = self._seen_comment_ids.setdefault(submission_id, set())
+            unprocessed_comments = self._unprocessed_comments.setdefault(submission_id, {})
+
+        unseen_children = []
+        for top_level_comment in submission.comments:
+            if isinstance(top_level_comment, MoreComments):
+                unseen_children.extend(child_id for child_id in top_level_comment.children
+                                       if child_id not in seen_comment_ids and child_id not in processed_comment_ids)
+            else:
+                unprocessed_comments[top_level_comment.id] = top_level_comment
+                seen_comment_ids.add(top_level_comment.id)
+
+        request_count = 0
+        while unseen_children and request_count < request_budget:
+            batch = unseen_children[:COMMENT_HARVEST_BATCH_SIZE]
+            del unseen_children[:COMMENT_HARVEST_BATCH_SIZE]
+            # depth 1 leaves out the replies, which are not commands
+            things = reddit.post("api/morechildren/", data={"api_type": "json",
+                                                            "children": ",".join(batch),
+                                                            "link_id": submission_fullname,
+                                                            "sort": "new",
+                                                            "depth": 1,
+                                                            "limit_children": False})
+            request_count += 1
+            # Deleted children return nothing and are never asked for again
+            seen_comment_ids.update(batch)
+
+            for thing in things:
+                if thing.parent_id != submission_fullname:
+                    continue
+                if isinstance(thing, MoreComments):
+                    unseen_children.extend(child_id for child_id in thing.children
+                                           if child_id not in seen_comment_ids and child_id not in processed_comment_ids)
+                else:
+                    unprocessed_comments[thing.id] = thing
+
+        for comment_id in [comment_id for comment_id in unprocessed_comments if comment_id in processed_comment_ids]:
+            del unprocessed_comments[comment_id]
+
+        return (sorted(unprocessed_comments.values(), key=operator.attrgetter("created_utc")),
+                request_count, len(unseen_children))
+
+    def forget(self, submission_id):
+        with self._lock:
+            self._seen_comment_ids.pop(submission_id, None)
+            self._unprocessed_comments.pop(submission_id, None)
+
+
+class HistoricalPriceBars(object):
+    """
+    Minute closes of the currency pairs delayed commands trade, fetched ahead of processing so get_trading_price
+    can fill them locally instead of making one histominute request per command
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._closes = {} # (from_symbol, to_symbol) to dictionary of minute start time to close
+
+    def get_close(self, from_symbol, to_symbol, price_time):
+        """
+        :return: the close of the minute containing price_time or None if it was not fetched
+        """
+        with self._lock:
+            return self._closes.get((from_symbol, to_symbol), {}).get(get_minute_start(price_time))
+
+    def has_minute(self, pair, minute_time):
+        with self._lock:
+            return minute_time in self._closes.get(pair, {})
+
+    def add_bars(self, pair, closes):
+        """
+        :param pair: (from_symbol, to_symbol)
+        :param closes: dictionary of minute start time to close
+        """
+        with self._lock:
+            self._closes.setdefault(pair, {}).update(closes)
+
+    def retain(self, pairs):
+        """
+        Drops the bars of pairs no pending command needs anymore
+        :param pairs: the pairs to keep
+        """
+        pairs = set(pairs)
+        with self._lock:
+            for pair in list(self._closes):
+                if pair not in pairs:
+                    del self._closes[pair]
+
+
+class InputRecorder(object):
+    """
+    Appends everything that decides a game's outcome to a JSON lines file: new games, coin list loads, processed
+    game comments, price quotes and triggered limit orders. Replies are recorded too so a replay can check it
+    reproduced them. Records nothing when no file is configured
+    """
+
+    def __init__(self, record_file):
+        self.record_file = record_file
+        self._lock = Lock()
+        self._file = None
+
+    def record(self, event_type, **fields):
+        """
+        :param event_type: game, symbols, comment, quote, limit_trigger or reply
+        :param fields: the JSON serializable fields of the event
+        """
+        if not self.record_file:
+            return
+
+        fields["type"] = event_type
+        fields["time"] = time.time()
+        event_line = json.dumps(fields, sort_keys=True) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.record_file, "a")
+            # Flushed per event so a crash loses at most the event being written
+            self._file.write(event_line)
+            self._file.flush()
+
+    def record_comment(self, comment):
+        """
+        Records a game comment once it was processed, so the recording is in the order commands were committed.
+        PMs are not recorded
+        :param comment: the reddit comment
+        """
+        if not self.record_file or comment.parent_id is None:
+            return
+
+        self.record("comment",
+                    comment_id=comment.id,
+                    submission_id=comment.parent().id,
+                    author=comment.author.name if comment.author is not None else None,
+                    body=comment.body,
+                    created_utc=comment.created_utc)
+
+    def record_quote(self, from_symbol, to_symbol, price_time, price):
+        """
+        :param price_time: the time the price was asked for
+        :param price: the price returned. Errors are not recorded
+        """
+        if price is not None and price > 0:
+            self.record("quote", from_symbol=from_symbol, to_symbol=to_symbol, price_time=price_time, price=price)
+
+    def stop(self):
+        """
+        Stops recording, e.g. while a recording is replayed
+        """
+        with self._lock:
+            self.record_file = ""
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class QueuedComment(object):
+    """
+    A comment rebuilt from its command_queue row with the parts of praw's Comment the command code uses,
+    so a queued command is processed without fetching the comment from Reddit again
+    """
+
+    def __init__(self, queued_command):
+        self.id = queued_command["comment_id"]
+        self.body = queued_command["body"]
+        self.created_utc = queued_command["created_utc"]
+        self.parent_id = "t3_" + queued_command["submission_id"]
+        self.author = None
+        if queued_command["owner"] != DELETED_COMMENT_OWNER:
+            self.author = SimpleNamespace(name=queued_command["owner"])
+        self._submission = SimpleNamespace(id=queued_command["submission_id"])
+
+    def parent(self):
+        return self._submission
+
+    def reply(self, reply_text):
+        # praw's comment is lazy so replying does not fetch it
+        return reddit.comment(self.id).reply(reply_text)
+
+    def __str__(self):
+        return self.id
+
+
+price_snapshot = PriceSnapshot()
+subreddit_metadata = SubredditMetadataCache()
+portfolio_summary_cache = PortfolioSummaryCache()
+limit_order_index = LimitOrderProximityIndex()
+historical_price_bars = HistoricalPriceBars()
+symbol_index = SymbolIndex()
+comment_harvester = CommentHarvester()
+player_onboarding = PlayerOnboarding()
+price_pool = WorkerPool("price", PRICE_POOL_WORKERS)
+db_pool = WorkerPool("db", COMMAND_QUEUE_WORKERS)
+reddit_pool = WorkerPool("reddit", REDDIT_POOL_WORKERS)
+alert_pool = WorkerPool("alert", 1)
+input_recorder = InputRecorder(RECORD_FILE)
+replay_session = None # the ReplaySession prices and comments come from while a recording is replayed
+dev_alerter = DevAlerter({"reddit": RedditPmAlertSink,
+                          "file": FileAlertSink,
+                          "smtp": SmtpAlertSink}[DEV_ALERT_SINK]())
+shutdown_requested = Event()
+reload_requested = Event()
+shutdown_signal_number = None # the signal that set shutdown_requested, logged by the main loop
+game_id_cache = {}
+latest_leader_boards = {} # game_id to the LeaderBoard last saved to standings
+standings_history_last_points = {} # (game_id, owner, resolution) to the last (bucket, value_cents, rank) written
+standings_history_last_prune_time = 0
+inbox_attempts = {} # message id to number of failed attempts for PMs left unread
+submission_id_cache = {}
+
+def to_fixed_prices(prices):
+    """
+    Converts a dictionary of API prices to fixed point once so valuations dont convert per row
+    :param prices: dictionary of currency to float price
+    :return: dictionary of currency to fixed point price
+    """
+    fixed_prices = {}
+    for currency in prices:
+        fixed_prices[currency] = to_fixed(prices[currency])
+    return fixed_prices
+
+def add_to_processed(submission_id, comment_id, body, request_context = None):
     """
     Adds the comment_id to the list of submitted comments
     :param submission_id: the id of the game
     :param comment_id: the id of the comment
     :param body: the body of the comment
+    :param request_context: the command's RequestContext. None to commit on its own
     :return:
     """
-    db_connection = DbConnection()
-    query = "SELECT game_id FROM game_submission WHERE game_submission.submission_id = %s"
-    db_connection.cursor.execute(query, [submission_id])
-    game_id = db_connection.cursor.fetchall()[0]["game_id"]
+    own_context = request_context is None
+    if own_context:
+        request_context = RequestContext()
 
-    query = "INSERT INTO processed_comment (game_id, comment_id, comment_body) VALUES (%s, %s, %s)"
-    db_connection.cursor.execute(query, [game_id, comment_id, body])
+    try:
+        # IGNORE because a command can be retried after it was processed but before the queue was updated
+        query = "INSERT IGNORE INTO processed_comment (game_id, comment_id, comment_body) VALUES (%s, %s, %s)"
+        request_context.db_connection.cursor.execute(query, [get_game_id(submission_id), comment_id, body])
 
-    db_connection.connection.commit()
-    db_connection.connection.close()
+        if own_context:
+            request_context.commit()
+    finally:
+        if own_context:
+            request_context.close()
 
 def send_dev_pm(subject, body):
     """
-    Sends Reddit PM to DEV_USER_NAME
+    Raises a dev alert. Alerts are deduplicated and sent as a digest through the configured sink in the background
     :param subject: subject of PM
     :param body: body of PM
     """
-    reddit.redditor(DEV_USER_NAME).message(subject, body)
+    dev_alerter.alert(subject, body)
 
-def create_new_custom_game(message):
+def create_new_custom_game(message, request_context):
     """
     :param message: the message containing the new_game command
+    :param request_context: the RequestContext the reply is queued on
     :return: True if success False if not
     """
     game_length_modes = ["DAY","DAYS","MONTH","MONTHS"]
@@ -220,8 +1500,8 @@ def create_new_custom_game(message):
 
         return True
     else:
-        message.reply("Could not parse new game command. The correct syntax is:\n\n"
-                      "!NewGame {game_length_integer} {day | days | month | months}")
+        request_context.reply(message, "Could not parse new game command. The correct syntax is:\n\n"
+                                       "!NewGame {game_length_integer} {day | days | month | months}")
         return False
 
 def create_new_game(begin_datetime, end_datetime, title_description = ""):
@@ -243,9 +1523,7 @@ def create_new_game(begin_datetime, end_datetime, title_description = ""):
             supported_commands=SUPPORTED_COMMANDS
         ))
 
-    choices = submission.flair.choices()
-    template_id = next(x for x in choices
-                       if x['flair_text'] == 'In Progress')['flair_template_id']
+    template_id = subreddit_metadata.get_in_progress_template_id(submission)
     submission.flair.select(template_id)
 
 
@@ -262,75 +1540,73 @@ def create_new_game(begin_datetime, end_datetime, title_description = ""):
     db_connection.connection.commit()
     db_connection.connection.close()
 
-def process_market_order_command(message):
+    input_recorder.record("game",
+                          subreddit=submission.subreddit.display_name,
+                          submission_id=submission.id,
+                          author=submission.author.name,
+                          game_begin_datetime=str(begin_datetime),
+                          game_end_datetime=str(end_datetime))
+
+def get_command_type(message_body):
+    """
+    :param message_body: the body of a comment or PM
+    :return: the CommandType of the command in message_body
+    """
+    message_lower = message_body.lower()
+    if "!newgame" in message_lower:
+        return CommandType.NEW_GAME
+    elif "!market" in message_lower:
+        return CommandType.MARKET_ORDER
+    elif "!limit" in message_lower:
+        return CommandType.LIMIT_ORDER
+    elif "!cancellimit" in message_lower:
+        return CommandType.CANCEL_LIMIT_ORDER
+    elif "!portfolio" in message_lower:
+        return CommandType.PORTFOLIO
+    elif "!standings" in message_lower:
+        return CommandType.STANDINGS
+    elif "!stats" in message_lower:
+        return CommandType.STATS
+    else:
+        return CommandType.UNKNOWN
+
+def process_market_order_command(message, request_context):
     """
     :param message: the message containing the market order command
+    :param request_context: the RequestContext the command runs in
     :return: True if success False if not
     """
-    command_regex = r'!market[ ]+\$?(?P<quantity>(([\d]+)?(\.\d+)?%?))[ ]+(?P<buy_currency>[0-9a-zA-Z]+)[ ]+(?P<sell_currency>[0-9a-zA-Z]+)'
-    match = re.search(command_regex, message.body, re.IGNORECASE)
-
-    if (match and match.group("quantity") and match.group("buy_currency") and match.group("sell_currency")):
-        args_invalid = False
-        quantity_is_percent = False
-        quantity_str = match.group("quantity")
-        buy_currency = match.group("buy_currency").upper()
-        sell_currency = match.group("sell_currency").upper()
-
-        if "%" in quantity_str:
-            quantity_str = quantity_str.replace("%","")
-            quantity_is_percent = True
-
-        quantity_float = float(quantity_str)
-
-        if (quantity_float <= 0 or (quantity_float > 100 and quantity_is_percent)):
-            args_invalid = True
-
-        trading_price = get_trading_price(buy_currency, sell_currency, message.created_utc)
-
-        portfolio_sell_currency = get_portfolio(message.parent().id, message.author.name, sell_currency)
-
-        available_funds = 0
-        trade_cost = 0
-        quantity_bought = 0
-
-        if portfolio_sell_currency:
-            available_funds = float(portfolio_sell_currency[0]["amount"])
-
-        if quantity_is_percent:
-            trade_cost = (quantity_float / 100) * available_funds
-            quantity_bought = trade_cost / trading_price
-        else:
-            trade_cost = quantity_float * trading_price
-            quantity_bought = quantity_float
-
-        if args_invalid:
-            message.reply("Error processesing your request: Quantities must be greater than 0 and percentages cannot exceed 100%")
-        elif trading_price <= 0:
-            message.reply("Error processesing your request: The provided currency pair may be unsupported or the CryptoCompare API could be down. "
-                          "If it is not listed [here](https://www.cryptocompare.com/api/data/coinlist/) then it is not supported. "
-                          "If it is listed please try again later.\n\n"
-                          "Please see the [README](https://github.com/jjmerri/cryptoTradingGame-Reddit) for more info.")
-        elif available_funds < trade_cost or available_funds == 0:
-            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name)
-            message.reply("Error processesing your request: You have insufficient funds to make that trade. "
+    order = parse_market_order(message.body)
+
+    if order:
+        unsupported_symbols_reply = get_unsupported_symbols_reply([order["buy_currency"], order["sell_currency"]])
+        if unsupported_symbols_reply:
+            request_context.reply(message, unsupported_symbols_reply)
+            return True
+
+        order_result, trading_price = get_game_engine(request_context).market_order(
+            get_game_id(message.parent().id), message.id, message.author.name, order, message.created_utc)
+
+        if order_result == OrderResult.INVALID_ARGS:
+            request_context.reply(message, "Error processesing your request: Quantities must be greater than 0 and percentages cannot exceed 100%")
+        elif order_result == OrderResult.NO_PRICE:
+            request_context.reply(message, get_price_unavailable_reply())
+        elif order_result == OrderResult.INSUFFICIENT_FUNDS:
+            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name, request_context)
+            request_context.reply(message, "Error processesing your request: You have insufficient funds to make that trade. "
                           "Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
                             portfolio_summary = portfolio_summary
                             ))
         else:
-            trade_executed = execute_trade(message.id, message.author.name, quantity_bought, buy_currency, trade_cost, sell_currency, False, submission_id = message.parent().id)
-            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name)
-
-            if trade_executed:
-                message.reply("Trade Executed! Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
+            # A retried command that was already applied gets the same reply
+            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name, request_context)
+            request_context.reply(message, "Trade Executed! Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
                             portfolio_summary = portfolio_summary
                             ))
-            else:
-                logger.error("Error executing market order for comment_id: {message_id}".format(message_id = message.id))
 
         return True
     else:
-        message.reply("Could not parse market order command. The correct syntax is:\n\n"
+        request_context.reply(message, "Could not parse market order command. The correct syntax is:\n\n"
                       "!Market {quantity_to_buy | percentage_of_sell_currency} {symbol_to_buy} {symbol_to_sell}\n\n"
                       "Examples:\n\n"
                       "To buy 1000 XRP with USD:\n\n"
@@ -340,53 +1616,32 @@ def process_market_order_command(message):
         return True
 
 
-def process_limit_order_command(message):
+def process_limit_order_command(message, request_context):
     """
     :param message: the message containing the limit order command
+    :param request_context: the RequestContext the command runs in
     :return: True if success False if not
     """
-    command_regex = r'!limit[ ]+\$?(?P<quantity>(([\d]+)?(\.\d+)?%?))[ ]+(?P<buy_currency>[0-9a-zA-Z]+)[ ]+(?P<sell_currency>[0-9a-zA-Z]+)[ ]+(?P<limit_price>(([\d]+)?(\.\d+)?))'
-    match = re.search(command_regex, message.body, re.IGNORECASE)
-
-    if (match and match.group("quantity") and match.group("buy_currency") and match.group("sell_currency") and match.group("limit_price")):
-        args_invalid = False
-        quantity_is_percent = False
-        quantity_str = match.group("quantity")
-        buy_currency = match.group("buy_currency").upper()
-        sell_currency = match.group("sell_currency").upper()
-        limit_price = float(match.group("limit_price"))
-
-        if "%" in quantity_str:
-            quantity_str = quantity_str.replace("%","")
-            quantity_is_percent = True
-
-        quantity_float = float(quantity_str)
-
-        if (quantity_float <= 0 or (quantity_float > 100 and quantity_is_percent)):
-            args_invalid = True
-
-        portfolio_sell_currency = get_portfolio(message.parent().id, message.author.name, sell_currency)
-
-        available_funds = 0
-        trade_cost = 0
-        quantity_bought = 0
-
-        current_price = get_trading_price(buy_currency, sell_currency, message.created_utc)
-
-        if portfolio_sell_currency:
-            available_funds = float(portfolio_sell_currency[0]["amount"])
-
-        if quantity_is_percent:
-            trade_cost = (quantity_float / 100) * available_funds
-            quantity_bought = trade_cost / limit_price
-        else:
-            trade_cost = quantity_float * limit_price
-            quantity_bought = quantity_float
-
-        if args_invalid:
-            message.reply("Error processesing your request: Quantities must be greater than 0 and percentages cannot exceed 100%")
-        elif current_price < limit_price:
-            message.reply(
+    order = parse_limit_order(message.body)
+
+    if order:
+        buy_currency = order["buy_currency"]
+        sell_currency = order["sell_currency"]
+
+        unsupported_symbols_reply = get_unsupported_symbols_reply([buy_currency, sell_currency])
+        if unsupported_symbols_reply:
+            request_context.reply(message, unsupported_symbols_reply)
+            return True
+
+        order_result, current_price, limit_order_id = get_game_engine(request_context).limit_order(
+            get_game_id(message.parent().id), message.id, message.author.name, order, message.created_utc)
+
+        if order_result == OrderResult.INVALID_ARGS:
+            request_context.reply(message, "Error processesing your request: Quantities must be greater than 0 and percentages cannot exceed 100%")
+        elif order_result == OrderResult.NO_PRICE:
+            request_context.reply(message, get_price_unavailable_reply())
+        elif order_result == OrderResult.LIMIT_ABOVE_MARKET:
+            request_context.reply(message,
                 "**Error:** Limit order not created! "
                 "The price you specified for the limit order is higher than the current price of {current_price}. "
                 "It would have been cheaper to make a market order.\n\n"
@@ -395,29 +1650,30 @@ def process_limit_order_command(message):
                 "when 1 {sell_currency} became worth {limit_price} {buy_currency} you can use the following command:\n\n"
                 "**!limit {quantity_str} {buy_currency} {sell_currency} {inverted_ratio}**\n\n"
                 "If you want to make a purchase at the market price use the !Market command.".format(
-                    current_price = str(current_price),
+                    # The API price round trips through fixed point so it reads as the API sent it
+                    current_price = str(float(from_fixed(current_price))),
                     buy_currency = buy_currency,
                     sell_currency = sell_currency,
-                    limit_price = str(limit_price),
-                    quantity_str = quantity_str + ("%" if quantity_is_percent else ""),
-                    inverted_ratio = '{:,.6g}'.format(1/limit_price)
+                    limit_price = order["limit_price_text"],
+                    quantity_str = order["quantity_text"],
+                    inverted_ratio = format_fixed_6g(fixed_div(to_fixed(1), order["limit_price"]))
                 ))
-        elif available_funds < trade_cost or available_funds == 0:
-            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name)
-            message.reply("Error processesing your request: You have insufficient funds to create that limit order! "
+        elif order_result == OrderResult.INSUFFICIENT_FUNDS:
+            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name, request_context)
+            request_context.reply(message, "Error processesing your request: You have insufficient funds to create that limit order! "
                           "Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
                             portfolio_summary = portfolio_summary
                             ))
         else:
-            create_limit_order(message.parent().id, message.id, message.author.name, quantity_bought, buy_currency, available_funds, trade_cost, sell_currency, limit_price)
-            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name)
-            message.reply("Limit order created! Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
+            # A retried command that already created its order gets the same reply
+            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name, request_context)
+            request_context.reply(message, "Limit order created! Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
                             portfolio_summary = portfolio_summary
                             ))
 
         return True
     else:
-        message.reply("Could not parse limit order command. The correct syntax is:\n\n"
+        request_context.reply(message, "Could not parse limit order command. The correct syntax is:\n\n"
                       "!Limit {quantity_to_buy | percentage_of_sell_currency} {symbol_to_buy} {symbol_to_sell} {limit_price}\n\n"
                       "Examples:\n\n"
                       "To buy 1000 XRP with USD when the price of 1 XRP reaches .9 USD:\n\n"
@@ -426,29 +1682,29 @@ def process_limit_order_command(message):
                       "!Limit 50% XRP USD .9")
         return True
 
-def process_cancel_limit_order_command(message):
+def process_cancel_limit_order_command(message, request_context):
     """
     :param message: the message containing the cancel limit order command
+    :param request_context: the RequestContext the command runs in
     :return: True if success False if not
     """
     command_regex = r'!cancellimit[ ]+(?P<limit_order_id>[\d]+)'
     match = re.search(command_regex, message.body, re.IGNORECASE)
 
     if (match and match.group("limit_order_id")):
-        args_invalid = False
         limit_order_id = int(match.group("limit_order_id"))
 
-        limit_order_cancelled = cancel_limit_order(limit_order_id, message.author.name)
+        order_result = get_game_engine(request_context).cancel_limit_order(limit_order_id, message.author.name)
 
-        if limit_order_cancelled:
-            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name)
-            message.reply(
+        if order_result == OrderResult.CANCELED:
+            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name, request_context)
+            request_context.reply(message,
                 "Limit order canceled! Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
                     portfolio_summary=portfolio_summary
                 ))
         else:
-            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name)
-            message.reply("Could not cancel the limit order specified. "
+            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name, request_context)
+            request_context.reply(message, "Could not cancel the limit order specified. "
                           "If you are sure you are the owner of that limit order and it hasnt already been executed or canceled please try again later. "
                           "Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
                             portfolio_summary=portfolio_summary
@@ -457,19 +1713,114 @@ def process_cancel_limit_order_command(message):
 
 
     else:
-        message.reply("Could not parse cancel limit order command. The correct syntax is:\n\n"
+        request_context.reply(message, "Could not parse cancel limit order command. The correct syntax is:\n\n"
                       "!CancelLimit {limit_order_id}\n\n"
                       "Example:\n\n"
                       "To cancel the limit order with ID 77:\n\n"
                       "!CancelLimit 77")
         return True
 
+def load_coin_list():
+    """
+    Loads the CryptoCompare coin list and saves it to COIN_LIST_SNAPSHOT_FILE
+    :return: list of upper case symbols or None if the API call failed
+    """
+    try:
+        r = requests.get("https://min-api.cryptocompare.com/data/all/coinlist", timeout=30)
+        response = r.json()
+        if response.get("Response", "Error") != "Success" or not response.get("Data"):
+            logger.error("Could not load the coin list: {message}".format(message=response.get("Message")))
+            return None
+
+        symbols = sorted(symbol.upper() for symbol in response["Data"])
+        with open(COIN_LIST_SNAPSHOT_FILE, "w") as snapshot_file:
+            snapshot_file.write("\n".join(symbols))
+        logger.info("loaded {count} symbols from the coin list".format(count=len(symbols)))
+        return symbols
+    except Exception as err:
+        logger.exception("Unknown Exception loading the coin list")
+        return None
+
+def load_coin_list_snapshot():
+    """
+    :return: the symbols saved by the last successful load_coin_list or None if there is no snapshot
+    """
+    if not os.path.isfile(COIN_LIST_SNAPSHOT_FILE):
+        return None
+
+    with open(COIN_LIST_SNAPSHOT_FILE) as snapshot_file:
+        return [line.strip() for line in snapshot_file if line.strip()]
+
+def get_unsupported_symbols_reply(symbols):
+    """
+    Validates the symbols of a command before any price request is made
+    :param symbols: the upper case symbols used by the command
+    :return: the error reply for the first unsupported symbol or None if all are supported
+    """
+    for symbol in symbols:
+        if not symbol_index.is_supported(symbol):
+            metrics.increment("unsupported_symbol_commands")
+            suggestion = symbol_index.suggest(symbol)
+            did_you_mean = " Did you mean **{suggestion}**?".format(suggestion=suggestion) if suggestion else ""
+            return ("Error processesing your request: {symbol} is not a supported currency.{did_you_mean}\n\n"
+                    "If it is not listed [here](https://www.cryptocompare.com/api/data/coinlist/) then it is not supported.\n\n"
+                    "Please see the [README](https://github.com/jjmerri/cryptoTradingGame-Reddit) for more info.".format(
+                        symbol=symbol,
+                        did_you_mean=did_you_mean))
+
+    return None
+
+def get_game_engine(request_context):
+    """
+    :param request_context: the RequestContext the command runs in
+    :return: a GameEngine that applies the trading rules to the MySQL tables in request_context at the bot's prices
+    """
+    return GameEngine(MySqlStorage(request_context), get_fixed_trading_price, get_fixed_usd_prices)
+
+def get_fixed_trading_price(from_symbol, to_symbol, price_time):
+    """
+    GameEngine price source. The price is fetched on the price pool
+    :return: the fixed point price or 0 if it could not be fetched
+    """
+    trading_price = price_pool.call(get_trading_price, from_symbol, to_symbol, price_time)
+    if trading_price is None or trading_price <= 0:
+        return 0
+    return to_fixed(trading_price)
+
+def get_fixed_usd_prices(currencies):
+    """
+    GameEngine USD price source for trade analytics
+    :return: dictionary of currency to fixed point USD price of the currencies that could be priced
+    """
+    usd_value, price_version = price_snapshot.get_prices(currencies)
+    return usd_value
+
+def get_price_unavailable_reply():
+    """
+    :return: the error reply for a command whose currency pair could not be priced
+    """
+    return ("Error processesing your request: The provided currency pair may be unsupported or the CryptoCompare API could be down. "
+            "If it is not listed [here](https://www.cryptocompare.com/api/data/coinlist/) then it is not supported. "
+            "If it is listed please try again later.\n\n"
+            "Please see the [README](https://github.com/jjmerri/cryptoTradingGame-Reddit) for more info.")
+
 def get_trading_price(from_symbol, to_symbol, price_time):
     """
     :param from_symbol: symbol we want the price of
     :param to_symbol: symbol we want the price in
     :param price_time: point in time to get the price. If elapsed time is < 60 seconds the current price is returned
-    :return:
+    :return: the price, or a negative number if it could not be fetched
+    """
+    if replay_session is not None:
+        return replay_session.get_price(from_symbol, to_symbol, price_time)
+
+    trading_price = request_trading_price(from_symbol, to_symbol, price_time)
+    input_recorder.record_quote(from_symbol, to_symbol, price_time, trading_price)
+    return trading_price
+
+def request_trading_price(from_symbol, to_symbol, price_time):
+    """
+    Calls the CryptoCompare API for get_trading_price
     """
     try:
         api_url = "https://min-api.cryptocompare.com/data/pricemulti?fsyms={from_symbol}&tsyms={to_symbol}".format(
@@ -484,6 +1835,12 @@ def get_trading_price(from_symbol, to_symbol, price_time):
             use_history_api = True
 
         if use_history_api:
+            # Backlogged commands were planned by plan_historical_backfill and are filled from local bars
+            backfilled_close = historical_price_bars.get_close(from_symbol, to_symbol, price_time)
+            if backfilled_close is not None:
+                metrics.increment("historical_backfill_fills")
+                return backfilled_close
+
             api_url = ("https://min-api.cryptocompare.com/data/histominute?"
                        "fsym={from_symbol}&"
                        "tsym={to_symbol}&"
@@ -539,12 +1896,18 @@ def get_game_id(submission_id):
     :param submission_id: the submission_id of the game
     :return: Returns the game_id associated with submission_id
     """
+    # The mapping never changes once a game is created so it only needs to be read once
+    if submission_id in game_id_cache:
+        return game_id_cache[submission_id]
+
     db_connection = DbConnection()
     query = "SELECT game_id FROM game_submission WHERE game_submission.submission_id = %s"
     db_connection.cursor.execute(query, [submission_id])
     game_id = db_connection.cursor.fetchall()[0]["game_id"]
     db_connection.connection.close()
 
+    game_id_cache[submission_id] = game_id
+    submission_id_cache[game_id] = submission_id
     return game_id
 
 def get_submission_id(game_id):
@@ -553,197 +1916,167 @@ def get_submission_id(game_id):
     :param submission_id: the submission_id of the game
     :return: Returns the game_id associated with submission_id
     """
+    if game_id in submission_id_cache:
+        return submission_id_cache[game_id]
+
     db_connection = DbConnection()
     query = "SELECT submission_id FROM game_submission WHERE game_submission.game_id = %s"
     db_connection.cursor.execute(query, [game_id])
     submission_id = db_connection.cursor.fetchall()[0]["submission_id"]
     db_connection.connection.close()
 
+    game_id_cache[submission_id] = game_id
+    submission_id_cache[game_id] = submission_id
     return submission_id
 
-def execute_trade(comment_id, username, buy_quantity, buy_currency, trade_cost, sell_currency, is_limit_order, submission_id = None, game_id = None):
+def get_owner_trade_stats(submission_id, username):
     """
-    Executes the trade as an atomic function by updating the portfolio and adding the trade to the executed_trade table
-    :param submission_id: id of the game the request is for
-    :param comment_id: id of the comment that contains the request
-    :param username: user that requested the trade
-    :param buy_quantity: amount of buy_currency bought
-    :param buy_currency: the currency that was bought
-    :param trade_cost: amount of sell_currency it cost to buy the amount of buy_currency
-    :param sell_currency: the currency that was sold
-    :return: success or failure
+    :param submission_id: the game to get the stats for
+    :param username: the user to get the stats for
+    :return: the user's trade_rollup rows, one per currency pair, with the most USD volume first
     """
-    if submission_id is None and game_id is None:
-        logger.error("execute_trade did not provide submission_id or game_id! Cannot execute trade.")
-        return False
-    elif game_id is None:
-        game_id = get_game_id(submission_id)
-    elif submission_id is None:
-        submission_id = get_submission_id(game_id)
-
-    available_funds = 0
-    portfolio_sell_currency = get_portfolio(submission_id, username, sell_currency)
-    if portfolio_sell_currency:
-        available_funds = float(portfolio_sell_currency[0]["amount"])
-    else:
-        return False
-
-    #If it is a limit order the funds were already subtracted from the portfolio so add the funds back to make the trade
-    if is_limit_order:
-        available_funds += float(trade_cost)
-
-    if available_funds < trade_cost:
-        logger.error("Insufficient funds to complete trade with comment_id: {comment_id)".format(comment_id=comment_id))
-        return False
-
     db_connection = DbConnection()
-
-    #Update sell currency portfolio
-    query = ("UPDATE portfolio "
-             "SET amount = %s "
-             "WHERE game_id = %s AND owner = %s AND currency = %s")
-    db_connection.cursor.execute(query, [(available_funds - float(trade_cost)), game_id, username, sell_currency])
-
-    #Update buy currency portolfio or add it if it doesnt exist
-    query = ("SELECT portfolio_id FROM portfolio "
-             "WHERE game_id = %s AND owner = %s AND currency = %s")
-    db_connection.cursor.execute(query, [game_id, username, buy_currency])
-    portfolio_id_result_set = db_connection.cursor.fetchall()
-
-    if portfolio_id_result_set:
-        portfolio_id = portfolio_id_result_set[0]["portfolio_id"]
-        query = ("UPDATE portfolio "
-                 "SET amount = amount + %s "
-                 "WHERE portfolio_id = %s")
-        db_connection.cursor.execute(query, [buy_quantity, portfolio_id])
-    else:
-        query = "INSERT INTO portfolio (game_id, owner, currency, amount) VALUES (%s, %s, %s, %s)"
-        db_connection.cursor.execute(query, [game_id, username, buy_currency, buy_quantity])
-
-    query = ("INSERT INTO executed_trade (game_id, comment_id, buy_currency, buy_amount, sell_currency, sell_amount) "
-            "VALUES (%s, %s, %s, %s, %s, %s)")
-    db_connection.cursor.execute(query, [game_id, comment_id, buy_currency, buy_quantity, sell_currency, trade_cost])
-
-    db_connection.connection.commit()
+    query = ("SELECT buy_currency, sell_currency, trade_count, buy_volume, sell_volume, volume_usd, realized_pnl_usd "
+             "FROM trade_rollup WHERE game_id = %s AND owner = %s "
+             "ORDER BY volume_usd DESC")
+    db_connection.cursor.execute(query, [get_game_id(submission_id), username])
+    trade_stats = db_connection.cursor.fetchall()
     db_connection.connection.close()
 
-    return True
+    return trade_stats
 
-def create_limit_order(submission_id, comment_id, username, buy_quantity, buy_currency, available_funds, trade_cost, sell_currency, limit_price):
+def get_pair_trade_stats(submission_id, buy_currency, sell_currency):
     """
-    creates a limit order as an atomic function by moving currency from the portfolio to the limit_order table
-    :param submission_id: id of the game the request is for
-    :param comment_id: id of the comment that contains the request
-    :param username: user that requested the trade
-    :param buy_quantity: amount of buy_currency bought
-    :param buy_currency: the currency that was bought
-    :param available_funds: amount of sell_currency available for sale
-    :param trade_cost: amount of sell_currency it cost to buy the amount of buy_currency
-    :param sell_currency: the currency that was sold
-    :return: success or failure
+    :param submission_id: the game to get the stats for
+    :param buy_currency: the currency bought
+    :param sell_currency: the currency sold
+    :return: the game wide trade_rollup row for the pair or None if it was never traded
     """
-
     db_connection = DbConnection()
-    query = "SELECT game_id FROM game_submission WHERE game_submission.submission_id = %s"
-    db_connection.cursor.execute(query, [submission_id])
-    game_id = db_connection.cursor.fetchall()[0]["game_id"]
-
-    #Update sell currency portfolio
-    query = ("UPDATE portfolio "
-             "SET amount = %s "
-             "WHERE game_id = %s AND owner = %s AND currency = %s")
-    db_connection.cursor.execute(query, [(available_funds - trade_cost), game_id, username, sell_currency])
-
-    #create limit order by inserting into table
-    query = ("INSERT INTO limit_order (game_id, comment_id, owner, buy_currency, buy_amount, sell_currency, sell_amount, limit_price, executed, canceled) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
-    db_connection.cursor.execute(query, [game_id, comment_id, username, buy_currency, buy_quantity, sell_currency, trade_cost, limit_price, False, False])
-
-    db_connection.connection.commit()
+    query = ("SELECT trade_count, buy_volume, sell_volume, volume_usd, realized_pnl_usd "
+             "FROM trade_rollup WHERE game_id = %s AND owner = %s AND buy_currency = %s AND sell_currency = %s")
+    db_connection.cursor.execute(query, [get_game_id(submission_id), TRADE_ROLLUP_GAME_OWNER, buy_currency, sell_currency])
+    trade_stats = db_connection.cursor.fetchall()
     db_connection.connection.close()
 
-def cancel_limit_order(limit_order_id, username):
+    if trade_stats:
+        return trade_stats[0]
+    return None
+
+def process_stats_command(message, request_context):
     """
-    :param limit_order_id: id of limit order to cancel
-    :param username: username of requestor
-    :return: True if successful False otherwise
+    Replies with the requester's trade count, volume and realized P&L per currency pair, or with the game wide
+    stats of one pair when the command names one
+    :param message: the message containing the stats command
+    :param request_context: the RequestContext the reply is queued on
+    :return: True if success False if not
     """
+    command_regex = r'!stats[ ]+(?P<buy_currency>[0-9a-zA-Z]+)[ ]+(?P<sell_currency>[0-9a-zA-Z]+)'
+    match = re.search(command_regex, message.body, re.IGNORECASE)
+    if match:
+        return process_pair_stats_command(message, request_context,
+                                          match.group("buy_currency").upper(), match.group("sell_currency").upper())
 
-    db_connection = DbConnection()
-    query = "SELECT * FROM limit_order WHERE limit_order_id = %s AND owner = %s AND executed = false AND canceled = false"
-    db_connection.cursor.execute(query, [limit_order_id, username])
-    limit_orders = db_connection.cursor.fetchall()
+    trade_stats = get_owner_trade_stats(message.parent().id, message.author.name)
 
-    if limit_orders:
-        limit_order = limit_orders[0]
-        sell_currency = limit_order["sell_currency"]
-        sell_amount = limit_order["sell_amount"]
-        game_id = limit_order["game_id"]
+    if not trade_stats:
+        request_context.reply(message, "You have not made any trades in this game yet.")
+        return True
 
-        # Update sell currency portfolio
-        query = ("UPDATE portfolio "
-                 "SET amount = amount + %s "
-                 "WHERE game_id = %s AND owner = %s AND currency = %s")
-        db_connection.cursor.execute(query, [sell_amount, game_id, username, sell_currency])
+    stats_parts = ["**Your Trading Stats:**\n\n"
+                   "Buy Currency | Sell Currency | Trades | Buy Volume | Sell Volume | Volume (USD) | Realized P&L (USD)\n"
+                   "---|---|---|---|---|---|----\n"]
+    total_trades = 0
+    total_volume_usd = 0
+    total_realized_pnl = 0
+    for pair_stats in trade_stats:
+        volume_usd = to_fixed(pair_stats["volume_usd"])
+        realized_pnl = to_fixed(pair_stats["realized_pnl_usd"])
+        total_trades += pair_stats["trade_count"]
+        total_volume_usd += volume_usd
+        total_realized_pnl += realized_pnl
+        stats_parts.extend((pair_stats["buy_currency"], "|", pair_stats["sell_currency"], "|", str(pair_stats["trade_count"]), "|",
+                            format_fixed_6g(to_fixed(pair_stats["buy_volume"])), "|",
+                            format_fixed_6g(to_fixed(pair_stats["sell_volume"])), "|$",
+                            format_fixed_2f(volume_usd), "|$", format_fixed_2f(realized_pnl), "\n"))
+    stats_parts.extend(("**TOTAL**|**-----**|**", str(total_trades), "**|**-----**|**-----**|**$",
+                        format_fixed_2f(total_volume_usd), "**|**$", format_fixed_2f(total_realized_pnl), "**\n"))
+
+    request_context.reply(message, "".join(stats_parts))
+    return True
 
-        #cancel order in table
-        query = "UPDATE limit_order SET canceled = true WHERE limit_order_id = %s AND owner = %s"
-        db_connection.cursor.execute(query, [limit_order_id, username])
+def process_pair_stats_command(message, request_context, buy_currency, sell_currency):
+    """
+    Replies with the trade count, volume and realized P&L of every trade in the game that bought buy_currency
+    with sell_currency
+    :param message: the message containing the stats command
+    :param request_context: the RequestContext the reply is queued on
+    :return: True if success False if not
+    """
+    pair_stats = get_pair_trade_stats(message.parent().id, buy_currency, sell_currency)
 
-        db_connection.connection.commit()
-        db_connection.connection.close()
+    if pair_stats is None:
+        request_context.reply(message, "Nobody has bought {buy_currency} with {sell_currency} in this game yet.".format(
+            buy_currency = buy_currency,
+            sell_currency = sell_currency))
         return True
-    else:
-        return False
+
+    request_context.reply(message, "".join(("**{buy_currency}/{sell_currency} Trading Stats for the Game:**\n\n".format(
+                                                buy_currency = buy_currency, sell_currency = sell_currency),
+                                            "Trades | Buy Volume | Sell Volume | Volume (USD) | Realized P&L (USD)\n"
+                                            "---|---|---|---|----\n",
+                                            str(pair_stats["trade_count"]), "|",
+                                            format_fixed_6g(to_fixed(pair_stats["buy_volume"])), "|",
+                                            format_fixed_6g(to_fixed(pair_stats["sell_volume"])), "|$",
+                                            format_fixed_2f(to_fixed(pair_stats["volume_usd"])), "|$",
+                                            format_fixed_2f(to_fixed(pair_stats["realized_pnl_usd"])), "\n")))
+    return True
 
 def initialize_portfolio(submission_id, username):
     """
-    If the portfolio is empty for the user in the given game then give them USD to start the game
-    :param game_id: The game the portfolio belongs to
+    If the user is new to the given game then give them USD to start the game. Players seen before cost no query
+    :param submission_id: The game the portfolio belongs to
     :param username: username the portfolio belongs to
     """
+    game_id = get_game_id(submission_id)
+    if not player_onboarding.is_onboarded(game_id, username):
+        player_onboarding.onboard(game_id, [username])
 
-    portfolio = get_portfolio(submission_id, username)
-
-    if not portfolio:
-        db_connection = DbConnection()
-        query = "SELECT game_id FROM game_submission WHERE game_submission.submission_id = %s"
-        db_connection.cursor.execute(query, [submission_id])
-        game_id = db_connection.cursor.fetchall()[0]["game_id"]
-
-        query = "INSERT INTO portfolio (game_id, owner, currency, amount) VALUES (%s, %s, %s, %s)"
-        db_connection.cursor.execute(query, [game_id, username, "USD", 10000])
-
-        db_connection.connection.commit()
-        db_connection.connection.close()
-
-def get_users_open_limit_orders(submission_id, username):
+def get_users_open_limit_orders(submission_id, username, request_context = None):
     """
     :param submission_id: The game the portfolio belongs to
     :param username: username the portfolio belongs to
-    :param currency: None if you want everything or specify the currency you want info for
-    :return: If currency is None return the entire portfolio otherwise get only the currency specified
+    :param request_context: the RequestContext to read in so uncommitted changes are seen. None to use a new connection
+    :return: the user's open limit orders
     """
-
-    db_connection = DbConnection()
     query = ("SELECT * FROM limit_order "
              "JOIN game_submission ON game_submission.game_id = limit_order.game_id "
              "WHERE game_submission.submission_id = %s AND limit_order.owner = %s AND "
              "executed = false AND canceled = false "
              "ORDER BY buy_currency ASC")
+
+    if request_context is not None:
+        request_context.db_connection.cursor.execute(query, [submission_id, username])
+        return request_context.db_connection.cursor.fetchall()
+
+    db_connection = DbConnection()
     db_connection.cursor.execute(query, [submission_id, username])
     limit_orders = db_connection.cursor.fetchall()
     db_connection.connection.close()
 
     return limit_orders
 
-def get_portfolio(submission_id, username, currency = None):
+def get_portfolio(submission_id, username, currency = None, request_context = None):
     """
     :param submission_id: The game the portfolio belongs to
     :param username: username the portfolio belongs to
     :param currency: None if you want everything or specify the currency you want info for
+    :param request_context: the RequestContext to read in. None to use a new connection
     :return: If currency is None return the entire portfolio otherwise get only the currency specified
     """
+    if request_context is not None:
+        return request_context.get_portfolio(get_game_id(submission_id), username, currency)
+
     currency_clause = ""
     query_args = [submission_id, username]
     if currency is not None:
@@ -796,25 +2129,38 @@ def get_all_open_limit_orders(submission_id):
     return limit_orders
 
 
+def get_open_limit_order(comment_id):
+    """
+    :param comment_id: the id of the comment that placed the limit order
+    :return: the limit order if it is still open otherwise None
+    """
+    db_connection = DbConnection()
+    query = "SELECT * FROM limit_order WHERE comment_id = %s AND executed = false AND canceled = false"
+    db_connection.cursor.execute(query, [comment_id])
+    limit_order = db_connection.cursor.fetchone()
+    db_connection.connection.close()
+
+    return limit_order
+
 def get_currencies(submission_id, username = None):
     """
     :param submission_id: The game the portfolio belongs to
     :param username: username the portfolio belongs to
     :return: If username is None return all the currencies being used
     """
-    username_clause = ""
-    query_args = [submission_id]
-    if username is not None:
-        username_clause = " AND portfolio.owner = %s"
-        query_args.append(username)
-
     db_connection = DbConnection()
-    query = ("SELECT DISTINCT currency FROM portfolio "
-             "JOIN game_submission ON game_submission.game_id = portfolio.game_id "
-             "WHERE game_submission.submission_id = %s{username_clause} "
-             "ORDER BY currency ASC".format(
-            username_clause=username_clause
-    ))
+    if username is None:
+        # Read from the materialized counters instead of a DISTINCT over every portfolio row in the game
+        query = ("SELECT currency FROM game_currency "
+                 "WHERE game_id = %s AND holder_count > 0 "
+                 "ORDER BY currency ASC")
+        query_args = [get_game_id(submission_id)]
+    else:
+        query = ("SELECT DISTINCT currency FROM portfolio "
+                 "JOIN game_submission ON game_submission.game_id = portfolio.game_id "
+                 "WHERE game_submission.submission_id = %s AND portfolio.owner = %s "
+                 "ORDER BY currency ASC")
+        query_args = [submission_id, username]
     db_connection.cursor.execute(query, query_args)
     currencies = db_connection.cursor.fetchall()
     db_connection.connection.close()
@@ -825,77 +2171,205 @@ def get_currencies(submission_id, username = None):
 
     return currency_list
 
-def get_portfolio_summary(submission_id, username):
-    portfolio = get_portfolio(submission_id, username)
-    limit_orders = get_users_open_limit_orders(submission_id, username)
+def get_active_games_currencies():
+    """
+    :return: every currency held by or referenced by an open limit order in any game that is not complete
+    """
+    db_connection = DbConnection()
+    query = ("SELECT DISTINCT currency FROM game_currency "
+             "JOIN game_submission ON game_submission.game_id = game_currency.game_id "
+             "WHERE game_submission.complete = false AND (holder_count > 0 OR open_order_count > 0)")
+    db_connection.cursor.execute(query, [])
+    currencies = db_connection.cursor.fetchall()
+    db_connection.connection.close()
 
-    portfolio_summary = ""
+    return [currency["currency"] for currency in currencies]
 
-    currencies = get_currencies(submission_id, username)
-    usd_value = get_currencies_current_usd_value(currencies)
-    total_usd_value = 0
+def get_game_stats(submission_id):
+    """
+    :param submission_id: the game to get the stats for
+    :return: dictionary with the game's player_count and open_order_count
+    """
+    db_connection = DbConnection()
+    query = "SELECT player_count, open_order_count FROM game_stats WHERE game_id = %s"
+    db_connection.cursor.execute(query, [get_game_id(submission_id)])
+    game_stats = db_connection.cursor.fetchall()
+    db_connection.connection.close()
 
-    if portfolio:
-        portfolio_header = ("**Available Funds:**\n\n"
-                            "Currency | Amount | Value (USD)\n"
-                  "---|---|----\n")
-        portfolio_body = ""
+    if game_stats:
+        return game_stats[0]
+    return {"player_count": 0, "open_order_count": 0}
 
-        total_portfolio_usd_value = 0
+def adjust_game_counters(db_connection, game_id, player_delta = 0, open_order_delta = 0,
+                         currency_holder_deltas = (), currency_order_deltas = (), currency_delta = 0):
+    """
+    Updates the materialized game_stats and game_currency counters in the caller's transaction
+    :param db_connection: the open connection the game state change is being made with. The caller commits
+    :param game_id: the game the change is for
+    :param player_delta: change in the number of players
+    :param open_order_delta: change in the number of open limit orders
+    :param currency_holder_deltas: currencies whose portfolio row count changes by currency_delta
+    :param currency_order_deltas: currencies whose open limit order count changes by currency_delta
+    :param currency_delta: the change applied to each currency in currency_holder_deltas and currency_order_deltas
+    """
+    if player_delta or open_order_delta:
+        query = ("INSERT INTO game_stats (game_id, player_count, open_order_count) VALUES (%s, %s, %s) "
+                 "ON DUPLICATE KEY UPDATE player_count = player_count + VALUES(player_count), "
+                 "open_order_count = open_order_count + VALUES(open_order_count)")
+        db_connection.cursor.execute(query, [game_id, player_delta, open_order_delta])
+
+    query = ("INSERT INTO game_currency (game_id, currency, holder_count, open_order_count) VALUES (%s, %s, %s, %s) "
+             "ON DUPLICATE KEY UPDATE holder_count = holder_count + VALUES(holder_count), "
+             "open_order_count = open_order_count + VALUES(open_order_count)")
+    for currency in currency_holder_deltas:
+        db_connection.cursor.execute(query, [game_id, currency, currency_delta, 0])
+    for currency in currency_order_deltas:
+        db_connection.cursor.execute(query, [game_id, currency, 0, currency_delta])
+
+def rebuild_game_counters():
+    """
+    Recomputes game_stats and game_currency from the portfolio and limit_order tables.
+    Run at startup so the counters are correct even if they were created after games started
+    """
+    db_connection = DbConnection()
+    db_connection.cursor.execute("DELETE FROM game_currency", [])
+    db_connection.cursor.execute("DELETE FROM game_stats", [])
+
+    db_connection.cursor.execute(
+        "INSERT INTO game_currency (game_id, currency, holder_count, open_order_count) "
+        "SELECT game_id, currency, COUNT(*), 0 FROM portfolio GROUP BY game_id, currency", [])
+    for order_currency_column in ("buy_currency", "sell_currency"):
+        db_connection.cursor.execute(
+            "INSERT INTO game_currency (game_id, currency, holder_count, open_order_count) "
+            "SELECT game_id, {column}, 0, COUNT(*) FROM limit_order "
+            "WHERE executed = false AND canceled = false GROUP BY game_id, {column} "
+            "ON DUPLICATE KEY UPDATE open_order_count = open_order_count + VALUES(open_order_count)".format(
+                column=order_currency_column), [])
+
+    db_connection.cursor.execute(
+        "INSERT INTO game_stats (game_id, player_count, open_order_count) "
+        "SELECT game_id, COUNT(DISTINCT owner), 0 FROM portfolio GROUP BY game_id", [])
+    db_connection.cursor.execute(
+        "INSERT INTO game_stats (game_id, player_count, open_order_count) "
+        "SELECT game_id, 0, COUNT(*) FROM limit_order WHERE executed = false AND canceled = false GROUP BY game_id "
+        "ON DUPLICATE KEY UPDATE open_order_count = VALUES(open_order_count)", [])
 
-        for portfolio_currency in portfolio:
-            currency = portfolio_currency["currency"]
-            amount = float(portfolio_currency["amount"])
-            if currency in usd_value:
-                currency_value = amount * usd_value[currency]
-                total_portfolio_usd_value += currency_value
-                portfolio_body += currency + "|" + '{:,.6g}'.format(amount) + "|" + '${:,.2f}'.format(currency_value) + "\n"
-        portfolio_footer = "**TOTAL**|**-----**|**" + '${:,.2f}'.format(total_portfolio_usd_value) + "**\n"
+    db_connection.connection.commit()
+    db_connection.connection.close()
 
-        portfolio_summary += portfolio_header + portfolio_body + portfolio_footer
-        total_usd_value += total_portfolio_usd_value
-    else:
-        logger.error("Something might be wrong with {username}'s portfolio for game {submission_id}. "
-                     "They have no portfolio for the given game!".format(username = username,
-                                                                         submission_id = submission_id))
-        return ""
+def get_portfolio_holdings(submission_id, username, request_context = None):
+    """
+    Loads the rows a portfolio summary is rendered from and converts them to fixed point once
+    :param submission_id: The game the portfolio belongs to
+    :param username: username the portfolio belongs to
+    :param request_context: the RequestContext to read in. None to use new connections
+    :return: dictionary with portfolio, limit_orders and currencies
+    """
+    portfolio = []
+    for portfolio_currency in get_portfolio(submission_id, username, request_context = request_context):
+        portfolio.append((portfolio_currency["currency"], to_fixed(portfolio_currency["amount"])))
+
+    limit_orders = []
+    for limit_order in get_users_open_limit_orders(submission_id, username, request_context):
+        limit_orders.append((limit_order["limit_order_id"],
+                             limit_order["buy_currency"],
+                             to_fixed(limit_order["buy_amount"]),
+                             limit_order["sell_currency"],
+                             to_fixed(limit_order["sell_amount"]),
+                             to_fixed(limit_order["limit_price"])))
 
-    if limit_orders:
-        limit_order_header = ("**Limit Orders:**\n\n"
-                              "Order ID | Buy Currency | Buy Quantity | Sell Currency | Sell Quantity | Limit Price | Value (USD)\n"
-                            "---|---|---|---|---|---|----\n")
-        limit_order_body = ""
+    currencies = set(portfolio_currency[0] for portfolio_currency in portfolio)
+    currencies.update(limit_order[3] for limit_order in limit_orders)
 
+    return {"portfolio": portfolio, "limit_orders": limit_orders, "currencies": sorted(currencies)}
+
+def get_portfolio_summary(submission_id, username, request_context = None):
+    """
+    Returns the markdown portfolio summary for username. Holdings are cached until the owner trades and are valued
+    with the tick's price snapshot so repeat requests dont touch the DB or the price API
+    :param submission_id: The game the portfolio belongs to
+    :param username: username the portfolio belongs to
+    :param request_context: the RequestContext to read in. None to use new connections
+    :return: the markdown portfolio summary
+    """
+    cache_key = (get_game_id(submission_id), username)
+
+    # Changes that are not committed yet are rendered straight from the transaction and never cached
+    if request_context is not None and request_context.is_portfolio_changed(*cache_key):
+        holdings = get_portfolio_holdings(submission_id, username, request_context)
+        usd_value, _ = price_snapshot.get_prices(holdings["currencies"])
+        return render_portfolio_summary(holdings, usd_value)
+
+    holdings, generation = portfolio_summary_cache.get_holdings(cache_key)
+
+    if holdings is None:
+        holdings = get_portfolio_holdings(submission_id, username, request_context)
+        if not holdings["portfolio"]:
+            logger.error("Something might be wrong with {username}'s portfolio for game {submission_id}. "
+                         "They have no portfolio for the given game!".format(username = username,
+                                                                             submission_id = submission_id))
+            return ""
+        portfolio_summary_cache.set_holdings(cache_key, generation, holdings)
+
+    usd_value, _ = price_snapshot.get_prices(holdings["currencies"])
+    price_key = get_summary_price_key(holdings, usd_value)
+
+    portfolio_summary = portfolio_summary_cache.get_summary(cache_key, price_key)
+    if portfolio_summary is None:
+        portfolio_summary = render_portfolio_summary(holdings, usd_value)
+        portfolio_summary_cache.set_summary(cache_key, generation, price_key, portfolio_summary)
+
+    return portfolio_summary
+
+def render_portfolio_summary(holdings, usd_value):
+    """
+    Renders the markdown tables for the holdings returned by get_portfolio_holdings
+    :param holdings: the cached holdings to render
+    :param usd_value: dictionary of currency to fixed point USD price
+    :return: the markdown portfolio summary
+    """
+    summary_parts = ["**Available Funds:**\n\n"
+                     "Currency | Amount | Value (USD)\n"
+                     "---|---|----\n"]
+    total_portfolio_usd_value = 0
+
+    for currency, amount in holdings["portfolio"]:
+        if currency in usd_value:
+            currency_value = fixed_mul(amount, usd_value[currency])
+            total_portfolio_usd_value += currency_value
+            summary_parts.extend((currency, "|", format_fixed_6g(amount), "|$", format_fixed_2f(currency_value), "\n"))
+    summary_parts.extend(("**TOTAL**|**-----**|**$", format_fixed_2f(total_portfolio_usd_value), "**\n"))
+
+    if holdings["limit_orders"]:
+        summary_parts.append("\n\n^^^^.\n\n **Limit Orders:**\n\n"
+                             "Order ID | Buy Currency | Buy Quantity | Sell Currency | Sell Quantity | Limit Price | Value (USD)\n"
+                             "---|---|---|---|---|---|----\n")
         total_limit_order_usd_value = 0
 
-        for limit_order_currency in limit_orders:
-            buy_currency = limit_order_currency["buy_currency"]
-            buy_quantity = limit_order_currency["buy_amount"]
-            limit_price = limit_order_currency["limit_price"]
-            currency = limit_order_currency["sell_currency"]
-            amount = float(limit_order_currency["sell_amount"])
-            order_id = limit_order_currency["limit_order_id"]
+        for order_id, buy_currency, buy_quantity, currency, amount, limit_price in holdings["limit_orders"]:
             if currency in usd_value:
-                currency_value = amount * usd_value[currency]
+                currency_value = fixed_mul(amount, usd_value[currency])
                 total_limit_order_usd_value += currency_value
-                limit_order_body += (str(order_id) + "|" + buy_currency + "|" + '{:,.6g}'.format(buy_quantity) + "|" +
-                                     currency + "|" + '{:,.6g}'.format(amount) + "|" + '{:,.6g}'.format(limit_price) + "|" + '${:,.2f}'.format(
-                    currency_value) + "\n")
-                limit_order_footer = "**TOTAL**|**-----**|**-----**|**-----**|**-----**|**-----**|**" + '${:,.2f}'.format(total_limit_order_usd_value) + "**\n"
-
-        portfolio_summary += "\n\n^^^^.\n\n " + limit_order_header + limit_order_body + limit_order_footer
-        total_usd_value += total_limit_order_usd_value
+                summary_parts.extend((str(order_id), "|", buy_currency, "|", format_fixed_6g(buy_quantity), "|",
+                                      currency, "|", format_fixed_6g(amount), "|", format_fixed_6g(limit_price), "|$",
+                                      format_fixed_2f(currency_value), "\n"))
+        summary_parts.extend(("**TOTAL**|**-----**|**-----**|**-----**|**-----**|**-----**|**$",
+                              format_fixed_2f(total_limit_order_usd_value), "**\n"))
 
-        portfolio_summary += "\n\n^^^^.\n\n The total combined value of your portfolio and limit orders is: " \
-                             "**{total}**".format(total = '{:,.2f}'.format(total_usd_value))
+        summary_parts.extend(("\n\n^^^^.\n\n The total combined value of your portfolio and limit orders is: **",
+                              format_fixed_2f(total_portfolio_usd_value + total_limit_order_usd_value), "**"))
 
-    return portfolio_summary
+    return "".join(summary_parts)
 
 def get_currencies_current_usd_value(currencies):
     """
     :param currencies: the currencies to get the USD value for
     :return: dictionary containing currency USD values
     """
+    if replay_session is not None:
+        return replay_session.get_usd_prices(currencies)
+
+    price_time = time.time()
     try:
         api_url = "https://min-api.cryptocompare.com/data/pricemulti?fsyms={currencies}&tsyms=USD".format(
             currencies = ",".join(currencies)
@@ -926,33 +2400,134 @@ def get_currencies_current_usd_value(currencies):
         prices = {}
         for price in response:
             prices[price] = response[price]["USD"]
+            input_recorder.record_quote(price, "USD", price_time, prices[price])
         return prices
     except Exception as err:
         logger.exception("Error getting usd values")
         return {}
 
+def get_minute_start(price_time):
+    """
+    :return: the start time of the histominute bar that contains price_time
+    """
+    return int(price_time // 60) * 60
+
+def plan_historical_backfill(comments):
+    """
+    Collects the (pair, minute) keys of market and limit commands that will be priced from history and
+    fetches each pair's minute bars once over the whole gap so they are filled locally
+    :param comments: the pending reddit comments
+    """
+    current_time = time.time()
+    pair_time_ranges = {}
+    for comment in comments:
+        if current_time - comment.created_utc <= 60:
+            continue
+
+        # Same grammar as the commands themselves so only orders that will be priced get bars
+        order = parse_market_order(comment.body) or parse_limit_order(comment.body)
+        if not order:
+            continue
+
+        pair = (order["buy_currency"], order["sell_currency"])
+        # Commands with unsupported symbols are rejected without a price so their bars would never be used
+        if not (symbol_index.is_supported(pair[0]) and symbol_index.is_supported(pair[1])):
+            continue
+
+        minute_time = get_minute_start(comment.created_utc)
+        if historical_price_bars.has_minute(pair, minute_time):
+            pair_time_ranges.setdefault(pair, None)
+            continue
+
+        time_range = pair_time_ranges.get(pair)
+        if time_range is None:
+            pair_time_ranges[pair] = (minute_time, minute_time)
+        else:
+            pair_time_ranges[pair] = (min(time_range[0], minute_time), max(time_range[1], minute_time))
+
+    historical_price_bars.retain(pair_time_ranges)
+
+    fetch_args = [[pair[0], pair[1], time_range[0], time_range[1]]
+                  for pair, time_range in sorted(pair_time_ranges.items()) if time_range is not None]
+    # Run api calls in parallel because they take a while in succession
+    fetched_closes = price_pool.run_all(fetch_historical_closes, fetch_args)
+    for args, closes in zip(fetch_args, fetched_closes):
+        if closes:
+            historical_price_bars.add_bars((args[0], args[1]), closes)
+
+def fetch_historical_closes(from_symbol, to_symbol, from_time, to_time):
+    """
+    Fetches the minute closes of from_symbol in to_symbol from from_time to to_time with one histominute request
+    per HISTORICAL_BARS_MAX_LIMIT minutes
+    :return: dictionary of minute start time to close. Missing minutes fall back to get_trading_price's own request
+    """
+    closes = {}
+    to_ts = to_time
+    while to_ts >= from_time:
+        api_url = ("https://min-api.cryptocompare.com/data/histominute?"
+                   "fsym={from_symbol}&"
+                   "tsym={to_symbol}&"
+                   "toTs={to_ts}&"
+                   "e=CCCAGG&"
+                   "limit={limit}&"
+                   "extraParams=reddit_trading_game".format(
+            from_symbol=from_symbol,
+            to_symbol=to_symbol,
+            to_ts=to_ts,
+            limit=min(HISTORICAL_BARS_MAX_LIMIT, (to_ts - from_time) // 60 + 1)
+        ))
+
+        response = {}
+        api_error_count = 0
+
+        # Loop to retry getting API data. Will break on success or 10 consecutive errors
+        while True:
+            r = requests.get(api_url)
+            response = r.json()
+            metrics.increment("historical_backfill_requests")
+
+            if response.get("Response", "Error") == "Success":
+                break
+
+            api_error_count += 1
+            logger.error("Retry number {error_count} call {api_url}".format(api_url=api_url,
+                                                                            error_count=api_error_count))
+            time.sleep(1)
+            if api_error_count >= 10:
+                return closes
+
+        minute_times = []
+        for minute_data in response.get("Data", []):
+            closes[minute_data["time"]] = minute_data["close"]
+            minute_times.append(minute_data["time"])
+
+        if not minute_times:
+            break
+        to_ts = min(minute_times) - 60
+
+    return closes
+
 def get_currencies_historical_usd_value(currencies, price_time):
     """
     :param currencies: the currencies to get the USD value for
     :param price_time: the point in time to get the price for
     :return: dictionary containing currency USD values
     """
+    if replay_session is not None:
+        return replay_session.get_usd_prices(currencies, price_time)
+
     try:
-        price_threads = []
+        price_args = []
         historical_prices = {}
 
         for currency in currencies:
             if currency == "USD":
                 historical_prices["USD"] = 1
             else:
-                # Thread api calls because they take a while in succession
-                t = Thread(target=get_currency_historical_usd_value, args=[currency, price_time, historical_prices])
-                price_threads.append(t)
-                t.start()
+                # Run api calls in parallel because they take a while in succession
+                price_args.append([currency, price_time, historical_prices])
 
-        # Wait for all checks
-        for price_thread in price_threads:
-            price_thread.join()
+        price_pool.run_all(get_currency_historical_usd_value, price_args)
 
         return historical_prices
 
@@ -993,35 +2568,32 @@ def get_currency_historical_usd_value(currency, price_time, historical_prices):
                                                                             error_count=api_error_count))
             time.sleep(1)
             if api_error_count >= 10:
-                send_dev_pm("Retry number {error_count} call {api_url}".format(api_url=api_url,
-                                                                               error_count=api_error_count))
+                send_dev_pm("API Error Getting Historical Price", "Retry number {error_count} call {api_url}".format(api_url=api_url,
+                                                                                                    error_count=api_error_count))
                 break
         else:
             for minute_data in response["Data"]:
                 if (price_time - minute_data['time']) < 60:
                     historical_prices[currency] = minute_data['close']
+                    input_recorder.record_quote(currency, "USD", price_time, minute_data['close'])
             break
 
 def update_leader_board(submission_record):
     """
-    Updates the leaderboard for the game with submission_id
+    Updates the leaderboard for the game with submission_id. Games that are over get their final leader board from close_games
     :param submission_record: the reddit submission of the game to update
-    :param leader_board_time: the as of time to use for the price
-    :param game_over: True if the game is over and this is the final update
-    :return:
     """
     submission_id = submission_record["submission_id"]
-    submission = reddit.submission(id=submission_id)
-    current_datetime = time.time()
-    game_end_datetime = calendar.timegm(submission_record["game_end_datetime"].utctimetuple())
-    game_over = False
-    leader_board_time = current_datetime
-
-    if current_datetime >= game_end_datetime:
-        game_over = True
-        leader_board_time = game_end_datetime
+    leader_board_text = get_leader_board_text(submission_id, time.time(), False)
+    edit_leader_board(submission_id, leader_board_text)
 
-    leader_board_text = get_leader_board_text(submission_id, leader_board_time, game_over)
+def edit_leader_board(submission_id, leader_board_text):
+    """
+    Replaces the leader board in the game's post
+    :param submission_id: the id of the game's post
+    :param leader_board_text: the rendered leader board
+    """
+    submission = reddit.submission(id=submission_id)
     leader_board_text = "<leader_board>\n\n" + leader_board_text + "<\leader_board>"
     regex = re.compile(r"<leader_board>.*<\\leader_board>", re.DOTALL)
 
@@ -1033,62 +2605,58 @@ def update_leader_board(submission_record):
 
     submission.edit(updated_body)
 
-def close_game(submission_id):
+def set_winner_flair(submission_id, winner):
     """
-    closes out the game with the submission_id
-    :param submission_id: the id of the game to close
+    Sets the editable flair of the game's post to the winner
+    :param submission_id: the id of the game's post
+    :param winner: the winner of the game
     """
-    winner = get_leader(submission_id);
-
     submission = reddit.submission(id = submission_id)
-    choices = submission.flair.choices()
-    template_id = next(x for x in choices
-                       if x['flair_text_editable'])['flair_template_id']
+    template_id = subreddit_metadata.get_editable_template_id(submission)
     submission.flair.select(template_id, "Winner: {winner}".format(winner=winner))
 
-    db_connection = DbConnection()
-    query = "UPDATE game_submission SET complete = true WHERE submission_id = %s"
-    db_connection.cursor.execute(query,[submission_id])
-    db_connection.connection.commit()
-    db_connection.connection.close()
-
-def get_leader(submission_id):
+def complete_games(submission_ids):
     """
-    returns the user id of the user currently in the lead
-    :param submission_id: submission_id to get the winner for
-    :return: the user id of the user currently in the lead
+    Marks all the games in submission_ids complete with a single update
+    :param submission_ids: the ids of the games to mark complete
     """
+    if not submission_ids:
+        return
+
     db_connection = DbConnection()
-    query = ("SELECT owner FROM standings "
-             "JOIN game_submission ON game_submission.game_id = standings.game_id "
-             "WHERE game_submission.submission_id = %s "
-             "ORDER BY portfolio_value DESC "
-             "LIMIT 1")
-    rowcount = db_connection.cursor.execute(query,[submission_id])
-    winner = "None"
-    if rowcount > 0:
-        winner = db_connection.cursor.fetchall()[0]["owner"]
+    query = "UPDATE game_submission SET complete = true WHERE submission_id IN ({ids})".format(
+        ids=",".join(["%s"] * len(submission_ids)))
+    db_connection.cursor.execute(query, list(submission_ids))
+    db_connection.connection.commit()
     db_connection.connection.close()
 
-    return winner
+    for submission_id in submission_ids:
+        game_id = get_game_id(submission_id)
+        portfolio_summary_cache.forget_game(game_id)
+        comment_harvester.forget(submission_id)
+        for history_key in [history_key for history_key in standings_history_last_points if history_key[0] == game_id]:
+            del standings_history_last_points[history_key]
 
-def get_leader_board(submission_id, leader_board_time):
+def get_leader_board(submission_id, leader_board_time, currencies_usd_value = None):
     """
     Gets the leader board for the submission with submission_id at the point in time specified by leader_board_time
     :param submission_id: the id of the game to get the leader board for
     :param leader_board_time: the point in time to get the leader board
-    :return: a dicttionary where the key is a username and the value is the value of the users portfolio
+    :param currencies_usd_value: fixed point USD prices to value the game with. Fetched for leader_board_time if None
+    :return: LeaderBoard of the players' fixed point portfolio values
     """
     portfolio_values = {}
 
     currencies = get_currencies(submission_id)
     if currencies:
-        now_timestamp = time.time()
+        if currencies_usd_value is None:
+            now_timestamp = time.time()
 
-        if (now_timestamp - leader_board_time) > 60:
-            currencies_usd_value = get_currencies_historical_usd_value(currencies, int(leader_board_time))
-        else:
-            currencies_usd_value = get_currencies_current_usd_value(currencies)
+            if (now_timestamp - leader_board_time) > 60:
+                currencies_usd_value = get_currencies_historical_usd_value(currencies, int(leader_board_time))
+            else:
+                currencies_usd_value = get_currencies_current_usd_value(currencies)
+            currencies_usd_value = to_fixed_prices(currencies_usd_value)
 
         portfolios = get_all_portfolios(submission_id)
         limit_orders = get_all_open_limit_orders(submission_id)
@@ -1096,22 +2664,22 @@ def get_leader_board(submission_id, leader_board_time):
         for portfolio in portfolios:
             owner = portfolio["owner"]
             currency = portfolio["currency"]
-            amount = portfolio["amount"]
-            portfolio_values[owner] = portfolio_values.get(owner, 0.0) + (currencies_usd_value[currency] * float(amount))
+            amount = to_fixed(portfolio["amount"])
+            portfolio_values[owner] = portfolio_values.get(owner, 0) + fixed_mul(currencies_usd_value[currency], amount)
 
         for limit_order in limit_orders:
             owner = limit_order["owner"]
             currency = limit_order["sell_currency"]
-            amount = limit_order["sell_amount"]
-            portfolio_values[owner] = portfolio_values.get(owner, 0.0) + (currencies_usd_value[currency] * float(amount))
+            amount = to_fixed(limit_order["sell_amount"])
+            portfolio_values[owner] = portfolio_values.get(owner, 0) + fixed_mul(currencies_usd_value[currency], amount)
 
-    return sorted(portfolio_values.items(), key=operator.itemgetter(1), reverse=True)
+    return LeaderBoard(portfolio_values)
 
 def get_leader_board_text(submission_id, leader_board_time, game_over):
     """
     Gets the text for the leaderboard to be used in the games post
     :param submission_id: the game to get the leader board for
-    :param currencies_usd_value: the values of all the cryptos being used in the game
+    :param leader_board_time: the point in time to get the leader board
     :param game_over: true if the game has ended
     :return: the text for the leaderboard to be used in the games post
     """
@@ -1119,66 +2687,277 @@ def get_leader_board_text(submission_id, leader_board_time, game_over):
 
     update_leader_board_table(submission_id, leader_board)
 
-    game_end_header = ""
+    return render_leader_board_text(leader_board, game_over, get_game_stats(submission_id))
+
+def render_leader_board_text(leader_board, game_over, game_stats):
+    """
+    Renders the top LEADER_BOARD_POST_ROWS players so the post stays within Reddit's size limit
+    :param leader_board: the LeaderBoard returned by get_leader_board
+    :param game_over: true if the game has ended
+    :param game_stats: the game's counters returned by get_game_stats
+    :return: the text for the leaderboard to be used in the games post
+    """
+    leader_board_parts = []
     if leader_board and game_over:
-        winner = leader_board[0][0]
-        game_end_header = "### GAME END FINAL STANDINGS: Congrats to the winner {winner}!!!\n\n".format(winner = winner)
+        leader_board_parts.append("### GAME END FINAL STANDINGS: Congrats to the winner {winner}!!!\n\n".format(
+            winner = leader_board.leader()))
 
-    leader_board_header = (game_end_header +
-                           "**Leader Board Updated at "
-                           "[{update_datetime} UTC](http://www.wolframalpha.com/input/?i={update_datetime} UTC To Local Time):**\n\n".format(
-                            update_datetime = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")) +
-                          "User | Value (USD)\n"
-                          "---|---\n")
-    leader_board_body = ""
+    leader_board_parts.append("**Leader Board Updated at "
+                              "[{update_datetime} UTC](http://www.wolframalpha.com/input/?i={update_datetime} UTC To Local Time):**\n\n"
+                              "User | Value (USD)\n"
+                              "---|---\n".format(
+                                update_datetime = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")))
 
     num_bold_leaders = 3
-    num_leaders = 0
-    for portfolio_value in leader_board:
-        num_leaders += 1
+    for num_leaders, portfolio_value in enumerate(leader_board.top(LEADER_BOARD_POST_ROWS), 1):
         if num_leaders <= num_bold_leaders:
-            username = "**" + portfolio_value[0] + "**"
+            leader_board_parts.extend(("**", portfolio_value[0], "**"))
         else:
-            username = portfolio_value[0]
+            leader_board_parts.append(portfolio_value[0])
+        leader_board_parts.extend(("|", format_fixed_2f(portfolio_value[1]), "\n"))
+
+    if len(leader_board) > LEADER_BOARD_POST_ROWS:
+        leader_board_parts.append("\nShowing the top {shown} of {total} players. "
+                                  "Comment !Standings {{page}} to see the rest.\n".format(
+                                    shown = LEADER_BOARD_POST_ROWS,
+                                    total = len(leader_board)))
+
+    leader_board_parts.append("\n{player_count} players, {open_order_count} open limit orders.\n".format(
+        player_count = game_stats["player_count"],
+        open_order_count = game_stats["open_order_count"]))
+
+    return "".join(leader_board_parts)
+
+def get_latest_leader_board(submission_id):
+    """
+    :param submission_id: the game to get the leader board for
+    :return: the LeaderBoard saved by the last update, loaded from standings if this process has not saved one yet
+    """
+    game_id = get_game_id(submission_id)
+    if game_id in latest_leader_boards:
+        return latest_leader_boards[game_id]
+
+    db_connection = DbConnection()
+    query = "SELECT owner, portfolio_value FROM standings WHERE game_id = %s"
+    db_connection.cursor.execute(query, [game_id])
+    standings = db_connection.cursor.fetchall()
+    db_connection.connection.close()
 
-        value = portfolio_value[1]
-        leader_board_body += username + "|" + '{:,.2f}'.format(value) + "\n"
+    portfolio_values = {}
+    for standing in standings:
+        portfolio_values[standing["owner"]] = to_fixed(standing["portfolio_value"])
+
+    latest_leader_boards[game_id] = LeaderBoard(portfolio_values)
+    return latest_leader_boards[game_id]
+
+def process_standings_command(message, request_context):
+    """
+    Replies with one page of the full leader board and the requester's rank
+    :param message: the message containing the standings command
+    :param request_context: the RequestContext the reply is queued on
+    :return: True if success False if not
+    """
+    command_regex = r'!standings([ ]+(?P<page>[\d]+))?'
+    match = re.search(command_regex, message.body, re.IGNORECASE)
+
+    page_number = 1
+    if match and match.group("page"):
+        page_number = max(1, int(match.group("page")))
+
+    leader_board = get_latest_leader_board(message.parent().id)
+    page_count = leader_board.page_count()
+    page_number = min(page_number, page_count)
+
+    standings_parts = ["**Standings page {page_number} of {page_count}:**\n\n"
+                       "Rank | User | Value (USD)\n"
+                       "---|---|---\n".format(page_number = page_number, page_count = page_count)]
+    for rank, username, value in leader_board.page(page_number):
+        standings_parts.extend((str(rank), "|", username, "|", format_fixed_2f(value), "\n"))
+
+    rank = leader_board.rank(message.author.name)
+    if rank is None:
+        standings_parts.append("\nYou are not in the standings yet.")
+    else:
+        standings_parts.append("\nYou are ranked {rank} of {total}.".format(rank = rank, total = len(leader_board)))
 
-    return leader_board_header + leader_board_body
+    request_context.reply(message, "".join(standings_parts))
+    return True
 
-def update_leader_board_table(submission_id, leader_board):
+def update_leader_board_table(submission_id, leader_board, standings_time = None):
     """
     Updates the leader board for the game
     :param submission_id: id fot the game to update the leader board for
     :param leader_board: the leader board to save
+    :param standings_time: the unix time the leader board is as of. Defaults to now
     """
-    if leader_board:
-        db_connection = DbConnection()
-        query = "SELECT game_id FROM game_submission WHERE game_submission.submission_id = %s"
-        db_connection.cursor.execute(query, [submission_id])
-        game_id = db_connection.cursor.fetchall()[0]["game_id"]
+    update_leader_board_tables({submission_id: leader_board}, standings_time)
 
-        query = ("DELETE standings FROM standings "
-                "WHERE game_id = %s")
-        db_connection.cursor.execute(query, [game_id])
+def update_leader_board_tables(leader_boards, standings_time = None):
+    """
+    Updates the leader boards for several games in one transaction and appends them to the standings history
+    :param leader_boards: dictionary of submission_id to the leader board to save
+    :param standings_time: the unix time the leader boards are as of. Defaults to now
+    """
+    if standings_time is None:
+        standings_time = time.time()
 
-        values_sql = ""
-        sql_args = []
+    values_sql = ""
+    sql_args = []
+    game_leader_boards = {}
+
+    for submission_id, leader_board in leader_boards.items():
+        if not leader_board:
+            continue
 
-        for leader in leader_board:
+        game_id = get_game_id(submission_id)
+        game_leader_boards[game_id] = leader_board
+        latest_leader_boards[game_id] = leader_board
+        # The rows are written in any order so the board is not sorted here
+        for owner, portfolio_value in leader_board.portfolio_values.items():
             values_sql += "(%s, %s, %s),"
             sql_args.append(game_id)
-            sql_args.append(leader[0])
-            sql_args.append(leader[1])
+            sql_args.append(owner)
+            sql_args.append(from_fixed(portfolio_value))
 
+    if game_leader_boards:
+        db_connection = DbConnection()
         values_sql = values_sql[:-1]
 
-        query = ("INSERT INTO standings (game_id, owner, portfolio_value) VALUES {values}".format(values=values_sql))
+        # Players never leave a game so the rows are updated in place instead of deleted and reinserted every loop
+        query = ("INSERT INTO standings (game_id, owner, portfolio_value) VALUES {values} "
+                 "ON DUPLICATE KEY UPDATE portfolio_value = VALUES(portfolio_value)".format(values=values_sql))
         db_connection.cursor.execute(query, sql_args)
 
+        recorded_points = record_standings_history(db_connection, game_leader_boards, standings_time)
+
         db_connection.connection.commit()
         db_connection.connection.close()
 
+        for history_key, point in recorded_points:
+            standings_history_last_points[history_key] = point
+
+def record_standings_history(db_connection, game_leader_boards, standings_time):
+    """
+    Appends the leader boards to standings_history at minute, hour and day resolution.
+    A row is only written when the player's value or rank changed since the last row of the resolution, whatever
+    the bucket, so idle players cost nothing. A change within a bucket overwrites the bucket's row
+    :param db_connection: the open connection to write with. The caller commits
+    :param game_leader_boards: dictionary of game_id to the leader board to record
+    :param standings_time: the unix time the leader boards are as of
+    :return: list of (history key, point) written, to be saved to standings_history_last_points once committed
+    """
+    values_sql = ""
+    sql_args = []
+    recorded = []
+
+    for game_id, leader_board in game_leader_boards.items():
+        # rank only sorts the values, players tied on value share a rank
+        for owner, portfolio_value in leader_board.portfolio_values.items():
+            value_cents = fixed_to_cents(portfolio_value)
+            standing_rank = leader_board.rank(owner)
+            for resolution, bucket_sec in STANDINGS_HISTORY_RESOLUTIONS:
+                bucket_timestamp = int(standings_time) // bucket_sec * bucket_sec
+                history_key = (game_id, owner, resolution)
+                point = (bucket_timestamp, value_cents, standing_rank)
+                last_point = standings_history_last_points.get(history_key)
+                if last_point is not None and last_point[1:] == point[1:]:
+                    continue
+
+                values_sql += "(%s, %s, %s, %s, %s, %s),"
+                sql_args.extend([game_id, owner, resolution, bucket_timestamp, value_cents, standing_rank])
+                recorded.append((history_key, point))
+
+    if recorded:
+        query = ("INSERT INTO standings_history (game_id, owner, resolution, bucket_timestamp, value_cents, standing_rank) "
+                 "VALUES {values} "
+                 "ON DUPLICATE KEY UPDATE value_cents = VALUES(value_cents), standing_rank = VALUES(standing_rank)".format(
+                     values=values_sql[:-1]))
+        db_connection.cursor.execute(query, sql_args)
+
+    return recorded
+
+def prune_standings_history():
+    """
+    Deletes minute and hour points that are older than their resolution's retention. Runs at most once an hour
+    """
+    global standings_history_last_prune_time
+
+    current_time = time.time()
+    if current_time - standings_history_last_prune_time < 3600:
+        return
+
+    db_connection = DbConnection()
+    # Each player's latest point is kept however old it is since an idle player's value carries forward from it
+    query = ("DELETE standings_history FROM standings_history "
+             "JOIN (SELECT game_id, owner, MAX(bucket_timestamp) AS last_bucket_timestamp FROM standings_history "
+             "WHERE resolution = %s GROUP BY game_id, owner) AS last_point "
+             "ON last_point.game_id = standings_history.game_id AND last_point.owner = standings_history.owner "
+             "WHERE standings_history.resolution = %s AND standings_history.bucket_timestamp < %s AND "
+             "standings_history.bucket_timestamp < last_point.last_bucket_timestamp")
+    for resolution, retention_sec in STANDINGS_HISTORY_RETENTION_SEC:
+        db_connection.cursor.execute(query, [resolution, resolution, int(current_time - retention_sec)])
+    db_connection.connection.commit()
+    db_connection.connection.close()
+
+    standings_history_last_prune_time = current_time
+
+def get_value_curve(submission_id, username, resolution = STANDINGS_RESOLUTION_HOUR, since = 0):
+    """
+    Returns a player's portfolio value over time. Only points where the value or rank changed are stored
+    so each value holds until the next point. The first point is the value held at since
+    :param submission_id: the game to get the curve for
+    :param username: the player to get the curve for
+    :param resolution: STANDINGS_RESOLUTION_MINUTE, STANDINGS_RESOLUTION_HOUR or STANDINGS_RESOLUTION_DAY
+    :param since: only return points at or after this unix time
+    :return: list of (bucket_timestamp, fixed point portfolio value) tuples in time order
+    """
+    curve = []
+    for standing_point in get_standings_history(submission_id, username, resolution, since):
+        curve.append((standing_point["bucket_timestamp"], cents_to_fixed(standing_point["value_cents"])))
+    return curve
+
+def get_rank_history(submission_id, username, resolution = STANDINGS_RESOLUTION_HOUR, since = 0):
+    """
+    Returns a player's leader board rank over time. The first point is the rank held at since
+    :param submission_id: the game to get the ranks for
+    :param username: the player to get the ranks for
+    :param resolution: STANDINGS_RESOLUTION_MINUTE, STANDINGS_RESOLUTION_HOUR or STANDINGS_RESOLUTION_DAY
+    :param since: only return points at or after this unix time
+    :return: list of (bucket_timestamp, rank) tuples in time order
+    """
+    ranks = []
+    for standing_point in get_standings_history(submission_id, username, resolution, since):
+        ranks.append((standing_point["bucket_timestamp"], standing_point["standing_rank"]))
+    return ranks
+
+def get_standings_history(submission_id, username, resolution, since):
+    """
+    Reads a player's history points with primary key range scans. Points are only written on a change so the
+    last point before since is returned too, moved up to since, as the value and rank held at since
+    :return: standings_history rows in time order
+    """
+    game_id = get_game_id(submission_id)
+    db_connection = DbConnection()
+    query = ("SELECT bucket_timestamp, value_cents, standing_rank FROM standings_history "
+             "WHERE game_id = %s AND owner = %s AND resolution = %s AND bucket_timestamp < %s "
+             "ORDER BY bucket_timestamp DESC LIMIT 1")
+    db_connection.cursor.execute(query, [game_id, username, resolution, int(since)])
+    standings_history = list(db_connection.cursor.fetchall())
+    for standing_point in standings_history:
+        standing_point["bucket_timestamp"] = int(since)
+
+    query = ("SELECT bucket_timestamp, value_cents, standing_rank FROM standings_history "
+             "WHERE game_id = %s AND owner = %s AND resolution = %s AND bucket_timestamp >= %s "
+             "ORDER BY bucket_timestamp ASC")
+    db_connection.cursor.execute(query, [game_id, username, resolution, int(since)])
+    in_range_points = db_connection.cursor.fetchall()
+    db_connection.connection.close()
+
+    if in_range_points and standings_history and in_range_points[0]["bucket_timestamp"] == int(since):
+        standings_history = []
+    standings_history.extend(in_range_points)
+    return standings_history
+
 def get_submission_record(submission_id):
     """
     Retreive game from the DB
@@ -1222,24 +3001,43 @@ def get_processed_comments(submission_id):
     return processed_comments
 
 def update_leader_boards():
+    """
+    :return: TICK_LOAD_IDLE when there are no live games
+    """
+    load = TICK_LOAD_NORMAL
     try:
         current_games = get_current_games()
-        for current_game in current_games:
-            update_leader_board(current_game)
+        current_datetime = time.time()
+        live_games = [current_game for current_game in current_games
+                      if current_datetime < calendar.timegm(current_game["game_end_datetime"].utctimetuple())]
+        # Ended games get their final leader board from close_games
+        for current_game in live_games:
+            with LogFields(game_id=current_game["game_id"]):
+                update_leader_board(current_game)
+
+        if not live_games:
+            load = TICK_LOAD_IDLE
+
+        prune_standings_history()
     except Exception as err:
         logger.exception("Unknown Exception in update_leader_boards")
 
+    return load
+
 def update_games_current_prices():
+    """
+    :return: TICK_LOAD_IDLE when there are no current games
+    """
+    load = TICK_LOAD_NORMAL
     try:
-        all_currencies = []
         current_games = get_current_games()
+        if not current_games:
+            load = TICK_LOAD_IDLE
 
-        for current_game in current_games:
-            currencies = get_currencies(current_game["submission_id"])
-            all_currencies.extend(currencies)
-
-        all_currencies.extend(common_currencies)
+        all_currencies = get_active_games_currencies()
+        all_currencies.extend(currency for currency in common_currencies if currency not in all_currencies)
         currencies_usd_value = get_currencies_current_usd_value(all_currencies)
+        price_snapshot.update(currencies_usd_value)
 
         for current_game in current_games:
             update_current_prices(current_game["submission_id"], currencies_usd_value)
@@ -1247,6 +3045,8 @@ def update_games_current_prices():
     except Exception as err:
         logger.exception("Unknown Exception in update_leader_boards")
 
+    return load
+
 def update_current_prices(submission_id, currencies_usd_value):
     submission = reddit.submission(id=submission_id)
 
@@ -1284,10 +3084,12 @@ def get_currencies_table_text(currencies_usd_value):
 
     return table_header + table_body
 
-def process_limit_order(limit_order):
+def process_limit_order(limit_order, current_price):
     """
     Checks if the limit_order needs to be processed and does so if needed
     :param limit_order: the limit_order to process
+    :param current_price: the current price of the limit_order's currency pair
+    :return: True if the limit_order is still open and due again by the next tick
     """
     limit_order_id = limit_order["limit_order_id"]
     buy_currency = limit_order["buy_currency"]
@@ -1296,66 +3098,304 @@ def process_limit_order(limit_order):
     comment_id = limit_order["comment_id"]
     current_time =  time.time()
 
-    current_price = get_trading_price(buy_currency, sell_currency, current_time)
-
     if current_price <= limit_price:
-        message = reddit.comment(comment_id)
-        limit_order_executed = execute_limit_order(limit_order)
+        # Orders that fail to execute are due again next tick
+        limit_order_index.forget(limit_order_id)
+        with LogFields(game_id=limit_order["game_id"], comment_id=comment_id):
+            limit_order_executed = execute_limit_order(limit_order)
 
-        if limit_order_executed:
-            portfolio_summary = get_portfolio_summary(message.parent().id, message.author.name)
-            message.reply("Limit order executed! "
-                          "Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
-                portfolio_summary=portfolio_summary
-            ))
-        else:
+        if not limit_order_executed:
             send_dev_pm("Error Executing Limit Order", "Could not execute limit_order with id: {limit_order_id}".format(
                 limit_order_id=limit_order_id
             ))
+        input_recorder.record("limit_trigger", comment_id=comment_id, price=current_price)
+        return False
+
+    recheck_sec = limit_order_index.schedule(limit_order_id, (buy_currency, sell_currency),
+                                             float(limit_price), current_price, current_time)
+    return recheck_sec < TICK_INTERVALS_SEC["execute_limit_orders"][0]
 
 def execute_limit_orders():
     """
-    checks if limit orders should be processed and processes them if so
+    checks if limit orders should be processed and processes them if so.
+    Only orders the limit_order_index says are due are priced, with one price fetch per currency pair
+    :return: TICK_LOAD_BUSY when an open order is close to its limit price, TICK_LOAD_IDLE when there are none
     """
+    load = TICK_LOAD_NORMAL
     try:
         current_games = get_current_games()
-        limit_order_threads = []
+        open_limit_orders = []
         for current_game in current_games:
             current_game_id = current_game["submission_id"]
-            limit_orders = get_all_open_limit_orders(current_game_id)
-            for limit_order in limit_orders:
-                # Thread api calls because they take a while in succession
-                t = Thread(target=process_limit_order,
-                           args=[limit_order])
-                limit_order_threads.append(t)
-                t.start()
-
-        # Wait for all limit_orders
-        for price_thread in limit_order_threads:
-            price_thread.join()
+            open_limit_orders.extend(get_all_open_limit_orders(current_game_id))
+        limit_order_index.retain(limit_order["limit_order_id"] for limit_order in open_limit_orders)
+
+        current_time = time.time()
+        due_limit_orders = [limit_order for limit_order in open_limit_orders
+                            if limit_order_index.is_due(limit_order["limit_order_id"], current_time)]
+        metrics.set_gauge("limit_orders_open", len(open_limit_orders))
+        metrics.set_gauge("limit_orders_checked", len(due_limit_orders))
+
+        # Run api calls in parallel because they take a while in succession
+        pairs = sorted(set((limit_order["buy_currency"], limit_order["sell_currency"]) for limit_order in due_limit_orders))
+        pair_prices = price_pool.run_all(get_trading_price, [[buy_currency, sell_currency, current_time]
+                                                             for buy_currency, sell_currency in pairs])
+        current_prices = {}
+        for pair, pair_price in zip(pairs, pair_prices):
+            # get_trading_price returns -1 on API errors. Those orders stay due and are retried next tick
+            if pair_price is not None and pair_price > 0:
+                limit_order_index.record_price(pair, pair_price, current_time)
+                current_prices[pair] = pair_price
+
+        limit_order_args = []
+        for limit_order in due_limit_orders:
+            pair = (limit_order["buy_currency"], limit_order["sell_currency"])
+            if pair in current_prices:
+                limit_order_args.append([limit_order, current_prices[pair]])
+
+        # Prices were fetched on the price pool, the fills are DB transactions
+        near_trigger_results = db_pool.run_all(process_limit_order, limit_order_args)
+        near_trigger_count = sum(1 for near_trigger in near_trigger_results if near_trigger)
+        metrics.set_gauge("limit_orders_near_trigger", near_trigger_count)
+
+        if not open_limit_orders:
+            load = TICK_LOAD_IDLE
+        elif near_trigger_count:
+            load = TICK_LOAD_BUSY
 
     except Exception as err:
         logger.exception("Unknown Exception in execute_limit_orders")
 
+    return load
+
 
 
 def close_games():
     """
-    closes games if they are past the end date
+    closes games if they are past the end date.
+    Games ending at the same time share one historical price fetch and their standings, post edits
+    and completion are written as a batch
+    :return: TICK_LOAD_IDLE when there are no current games
     """
+    load = TICK_LOAD_NORMAL
     try:
+        current_datetime = time.time()
+        games_by_end_time = {}
         current_games = get_current_games()
+        if not current_games:
+            load = TICK_LOAD_IDLE
+
         for current_game in current_games:
-            current_datetime = time.time()
             game_end_datetime = calendar.timegm(current_game["game_end_datetime"].utctimetuple())
 
             if current_datetime >= game_end_datetime:
-                close_game(current_game["submission_id"])
+                games_by_end_time.setdefault(game_end_datetime, []).append(current_game["submission_id"])
 
+        for game_end_datetime, submission_ids in sorted(games_by_end_time.items()):
+            close_games_ending_at(game_end_datetime, submission_ids)
 
     except Exception as err:
         logger.exception("Unknown Exception in close_games")
 
+    return load
+
+def close_games_ending_at(game_end_datetime, submission_ids):
+    """
+    Computes the final standings and closes all the games that ended at game_end_datetime
+    :param game_end_datetime: the unix timestamp the games ended at
+    :param submission_ids: the ids of the games that ended at game_end_datetime
+    """
+    currencies_by_game = {}
+    all_currencies = set()
+    for submission_id in submission_ids:
+        currencies_by_game[submission_id] = get_currencies(submission_id)
+        all_currencies.update(currencies_by_game[submission_id])
+
+    currencies_usd_value = {}
+    if all_currencies:
+        currencies_usd_value = to_fixed_prices(
+            get_currencies_historical_usd_value(sorted(all_currencies), int(game_end_datetime)))
+
+    leader_boards = {}
+    for submission_id in submission_ids:
+        if any(currency not in currencies_usd_value for currency in currencies_by_game[submission_id]):
+            # Never close a game on a partial price vector. It is retried on the next loop
+            logger.error("Missing final prices for game {submission_id}. Will retry.".format(submission_id=submission_id))
+            continue
+        leader_boards[submission_id] = get_leader_board(submission_id, game_end_datetime, currencies_usd_value)
+
+    update_leader_board_tables(leader_boards, game_end_datetime)
+
+    closed_submission_ids = []
+    for submission_id, leader_board in leader_boards.items():
+        try:
+            edit_leader_board(submission_id, render_leader_board_text(leader_board, True, get_game_stats(submission_id)))
+            set_winner_flair(submission_id, leader_board.leader() or "None")
+            closed_submission_ids.append(submission_id)
+        except Exception as err:
+            logger.exception("Could not close game {submission_id}".format(submission_id=submission_id))
+
+    complete_games(closed_submission_ids)
+
+
+def export_game_snapshot(game_id):
+    """
+    Writes the game's rows in SNAPSHOT_TABLES to SNAPSHOT_DIR/game_{game_id} as one .npy file per column.
+    All tables are read in one consistent snapshot transaction and the directory is swapped in whole
+    :param game_id: the game to export. Archived games are read from the archive tables
+    :return: the snapshot directory
+    """
+    db_connection = DbConnection()
+    db_connection.cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT", [])
+    db_connection.cursor.execute("SELECT submission_id, archived FROM game_submission WHERE game_id = %s", [game_id])
+    game_submission = db_connection.cursor.fetchall()[0]
+    table_suffix = "_archive" if to_bit_int(game_submission["archived"]) else ""
+
+    table_rows = {}
+    for table, columns in SNAPSHOT_TABLES:
+        query = "SELECT {columns} FROM {table}{table_suffix} WHERE game_id = %s ORDER BY {order_column}".format(
+            columns=", ".join(column for column, column_kind in columns),
+            table=table,
+            table_suffix=table_suffix,
+            order_column=columns[0][0])
+        db_connection.cursor.execute(query, [game_id])
+        table_rows[table] = db_connection.cursor.fetchall()
+    db_connection.connection.commit()
+    db_connection.connection.close()
+
+    snapshot_path = os.path.join(SNAPSHOT_DIR, "game_{game_id}".format(game_id=game_id))
+    temp_path = "{snapshot_path}.tmp-{pid}".format(snapshot_path=snapshot_path, pid=os.getpid())
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+
+    string_codes = {}
+    manifest = {"game_id": game_id,
+                "submission_id": game_submission["submission_id"],
+                "export_time": int(time.time()),
+                "tables": {}}
+    for table, columns in SNAPSHOT_TABLES:
+        rows = table_rows[table]
+        manifest["tables"][table] = {"rows": len(rows), "columns": dict(columns)}
+        for column, column_kind in columns:
+            values = [to_snapshot_value(row[column], column_kind, string_codes) for row in rows]
+            write_npy_column(os.path.join(temp_path, "{table}.{column}.npy".format(table=table, column=column)),
+                             column_kind, values)
+
+    manifest["strings"] = sorted(string_codes, key=string_codes.get)
+    with open(os.path.join(temp_path, "manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    shutil.rmtree(snapshot_path, ignore_errors=True)
+    os.rename(temp_path, snapshot_path)
+    logger.info("exported snapshot of game {game_id} to {snapshot_path}".format(game_id=game_id, snapshot_path=snapshot_path))
+    return snapshot_path
+
+def archive_completed_games():
+    """
+    Moves the rows of games that completed more than ARCHIVE_AFTER_SEC ago into the archive tables so queries
+    on the live tables only scale with active games. Runs once an hour on the tick scheduler
+    """
+    try:
+        db_connection = DbConnection()
+        query = ("SELECT game_id, submission_id FROM game_submission "
+                 "WHERE complete = true AND archived = false AND game_end_datetime < UTC_TIMESTAMP() - INTERVAL %s SECOND")
+        db_connection.cursor.execute(query, [ARCHIVE_AFTER_SEC])
+        archivable_games = db_connection.cursor.fetchall()
+        db_connection.connection.close()
+
+        for archivable_game in archivable_games:
+            archive_game(archivable_game["game_id"])
+    except Exception as err:
+        logger.exception("Unknown Exception in archive_completed_games")
+
+def archive_game(game_id):
+    """
+    Moves every row of the game in ARCHIVE_TABLES to its archive table in chunks. Each chunk is copied and deleted
+    in one transaction so a failure never loses or duplicates rows. The game is only marked archived once the
+    row counts are verified
+    :param game_id: the completed game to archive
+    :return: True if the game was archived and verified
+    """
+    # The final state of every archived game is kept for offline analysis
+    try:
+        export_game_snapshot(game_id)
+    except Exception as err:
+        logger.exception("Could not export snapshot for game {game_id}".format(game_id=game_id))
+
+    expected_archive_counts = {}
+    for table, id_column in ARCHIVE_TABLES:
+        expected_archive_counts[table] = sum(count_game_rows(game_id, table))
+
+    for table, id_column in ARCHIVE_TABLES:
+        while move_game_rows_chunk(game_id, table, id_column):
+            pass
+
+    for table, id_column in ARCHIVE_TABLES:
+        live_count, archive_count = count_game_rows(game_id, table)
+        if live_count != 0 or archive_count != expected_archive_counts[table]:
+            logger.error("Archive verification failed for game {game_id} table {table}".format(game_id=game_id, table=table))
+            send_dev_pm("Crypto Trading Game: Archive Verification Failed",
+                        "Game {game_id} table {table} has {live_count} live rows and {archive_count} archived rows. "
+                        "Expected 0 and {expected_count}.".format(game_id=game_id,
+                                                                 table=table,
+                                                                 live_count=live_count,
+                                                                 archive_count=archive_count,
+                                                                 expected_count=expected_archive_counts[table]))
+            return False
+
+    db_connection = DbConnection()
+    query = "UPDATE game_submission SET archived = true WHERE game_id = %s"
+    db_connection.cursor.execute(query, [game_id])
+    db_connection.connection.commit()
+    db_connection.connection.close()
+
+    latest_leader_boards.pop(game_id, None)
+    player_onboarding.forget_game(game_id)
+    portfolio_summary_cache.forget_game(game_id)
+    logger.info("Archived game {game_id}".format(game_id=game_id))
+    return True
+
+def move_game_rows_chunk(game_id, table, id_column):
+    """
+    Moves up to ARCHIVE_CHUNK_SIZE of the game's rows from table to its archive table
+    :param game_id: the game to move rows for
+    :param table: the live table
+    :param id_column: the primary key of table
+    :return: True if rows were moved
+    """
+    db_connection = DbConnection()
+    query = ("SELECT MAX({id_column}) AS chunk_end FROM "
+             "(SELECT {id_column} FROM {table} WHERE game_id = %s ORDER BY {id_column} ASC LIMIT %s) chunk".format(
+                 table=table, id_column=id_column))
+    db_connection.cursor.execute(query, [game_id, ARCHIVE_CHUNK_SIZE])
+    chunk_end = db_connection.cursor.fetchall()[0]["chunk_end"]
+
+    if chunk_end is None:
+        db_connection.connection.close()
+        return False
+
+    query = ("INSERT INTO {table}_archive SELECT * FROM {table} WHERE game_id = %s AND {id_column} <= %s".format(
+        table=table, id_column=id_column))
+    db_connection.cursor.execute(query, [game_id, chunk_end])
+    query = "DELETE FROM {table} WHERE game_id = %s AND {id_column} <= %s".format(table=table, id_column=id_column)
+    db_connection.cursor.execute(query, [game_id, chunk_end])
+
+    db_connection.connection.commit()
+    db_connection.connection.close()
+    return True
+
+def count_game_rows(game_id, table):
+    """
+    :return: tuple of (rows for the game in table, rows for the game in the archive of table)
+    """
+    db_connection = DbConnection()
+    query = ("SELECT (SELECT COUNT(*) FROM {table} WHERE game_id = %s) AS live_count, "
+             "(SELECT COUNT(*) FROM {table}_archive WHERE game_id = %s) AS archive_count".format(table=table))
+    db_connection.cursor.execute(query, [game_id, game_id])
+    counts = db_connection.cursor.fetchall()[0]
+    db_connection.connection.close()
+
+    return counts["live_count"], counts["archive_count"]
 
 def create_new_games():
     """
@@ -1363,7 +3403,8 @@ def create_new_games():
     This is done so the schedule can be kept by automoderator scheduling and not this script
     """
     try:
-        for submission in reddit.subreddit(CRYPTO_GAME_SUBREDDIT).new():
+        new_submissions = subreddit_metadata.get_new_submissions(CRYPTO_GAME_SUBREDDIT)
+        for submission in new_submissions:
             if "[Placeholder]" in submission.title:
                 begin_datetime = datetime.utcfromtimestamp(submission.created_utc)
                 end_datetime = None
@@ -1382,126 +3423,721 @@ def create_new_games():
                 create_new_game(begin_datetime, end_datetime, title_description)
 
                 submission.mod.remove()
+
+        # Only advanced once every placeholder was handled so a failure is rescanned next loop
+        subreddit_metadata.advance_submission_cursor(new_submissions)
     except Exception as err:
         logger.exception("Unknown Exception in create_new_games")
 
 
 def execute_limit_order(limit_order):
     """
-    Executes the limit order by making closing the limit order and adding the appropriate funds to the owners portfolio
+    Executes the limit order by making closing the limit order and adding the appropriate funds to the owners portfolio.
+    The owner is replied to once the trade is committed
     :param limit_order: The limit order table row to execute
-    :return:
+    :return: True if the trade was executed
     """
-    limit_order_id = limit_order["limit_order_id"]
-    game_id = limit_order["game_id"]
-    owner = limit_order["owner"]
-    buy_amount = limit_order["buy_amount"]
-    sell_amount = limit_order["sell_amount"]
-    buy_currency = limit_order["buy_currency"]
-    sell_currency = limit_order["sell_currency"]
-    comment_id = limit_order["comment_id"]
-
-
-    db_connection = DbConnection()
-    query = "UPDATE limit_order SET executed = true WHERE limit_order_id = %s"
-    db_connection.cursor.execute(query, [limit_order_id])
-
-    trade_executed = execute_trade(comment_id, owner, buy_amount, buy_currency,
-                  sell_amount, sell_currency, True, game_id = game_id)
-    if trade_executed:
-        db_connection.connection.commit()
-    else:
-        logger.error("Could not execute trade")
-        db_connection.connection.rollback()
-
-    db_connection.connection.close()
+    # Closing the order and the trade it fills commit together
+    request_context = RequestContext()
+    try:
+        executed_limit_order = get_game_engine(request_context).execute_limit_order(limit_order["limit_order_id"])
+        if executed_limit_order is not None:
+            portfolio_summary = get_portfolio_summary(get_submission_id(executed_limit_order["game_id"]),
+                                                      executed_limit_order["owner"], request_context)
+            request_context.reply(reddit.comment(executed_limit_order["comment_id"]), "Limit order executed! "
+                                  "Here is the current state of your portfolio:\n\n{portfolio_summary}".format(
+                portfolio_summary=portfolio_summary
+            ))
+            request_context.commit()
+        else:
+            logger.error("Could not execute trade")
+    finally:
+        request_context.close()
 
-    return trade_executed
+    return executed_limit_order is not None
 
 def process_game_messages():
+    """
+    :return: TICK_LOAD_BUSY when new comments were found, TICK_LOAD_IDLE when there were none
+    """
+    load = TICK_LOAD_NORMAL
     try:
+        symbol_index.refresh_if_stale()
         current_games = get_current_games()
+        pending_comments = []
+        harvest_request_budget = COMMENT_HARVEST_REQUESTS_PER_TICK
+        hidden_comments_left = 0
         for current_game in current_games:
             submission_id = current_game["submission_id"]
-            unprocessed_comments = get_unprocessed_comments(submission_id)
-            for unprocessed_comment in unprocessed_comments:
-                message_request = MessageRequest(unprocessed_comment)
-                message_request.process()
+            unprocessed_comments, request_count, game_hidden_comments_left = get_unprocessed_comments(submission_id, harvest_request_budget)
+            harvest_request_budget -= request_count
+            hidden_comments_left += game_hidden_comments_left
+            metrics.increment("more_comments_requests", request_count)
+            pending_comments.extend(unprocessed_comments)
+            enqueue_commands(submission_id, unprocessed_comments)
+            # New players get their starting USD in one insert per game instead of one per command
+            player_onboarding.onboard_commenters(get_game_id(submission_id), unprocessed_comments)
+        comment_backlog_depth = len(pending_comments)
+        metrics.set_gauge("comment_backlog_depth", comment_backlog_depth)
+        metrics.set_gauge("hidden_comments_left", hidden_comments_left)
+
+        plan_historical_backfill(pending_comments)
+
+        process_command_queue()
+
+        load = TICK_LOAD_BUSY if comment_backlog_depth or hidden_comments_left else TICK_LOAD_IDLE
     except Exception as err:
         logger.exception("Unknown Exception in process_game_messages")
 
-def get_unprocessed_comments(submission_id):
-    submission = reddit.submission(id = submission_id)
-    submission.comment_sort = 'old'
-    top_level_comments = list(submission.comments)
+    return load
+
+def get_unprocessed_comments(submission_id, request_budget):
+    """
+    :param submission_id: the game to get the comments of
+    :param request_budget: the most MoreComments requests to make
+    :return: tuple of (unprocessed top level comments oldest first, MoreComments requests made, hidden comments left)
+    """
+    processed_comment_ids = set(processed_comment["comment_id"] for processed_comment in get_processed_comments(submission_id))
+    return comment_harvester.harvest(submission_id, processed_comment_ids, request_budget)
 
-    processed_comments = get_processed_comments(submission_id)
-    unprocessed_comments = []
+def enqueue_commands(submission_id, comments):
+    """
+    Persists comments to the command_queue so they survive a restart. The comment_id is the idempotency key
+    so enqueueing a comment that is already queued does nothing
+    :param submission_id: the game the comments were made in
+    :param comments: the reddit comments to enqueue
+    """
+    if not comments:
+        return
+
+    values_sql = ""
+    sql_args = []
+    for comment in comments:
+        values_sql += "(%s, %s, %s, %s, %s, %s, UTC_TIMESTAMP()),"
+        sql_args.extend([comment.id,
+                         submission_id,
+                         comment.author.name if comment.author is not None else DELETED_COMMENT_OWNER,
+                         comment.body,
+                         comment.created_utc,
+                         COMMAND_STATUS_PENDING])
+    values_sql = values_sql[:-1]
+
+    db_connection = DbConnection()
+    query = ("INSERT IGNORE INTO command_queue (comment_id, submission_id, owner, body, created_utc, status, next_attempt_datetime) "
+             "VALUES {values}".format(values=values_sql))
+    db_connection.cursor.execute(query, sql_args)
+    db_connection.connection.commit()
+    db_connection.connection.close()
 
-    for top_level_comment in top_level_comments:
-        comment_processed = False
-        for processed_comment in processed_comments:
-            if top_level_comment.id == processed_comment["comment_id"]:
-                comment_processed = True
+def process_command_queue():
+    """
+    Drains the command_queue with COMMAND_QUEUE_WORKERS tasks on the db pool.
+    Commands are partitioned by owner so one user's commands are never processed concurrently
+    """
+    close_completed_game_commands()
+    db_pool.run_all(command_queue_worker, [[worker_index] for worker_index in range(COMMAND_QUEUE_WORKERS)])
+
+def close_completed_game_commands():
+    """
+    Acks the commands whose game completed while they were waiting, for example while backing off when close_games
+    ran. They are replied to that the game is over instead of trading after the final standings were written
+    """
+    db_connection = DbConnection()
+    query = ("SELECT command_queue.*, game_submission.archived FROM command_queue "
+             "JOIN game_submission ON game_submission.submission_id = command_queue.submission_id "
+             "WHERE game_submission.complete = true AND "
+             "(command_queue.status = %s OR command_queue.lease_expire_datetime < UTC_TIMESTAMP()) "
+             "ORDER BY command_queue.command_queue_id ASC")
+    db_connection.cursor.execute(query, [COMMAND_STATUS_PENDING])
+    queued_commands = db_connection.cursor.fetchall()
+    db_connection.connection.close()
+
+    for queued_command in queued_commands:
+        comment_id = queued_command["comment_id"]
+        request_context = RequestContext()
+        try:
+            if not is_command_applied(comment_id) and queued_command["owner"] != DELETED_COMMENT_OWNER:
+                request_context.reply(QueuedComment(queued_command),
+                                      "This game is over so your command was not processed. "
+                                      "Please make your trades in the current game.")
+            # An archived game must not get live rows again or its archive counts would no longer match
+            if not to_bit_int(queued_command["archived"]):
+                add_to_processed(queued_command["submission_id"], comment_id, queued_command["body"], request_context)
+            query = "DELETE FROM command_queue WHERE command_queue_id = %s"
+            request_context.db_connection.cursor.execute(query, [queued_command["command_queue_id"]])
+            request_context.commit()
+        except Exception as err:
+            logger.exception("Could not close command {comment_id} of a completed game".format(comment_id=comment_id))
+        finally:
+            request_context.close()
+
+def command_queue_worker(worker_index):
+    """
+    Claims batches of commands for the owners in worker_index's partition until none are ready
+    :param worker_index: the partition of owners this worker processes
+    """
+    try:
+        # Stops between batches on shutdown. Unclaimed commands stay in the durable queue for the next process
+        while should_keep_running():
+            queued_commands = claim_queued_commands(worker_index)
+            if not queued_commands:
                 break
-        if not comment_processed:
-            unprocessed_comments.append(top_level_comment)
 
-    return unprocessed_comments
+            # Owners whose earlier command will be retried. Their later commands wait for it to keep them in order
+            retried_owners = set()
+            for queued_command in queued_commands:
+                if queued_command["owner"] in retried_owners:
+                    release_queued_command(queued_command)
+                    continue
+                with LogFields(game_id=get_game_id(queued_command["submission_id"]), comment_id=queued_command["comment_id"]):
+                    if not process_queued_command(queued_command):
+                        retried_owners.add(queued_command["owner"])
+    except Exception as err:
+        logger.exception("Unknown Exception in command_queue_worker")
+
+def claim_queued_commands(worker_index):
+    """
+    Leases up to COMMAND_QUEUE_BATCH_SIZE ready commands. Commands whose lease expired because the process
+    died while working on them are claimed again which makes processing at-least-once.
+    Owners with a command backing off or leased by someone else are skipped so their commands stay in order.
+    Commands of completed games are never claimed, close_completed_game_commands acks them
+    :param worker_index: the partition of owners to claim commands for
+    :return: the claimed command_queue rows
+    """
+    lease_owner = "{pid}-{uuid}".format(pid=os.getpid(), uuid=uuid.uuid4().hex)
+
+    db_connection = DbConnection()
+    # DISTINCT keeps MySQL from merging the derived table, which it can not do for the table being updated
+    query = ("UPDATE command_queue "
+             "SET status = %s, lease_owner = %s, lease_expire_datetime = UTC_TIMESTAMP() + INTERVAL %s SECOND "
+             "WHERE ((status = %s AND next_attempt_datetime <= UTC_TIMESTAMP()) OR "
+             "(status = %s AND lease_expire_datetime < UTC_TIMESTAMP())) AND "
+             "MOD(CRC32(owner), %s) = %s AND "
+             "submission_id IN (SELECT submission_id FROM game_submission WHERE complete = false) AND "
+             "owner NOT IN (SELECT owner FROM ("
+             "SELECT DISTINCT owner FROM command_queue "
+             "WHERE (status = %s AND next_attempt_datetime > UTC_TIMESTAMP()) OR "
+             "(status = %s AND lease_expire_datetime >= UTC_TIMESTAMP())) AS waiting_owner) "
+             "ORDER BY command_queue_id ASC "
+             "LIMIT %s")
+    db_connection.cursor.execute(query, [COMMAND_STATUS_PROCESSING, lease_owner, COMMAND_QUEUE_LEASE_SEC,
+                                         COMMAND_STATUS_PENDING, COMMAND_STATUS_PROCESSING,
+                                         COMMAND_QUEUE_WORKERS, worker_index,
+                                         COMMAND_STATUS_PENDING, COMMAND_STATUS_PROCESSING,
+                                         COMMAND_QUEUE_BATCH_SIZE])
+    db_connection.connection.commit()
+
+    query = "SELECT * FROM command_queue WHERE lease_owner = %s AND status = %s ORDER BY command_queue_id ASC"
+    db_connection.cursor.execute(query, [lease_owner, COMMAND_STATUS_PROCESSING])
+    queued_commands = db_connection.cursor.fetchall()
+    db_connection.connection.close()
+
+    return queued_commands
+
+def process_queued_command(queued_command):
+    """
+    Processes a claimed command and acks, retries or dead letters it
+    :param queued_command: the command_queue row to process
+    :return: False if the command will be retried, True once it is done with
+    """
+    comment_id = queued_command["comment_id"]
+
+    if is_command_applied(comment_id):
+        # Applied before a crash but never acked. Record it as processed without replying again
+        add_to_processed(queued_command["submission_id"], comment_id, "")
+        complete_queued_command(queued_command)
+        return True
+
+    message_request = MessageRequest(QueuedComment(queued_command))
+    if message_request.process():
+        complete_queued_command(queued_command)
+        return True
+
+    return fail_queued_command(queued_command, message_request.error)
+
+def is_command_applied(comment_id):
+    """
+    :param comment_id: the id of the comment containing the command
+    :return: True if the command already changed game state or was already processed
+    """
+    db_connection = DbConnection()
+    query = ("SELECT comment_id FROM processed_comment WHERE comment_id = %s "
+             "UNION ALL SELECT comment_id FROM executed_trade WHERE comment_id = %s "
+             "UNION ALL SELECT comment_id FROM limit_order WHERE comment_id = %s "
+             "LIMIT 1")
+    rowcount = db_connection.cursor.execute(query, [comment_id, comment_id, comment_id])
+    db_connection.connection.close()
+
+    return rowcount > 0
+
+def complete_queued_command(queued_command):
+    """
+    Removes a successfully processed command from the queue
+    :param queued_command: the command_queue row that was processed
+    """
+    db_connection = DbConnection()
+    query = "DELETE FROM command_queue WHERE command_queue_id = %s"
+    db_connection.cursor.execute(query, [queued_command["command_queue_id"]])
+    db_connection.connection.commit()
+    db_connection.connection.close()
+
+def release_queued_command(queued_command):
+    """
+    Gives up the lease of a command that was claimed but not attempted, without counting an attempt
+    :param queued_command: the command_queue row to release
+    """
+    db_connection = DbConnection()
+    query = ("UPDATE command_queue SET status = %s, lease_owner = NULL, lease_expire_datetime = NULL "
+             "WHERE command_queue_id = %s")
+    db_connection.cursor.execute(query, [COMMAND_STATUS_PENDING, queued_command["command_queue_id"]])
+    db_connection.connection.commit()
+    db_connection.connection.close()
+
+def fail_queued_command(queued_command, error):
+    """
+    Schedules the command to be retried with exponential backoff or moves it to command_dead_letter
+    once COMMAND_QUEUE_MAX_ATTEMPTS is reached
+    :param queued_command: the command_queue row that failed
+    :param error: description of the failure
+    :return: True if the command was dead lettered, False if it will be retried
+    """
+    attempts = queued_command["attempts"] + 1
+    error = (error or "Unknown error")[:10000]
+
+    db_connection = DbConnection()
+    if attempts >= COMMAND_QUEUE_MAX_ATTEMPTS:
+        query = ("INSERT INTO command_dead_letter (comment_id, submission_id, owner, attempts, last_error) "
+                 "VALUES (%s, %s, %s, %s, %s)")
+        db_connection.cursor.execute(query, [queued_command["comment_id"], queued_command["submission_id"],
+                                             queued_command["owner"], attempts, error])
+        query = "DELETE FROM command_queue WHERE command_queue_id = %s"
+        db_connection.cursor.execute(query, [queued_command["command_queue_id"]])
+    else:
+        backoff_sec = min(COMMAND_QUEUE_BACKOFF_SEC * 2 ** (attempts - 1), COMMAND_QUEUE_MAX_BACKOFF_SEC)
+        query = ("UPDATE command_queue "
+                 "SET status = %s, attempts = %s, last_error = %s, lease_owner = NULL, lease_expire_datetime = NULL, "
+                 "next_attempt_datetime = UTC_TIMESTAMP() + INTERVAL %s SECOND "
+                 "WHERE command_queue_id = %s")
+        db_connection.cursor.execute(query, [COMMAND_STATUS_PENDING, attempts, error, backoff_sec,
+                                             queued_command["command_queue_id"]])
+    db_connection.connection.commit()
+    db_connection.connection.close()
+
+    if attempts >= COMMAND_QUEUE_MAX_ATTEMPTS:
+        # Mark it processed so the comment is not harvested and queued again
+        add_to_processed(queued_command["submission_id"], queued_command["comment_id"], "")
+        send_dev_pm("Crypto Trading Game: Could Not Process Message",
+                    "Moved comment {comment_id} to command_dead_letter after {attempts} attempts:\n\n{error}".format(
+                        comment_id=queued_command["comment_id"],
+                        attempts=attempts,
+                        error=error))
+
+    return attempts >= COMMAND_QUEUE_MAX_ATTEMPTS
 
 
 def process_pms():
+    """
+    Drains the whole unread inbox, processes PMs concurrently and marks everything that was handled read in batches.
+    Failed PMs stay unread and are retried until INBOX_MAX_ATTEMPTS
+    :return: TICK_LOAD_BUSY when there were unread messages, TICK_LOAD_IDLE when the inbox was empty
+    """
+    load = TICK_LOAD_NORMAL
     try:
-        for message in reddit.inbox.unread(limit = 100):
-            message.mark_read()
-            if not message.was_comment:
-                message_request = MessageRequest(message)
-                message_request.process()
+        unread_messages = list(reddit.inbox.unread(limit = None))
+        metrics.set_gauge("inbox_backlog_depth", len(unread_messages))
+
+        handled_messages = [message for message in unread_messages if message.was_comment]
+        pms = [message for message in unread_messages if not message.was_comment]
+
+        # PM commands run DB transactions so they go on the db pool like comment commands
+        pm_results = db_pool.run_all(process_pm, [[pm] for pm in pms])
+        for pm, handled in zip(pms, pm_results):
+            if handled:
+                handled_messages.append(pm)
+
+        mark_messages_read(handled_messages)
+
+        load = TICK_LOAD_BUSY if unread_messages else TICK_LOAD_IDLE
     except Exception as err:
         logger.exception("Unknown Exception in process_pms")
 
+    return load
+
+def process_pm(message):
+    """
+    :param message: the PM to process
+    :return: True if the PM should be marked read
+    """
+    message_request = MessageRequest(message)
+    with LogFields(comment_id=message.id):
+        processed = message_request.process()
+
+    if processed:
+        inbox_attempts.pop(message.id, None)
+        return True
+
+    attempts = inbox_attempts.get(message.id, 0) + 1
+    inbox_attempts[message.id] = attempts
+    if attempts >= INBOX_MAX_ATTEMPTS:
+        inbox_attempts.pop(message.id, None)
+        send_dev_pm("Crypto Trading Game: Could Not Process Message", message_request.error)
+        return True
+
+    return False
+
+def mark_messages_read(messages):
+    """
+    Marks messages read with one Reddit call per INBOX_MARK_READ_BATCH_SIZE messages
+    :param messages: the messages to mark read
+    """
+    for batch_start in range(0, len(messages), INBOX_MARK_READ_BATCH_SIZE):
+        reddit.inbox.mark_read(messages[batch_start:batch_start + INBOX_MARK_READ_BATCH_SIZE])
+
+def replay_recording(record_file):
+    """
+    Replays a recording made with record_file set through the same MessageRequest and process_limit_order code the
+    bot runs, as fast as it can. Writes to the configured database, which must be a DEV database without the
+    recorded games
+    :param record_file: the JSON lines file written by InputRecorder
+    :return: True if every recorded reply was reproduced
+    """
+    global reddit, replay_session
+
+    if ENVIRONMENT != "DEV":
+        logger.error("Replays write to the database so they only run in DEV")
+        return False
+
+    with open(record_file) as recording:
+        events = [json.loads(line) for line in recording if line.strip()]
+
+    game_events = [event for event in events if event["type"] == "game"]
+    db_connection = DbConnection()
+    for game_event in game_events:
+        db_connection.cursor.execute("SELECT game_id FROM game_submission WHERE submission_id = %s",
+                                     [game_event["submission_id"]])
+        if db_connection.cursor.fetchone():
+            db_connection.connection.close()
+            logger.error("Game {submission_id} is already in the database. Replay into a fresh DEV database".format(
+                submission_id=game_event["submission_id"]))
+            return False
+
+    for game_event in game_events:
+        cmd = ("INSERT INTO game_submission (subreddit, submission_id, author, game_begin_datetime, game_end_datetime, complete) "
+               "VALUES (%s, %s, %s, %s, %s, %s)")
+        db_connection.cursor.execute(cmd, (game_event["subreddit"],
+                                           game_event["submission_id"],
+                                           game_event["author"],
+                                           game_event["game_begin_datetime"],
+                                           game_event["game_end_datetime"],
+                                           False))
+    db_connection.connection.commit()
+    db_connection.connection.close()
+
+    # Nothing the replay does may reach Reddit, the price API or the recording
+    input_recorder.stop()
+    dev_alerter.sink = FileAlertSink()
+    replay_session = ReplaySession(events)
+    reddit = replay_session
+
+    symbols_events = [event for event in events if event["type"] == "symbols"]
+    symbol_index.replace(symbols_events[0]["symbols"] if symbols_events else load_coin_list_snapshot())
+
+    game_submission_ids = set(game_event["submission_id"] for game_event in game_events)
+    replayed_comment_ids = set()
+    failed_comment_ids = []
+    skipped_comment_count = 0
+    missing_limit_orders = []
+    limit_trigger_count = 0
+
+    replay_start_time = time.time()
+    for event in events:
+        replay_session.now = event["time"]
+        # Every command is valued with the quotes recorded up to when it ran, not with an earlier event's snapshot
+        price_snapshot.clear()
+
+        if event["type"] == "symbols":
+            symbol_index.replace(event["symbols"])
+        elif event["type"] == "comment":
+            if event["submission_id"] not in game_submission_ids:
+                # The game was created before recording started so its earlier commands are missing
+                skipped_comment_count += 1
+                continue
+
+            replayed_comment_ids.add(event["comment_id"])
+            with LogFields(comment_id=event["comment_id"]):
+                if not MessageRequest(replay_session.comment(event["comment_id"])).process():
+                    failed_comment_ids.append(event["comment_id"])
+        elif event["type"] == "limit_trigger" and event["comment_id"] in replayed_comment_ids:
+            limit_order = get_open_limit_order(event["comment_id"])
+            if limit_order is None:
+                missing_limit_orders.append(event["comment_id"])
+            else:
+                process_limit_order(limit_order, event["price"])
+                limit_trigger_count += 1
+    replay_sec = max(time.time() - replay_start_time, 0.000001)
+
+    mismatched_comment_ids = replay_session.get_mismatched_comment_ids(replayed_comment_ids)
+
+    print("Replayed {command_count} commands and {limit_trigger_count} limit order triggers in {replay_sec:.2f} sec, "
+          "{commands_per_sec:.1f} commands/sec".format(
+              command_count=len(replayed_comment_ids),
+              limit_trigger_count=limit_trigger_count,
+              replay_sec=replay_sec,
+              commands_per_sec=len(replayed_comment_ids) / replay_sec))
+    print("Skipped {skipped_count} commands of games created before recording started".format(
+        skipped_count=skipped_comment_count))
+    print("Failed commands: {comment_ids}".format(comment_ids=", ".join(failed_comment_ids) or "none"))
+    print("Triggered limit orders that were not open: {comment_ids}".format(
+        comment_ids=", ".join(missing_limit_orders) or "none"))
+    print("Comments whose replies differed from the recording: {comment_ids}".format(
+        comment_ids=", ".join(mismatched_comment_ids) or "none"))
+
+    for game_event in game_events:
+        submission_id = game_event["submission_id"]
+        currencies = get_currencies(submission_id)
+        currencies_usd_value = to_fixed_prices(replay_session.get_usd_prices(currencies))
+        if len(currencies_usd_value) < len(currencies):
+            print("Game {submission_id} cannot be valued because some of its currencies were never quoted in USD".format(
+                submission_id=submission_id))
+            continue
+
+        leader_board = get_leader_board(submission_id, replay_session.now, currencies_usd_value)
+        print("Game {submission_id} top {count} at the end of the recording:".format(
+            submission_id=submission_id, count=min(len(leader_board), 10)))
+        for rank, username, value in leader_board.page(1, 10):
+            print("{rank}. {username} ${value}".format(rank=rank, username=username, value=format_fixed_2f(value)))
+
+    return not (failed_comment_ids or missing_limit_orders or mismatched_comment_ids)
+
+def configure_logging():
+    """
+    Sends logger records through a queue to a listener thread that writes JSON lines to the rotating LOG_FILE
+    and warnings to stderr so no log I/O happens on the threads doing the work
+    :return: the started QueueListener. Stop it before exiting to flush the queue
+    """
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonLogFormatter())
+
+    stderr_handler = logging.StreamHandler()
+    stderr_handler.setLevel(logging.WARNING)
+    stderr_handler.setFormatter(logging.Formatter(FORMAT))
+
+    log_queue = queue.Queue()
+    queue_handler = AsyncQueueHandler(log_queue)
+    # Sampled first so dropped records skip the rest of the work
+    queue_handler.addFilter(LogSampler())
+    queue_handler.addFilter(CorrelationFilter())
+
+    logger.handlers = [queue_handler]
+    logger.propagate = False
+
+    log_listener = QueueListener(log_queue, file_handler, stderr_handler, respect_handler_level=True)
+    log_listener.start()
+    return log_listener
+
+def shutdown_worker_pools():
+    """
+    Cancels queued work in every worker pool and waits for running work to finish
+    """
+    # The alert pool goes last so alerts raised while the other pools finish are still sent
+    for worker_pool in (price_pool, db_pool, reddit_pool, alert_pool):
+        worker_pool.shutdown()
+
 def create_running_file():
     running_file = open(RUNNING_FILE, "w")
     running_file.write(str(os.getpid()))
     running_file.close()
 
+def get_running_file_pid():
+    """
+    :return: the pid holding the running file lease or None if there is no running file
+    """
+    try:
+        with open(RUNNING_FILE) as running_file:
+            return int(running_file.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+def has_running_lease():
+    """
+    :return: True if this process still holds the running file lease. Deleting the file or another process
+    taking it over ends the lease
+    """
+    return get_running_file_pid() == os.getpid()
+
+def should_keep_running():
+    return not shutdown_requested.is_set() and has_running_lease()
+
+def is_pid_running(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+def take_over_running_lease():
+    """
+    Takes the running file lease from the process holding it and asks that process to stop.
+    The old process finishes its current phase and exits while this one warms up
+    :return: the pid of the process that held the lease or None
+    """
+    old_pid = get_running_file_pid()
+    create_running_file()
+
+    if old_pid is not None and old_pid != os.getpid() and is_pid_running(old_pid):
+        logger.info("took over running lease from {pid}".format(pid=old_pid))
+        os.kill(old_pid, signal.SIGTERM)
+        return old_pid
+
+    return None
+
+def wait_for_pid_exit(pid):
+    """
+    Waits up to HANDOFF_TIMEOUT_SEC for pid to exit so two processes never work at the same time
+    """
+    handoff_deadline = time.time() + HANDOFF_TIMEOUT_SEC
+    while is_pid_running(pid) and time.time() < handoff_deadline:
+        time.sleep(0.5)
+
+    if is_pid_running(pid):
+        logger.error("process {pid} did not exit within {timeout} seconds of handoff".format(
+            pid=pid, timeout=HANDOFF_TIMEOUT_SEC))
+
+# The signal handlers only set flags. Logging from a handler can deadlock on a lock the interrupted code holds
+# so the main loop logs once it sees the flag
+
+def handle_shutdown_signal(signum, frame):
+    global shutdown_signal_number
+    shutdown_signal_number = signum
+    shutdown_requested.set()
+
+def handle_reload_signal(signum, frame):
+    reload_requested.set()
+
+def reload_config():
+    """
+    Rereads crypto_trading.cfg. Worker pools, caches and the Reddit session are kept unless the Reddit
+    credentials changed
+    """
+    global reddit, client_id, client_secret, bot_password, bot_username
+    global DB_USER, DB_PASS, DB_HOST, DB_DATABASE, ENVIRONMENT, CRYPTO_GAME_SUBREDDIT, DEV_USER_NAME
+
+    reload_requested.clear()
+    logger.info("received SIGHUP. Reloading config")
+    config.read("crypto_trading.cfg")
+
+    DB_USER = config.get("SQL", "user")
+    DB_PASS = config.get("SQL", "passwd")
+    DB_HOST = config.get("SQL", "host")
+    DB_DATABASE = config.get("SQL", "database")
+
+    ENVIRONMENT = config.get("CRYPTOTRADING", "environment")
+    CRYPTO_GAME_SUBREDDIT = config.get("CRYPTOTRADING", "subreddit")
+    if ENVIRONMENT == "DEV":
+        CRYPTO_GAME_SUBREDDIT = config.get("CRYPTOTRADING", "dev_subreddit")
+    DEV_USER_NAME = config.get("CRYPTOTRADING", "dev_user")
+
+    reddit_credentials = (config.get("Reddit", "client_id"),
+                          config.get("Reddit", "client_secret"),
+                          config.get("Reddit", "password"),
+                          config.get("Reddit", "username"))
+    if reddit_credentials != (client_id, client_secret, bot_password, bot_username):
+        client_id, client_secret, bot_password, bot_username = reddit_credentials
+        reddit = praw.Reddit(client_id=client_id,
+                             client_secret=client_secret,
+                             password=bot_password,
+                             user_agent='cryptoTradingGame by /u/BoyAndHisBlob',
+                             username=bot_username)
+
+    logger.info("config reloaded")
+
 
 # =============================================================================
 # MAIN
 # =============================================================================
 
 def main():
+    log_listener = configure_logging()
+
+    if "--export-snapshot" in sys.argv[1:]:
+        # One off export for offline analysis. The bot itself is not started
+        for game_id in sys.argv[sys.argv.index("--export-snapshot") + 1:]:
+            export_game_snapshot(int(game_id))
+        log_listener.stop()
+        sys.exit()
+
+    if "--replay" in sys.argv[1:]:
+        # Offline replay of a recording. The bot itself is not started
+        replayed = replay_recording(sys.argv[sys.argv.index("--replay") + 1])
+        shutdown_worker_pools()
+        log_listener.stop()
+        sys.exit(0 if replayed else 1)
+
     start_process = False
+    takeover = "--takeover" in sys.argv[1:]
     logger.info("start")
 
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+    signal.signal(signal.SIGHUP, handle_reload_signal)
+
     if ENVIRONMENT == "DEV" and os.path.isfile(RUNNING_FILE):
         os.remove(RUNNING_FILE)
         logger.info("running file removed")
 
-    if not os.path.isfile(RUNNING_FILE):
+    old_pid = None
+    if takeover:
+        old_pid = take_over_running_lease()
+        start_process = True
+    elif not os.path.isfile(RUNNING_FILE):
         create_running_file()
         start_process = True
     else:
         start_process = False
         logger.error("crypto processor already running! Will not start.")
 
-    while start_process and os.path.isfile(RUNNING_FILE):
+    if start_process:
+        # The old process keeps writing the counters until it exits
+        if old_pid is not None:
+            wait_for_pid_exit(old_pid)
+        try:
+            rebuild_game_counters()
+        except Exception as err:
+            logger.exception("Could not rebuild the game counters. Continuing with the stored counters")
+
+    main_loop_phases = (create_new_games,
+                        process_pms,
+                        process_game_messages,
+                        update_games_current_prices,
+                        update_leader_boards,
+                        execute_limit_orders,
+                        close_games,
+                        archive_completed_games)
+
+    tick_scheduler = TickScheduler(main_loop_phases, TICK_INTERVALS_SEC, metrics)
+
+    while start_process and should_keep_running():
         logger.info("Start Main Loop")
         try:
-            create_new_games()
-            process_pms()
-            process_game_messages()
-            update_games_current_prices()
-            update_leader_boards()
-            execute_limit_orders()
-            close_games()
-
-            logger.info("End Main Loop")
+            for main_loop_phase in tick_scheduler.due_phases():
+                if reload_requested.is_set():
+                    reload_config()
+                # Checked between phases so a shutdown or handoff never waits for a whole loop
+                if not should_keep_running():
+                    break
+                tick_scheduler.run(main_loop_phase)
+
+            logger.info("End Main Loop metrics: {metrics}".format(metrics=metrics.snapshot()))
         except Exception as err:
             logger.exception("Unknown Exception in Main Loop")
 
-        time.sleep(30)
+        shutdown_requested.wait(tick_scheduler.seconds_until_next_tick())
 
+    if shutdown_requested.is_set():
+        logger.info("received signal {signum}. Shutting down after the current phase".format(signum=shutdown_signal_number))
+    shutdown_worker_pools()
+    logger.info("stopped")
+    log_listener.stop()
     sys.exit()
 # =============================================================================
 # RUNNER
@@ -0,0 +1,536 @@
+#!/usr/bin/env python3.6
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+import os
+import sys
+import time
+import json
+import math
+import mmap
+import array
+import heapq
+import bisect
+import struct
+import calendar
+import operator
+from types import SimpleNamespace
+from threading import Lock, local
+
+# Only used to return snapshot columns as numpy arrays. Snapshots are written and read without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+
+# The parts of the bot that need neither Reddit, MySQL nor crypto_trading.cfg, so they can be imported and tested alone
+
+# Number of players shown in each !Standings page
+LEADER_BOARD_PAGE_ROWS = 50
+
+# A main loop phase that reports TICK_LOAD_BUSY halves its interval down to min and TICK_LOAD_IDLE doubles it up to max
+TICK_LOAD_IDLE = "IDLE"
+TICK_LOAD_NORMAL = "NORMAL"
+TICK_LOAD_BUSY = "BUSY"
+TICK_MIN_SLEEP_SEC = 1
+
+# Open limit orders are rechecked once a LIMIT_ORDER_RECHECK_SIGMAS move at the pair's recent volatility could reach
+# their limit price, never more than LIMIT_ORDER_MAX_RECHECK_SEC apart. Orders of pairs without a volatility yet
+# are checked every tick
+LIMIT_ORDER_RECHECK_SIGMAS = 4
+LIMIT_ORDER_MAX_RECHECK_SEC = 600
+LIMIT_ORDER_VOLATILITY_WEIGHT = 0.1
+
+# Snapshot column kind to (.npy descr, array/memoryview format)
+SNAPSHOT_COLUMN_FORMATS = {"int": ("<i8", "q"),
+                           "decimal": ("<f8", "d"),
+                           "str": ("<i4", "i"),
+                           "bool": ("|u1", "B"),
+                           "datetime": ("<i8", "q")}
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class LogFields(object):
+    """
+    Attaches correlation fields such as game_id, comment_id, phase and tick_id to every record the current thread
+    logs while the context is open. Worker pools carry the submitting thread's fields over to their tasks
+    """
+    _local = local()
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self._previous_fields = None
+
+    def __enter__(self):
+        self._previous_fields = LogFields.current()
+        fields = dict(self._previous_fields)
+        fields.update(self.fields)
+        LogFields._local.fields = fields
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        LogFields._local.fields = self._previous_fields
+
+    @staticmethod
+    def current():
+        """
+        :return: the correlation fields of the current thread
+        """
+        return getattr(LogFields._local, "fields", {})
+
+
+class Metrics(object):
+    """
+    Thread safe gauges and counters. Logged once per main loop
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._values = {}
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def increment(self, name, amount = 1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def snapshot(self):
+        """
+        :return: a copy of all the current metric values
+        """
+        with self._lock:
+            return dict(self._values)
+
+
+class LeaderBoard(object):
+    """
+    Players ranked by portfolio value. The top of the board comes from a heap so rendering the post is bounded
+    by the rows shown and the full order is only sorted when ranks or pages are needed
+    """
+
+    def __init__(self, portfolio_values):
+        self.portfolio_values = portfolio_values # username to fixed point portfolio value
+        self._ranked = None
+        self._negated_values = None
+
+    def __len__(self):
+        return len(self.portfolio_values)
+
+    def __iter__(self):
+        return iter(self.ranked())
+
+    def top(self, count):
+        """
+        :return: list of (username, value) tuples for the count best players
+        """
+        if self._ranked is not None:
+            return self._ranked[:count]
+        return heapq.nlargest(count, self.portfolio_values.items(), key=operator.itemgetter(1))
+
+    def leader(self):
+        """
+        :return: the username in first place or None if nobody is playing
+        """
+        top = self.top(1)
+        if top:
+            return top[0][0]
+        return None
+
+    def ranked(self):
+        """
+        :return: list of (username, value) tuples for every player sorted by value descending
+        """
+        if self._ranked is None:
+            self._ranked = sorted(self.portfolio_values.items(), key=operator.itemgetter(1), reverse=True)
+        return self._ranked
+
+    def rank(self, username):
+        """
+        :return: the 1 based rank of username or None if they are not playing
+        """
+        if username not in self.portfolio_values:
+            return None
+        if self._negated_values is None:
+            self._negated_values = sorted(-value for value in self.portfolio_values.values())
+        return bisect.bisect_left(self._negated_values, -self.portfolio_values[username]) + 1
+
+    def page(self, page_number, page_size = LEADER_BOARD_PAGE_ROWS):
+        """
+        :param page_number: 1 based page number
+        :return: list of (rank, username, value) tuples on the page
+        """
+        first_rank = (page_number - 1) * page_size + 1
+        ranked_page = self.ranked()[first_rank - 1:first_rank - 1 + page_size]
+        return [(rank, leader[0], leader[1]) for rank, leader in enumerate(ranked_page, first_rank)]
+
+    def page_count(self, page_size = LEADER_BOARD_PAGE_ROWS):
+        return max(1, (len(self) + page_size - 1) // page_size)
+
+
+class TickScheduler(object):
+    """
+    Runs the main loop phases on their own cadences. The time a phase takes comes out of its wait and missed ticks
+    are skipped instead of run back to back. Drift, overruns and skipped ticks go to metrics
+    """
+
+    def __init__(self, phases, intervals_sec, metrics):
+        """
+        :param phases: the phase functions in the order they run when several are due
+        :param intervals_sec: dictionary of phase name to (base, min, max) seconds between its ticks
+        :param metrics: the Metrics the ticks are reported to
+        """
+        current_time = time.time()
+        self._phases = phases
+        self._intervals_sec = intervals_sec
+        self.metrics = metrics
+        self._intervals = dict((phase, intervals_sec[phase.__name__][0]) for phase in phases)
+        self._next_due = dict((phase, current_time) for phase in phases)
+        self._tick_id = 0
+
+    def due_phases(self):
+        """
+        :return: the phases whose next tick has arrived
+        """
+        current_time = time.time()
+        return [phase for phase in self._phases if self._next_due[phase] <= current_time]
+
+    def seconds_until_next_tick(self):
+        """
+        :return: how long the main loop can wait before a phase is due
+        """
+        return max(TICK_MIN_SLEEP_SEC, min(self._next_due.values()) - time.time())
+
+    def run(self, phase):
+        """
+        Runs phase and schedules its next tick from the load level it returns
+        :param phase: the phase function to run
+        """
+        phase_name = phase.__name__
+        due_time = self._next_due[phase]
+        start_time = time.time()
+        self.metrics.set_gauge("{name}_tick_drift_sec".format(name=phase_name), round(start_time - due_time, 3))
+
+        load = None
+        try:
+            self._tick_id += 1
+            with LogFields(phase=phase_name, tick_id=self._tick_id):
+                load = phase()
+        finally:
+            end_time = time.time()
+            interval = self._adapt_interval(phase, load)
+            if end_time - start_time > interval:
+                self.metrics.increment("{name}_tick_overruns".format(name=phase_name))
+
+            next_due = due_time + interval
+            if next_due <= end_time:
+                # The phase runs once more right away and any further ticks that already passed are dropped
+                skipped_ticks = int((end_time - next_due) // interval)
+                if skipped_ticks:
+                    self.metrics.increment("{name}_tick_skipped".format(name=phase_name), skipped_ticks)
+                next_due += skipped_ticks * interval
+            self._next_due[phase] = next_due
+
+    def _adapt_interval(self, phase, load):
+        base_interval, min_interval, max_interval = self._intervals_sec[phase.__name__]
+        interval = self._intervals[phase]
+        if load == TICK_LOAD_BUSY:
+            interval = max(min_interval, interval / 2.0)
+        elif load == TICK_LOAD_IDLE:
+            interval = min(max_interval, interval * 2.0)
+        else:
+            interval = base_interval
+
+        self._intervals[phase] = interval
+        self.metrics.set_gauge("{name}_tick_interval_sec".format(name=phase.__name__), interval)
+        return interval
+
+
+class LimitOrderProximityIndex(object):
+    """
+    Tracks when each open limit order next needs its price checked. Orders close to their limit price relative to
+    the pair's recent volatility are due every tick and orders far from it are skipped until a move that large
+    becomes plausible, so each tick only prices the orders that might fill
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pair_prices = {} # (buy_currency, sell_currency) to (last price, time it was fetched)
+        self._pair_variances = {} # (buy_currency, sell_currency) to the moving average of log return variance per second
+        self._next_check_times = {} # limit_order_id to the time it is due
+
+    def record_price(self, pair, price, price_time):
+        """
+        Updates the pair's volatility with a newly fetched price
+        :param pair: (buy_currency, sell_currency)
+        :param price: the price of buy_currency in sell_currency
+        :param price_time: when price was fetched
+        """
+        with self._lock:
+            last_price = self._pair_prices.get(pair)
+            self._pair_prices[pair] = (price, price_time)
+            if last_price is None or price_time - last_price[1] < 1:
+                return
+
+            log_return = math.log(price / last_price[0])
+            variance = log_return ** 2 / (price_time - last_price[1])
+            if pair in self._pair_variances:
+                variance = (LIMIT_ORDER_VOLATILITY_WEIGHT * variance +
+                            (1 - LIMIT_ORDER_VOLATILITY_WEIGHT) * self._pair_variances[pair])
+            self._pair_variances[pair] = variance
+
+    def is_due(self, limit_order_id, current_time):
+        with self._lock:
+            return self._next_check_times.get(limit_order_id, 0) <= current_time
+
+    def schedule(self, limit_order_id, pair, limit_price, current_price, current_time):
+        """
+        Schedules the next check of an order that did not fill at current_price
+        :return: seconds until the order is due again
+        """
+        with self._lock:
+            variance = self._pair_variances.get(pair)
+            recheck_sec = 0
+            if variance is not None:
+                log_distance = math.log(current_price / limit_price)
+                if variance > 0:
+                    recheck_sec = min(LIMIT_ORDER_MAX_RECHECK_SEC,
+                                      (log_distance / LIMIT_ORDER_RECHECK_SIGMAS) ** 2 / variance)
+                else:
+                    recheck_sec = LIMIT_ORDER_MAX_RECHECK_SEC
+
+            self._next_check_times[limit_order_id] = current_time + recheck_sec
+            return recheck_sec
+
+    def forget(self, limit_order_id):
+        with self._lock:
+            self._next_check_times.pop(limit_order_id, None)
+
+    def retain(self, open_limit_order_ids):
+        """
+        Drops orders that were executed, canceled or archived
+        :param open_limit_order_ids: ids of every order that is still open
+        """
+        open_limit_order_ids = set(open_limit_order_ids)
+        with self._lock:
+            for limit_order_id in list(self._next_check_times):
+                if limit_order_id not in open_limit_order_ids:
+                    del self._next_check_times[limit_order_id]
+
+
+class ReplaySession(object):
+    """
+    Stands in for the Reddit session and the price API while a recording is replayed. Comments come from the
+    recording, replies are collected and prices are the recorded quotes, so a replay never waits on the network
+    """
+
+    def __init__(self, events):
+        self.now = 0 # recorded time of the event being replayed. Current prices are the latest quotes before it
+        self.replies = {} # comment_id to the replies made during the replay
+        self.recorded_replies = {} # comment_id to the replies in the recording
+        self._comment_events = {}
+        self._exact_quotes = {} # (from_symbol, to_symbol, price_time) to the price quoted for that exact call
+        self._quote_times = {} # (from_symbol, to_symbol) to the sorted price times of its quotes
+        self._quote_prices = {} # (from_symbol, to_symbol) to the prices of _quote_times
+
+        pair_quotes = {}
+        for event in events:
+            if event["type"] == "quote":
+                pair = (event["from_symbol"], event["to_symbol"])
+                self._exact_quotes[(pair[0], pair[1], event["price_time"])] = event["price"]
+                pair_quotes.setdefault(pair, []).append((event["price_time"], event["price"]))
+            elif event["type"] == "comment":
+                self._comment_events[event["comment_id"]] = event
+            elif event["type"] == "reply":
+                self.recorded_replies.setdefault(event["comment_id"], []).append(event["text"])
+
+        for pair, quotes in pair_quotes.items():
+            quotes.sort(key=operator.itemgetter(0))
+            self._quote_times[pair] = [quote[0] for quote in quotes]
+            self._quote_prices[pair] = [quote[1] for quote in quotes]
+
+    def comment(self, comment_id):
+        """
+        Same as reddit.comment for the comments in the recording
+        """
+        return ReplayComment(self, self._comment_events[comment_id])
+
+    def get_price(self, from_symbol, to_symbol, price_time = None):
+        """
+        :param price_time: the time the price is for. None for the current price
+        :return: the quote recorded for this exact call, otherwise the latest quote at or before price_time.
+        -1 if the pair was never quoted, the same as an API error
+        """
+        pair = (from_symbol, to_symbol)
+        if price_time is not None and (from_symbol, to_symbol, price_time) in self._exact_quotes:
+            return self._exact_quotes[(from_symbol, to_symbol, price_time)]
+
+        quote_times = self._quote_times.get(pair)
+        if not quote_times:
+            return -1
+
+        quote_index = bisect.bisect_right(quote_times, self.now if price_time is None else price_time) - 1
+        # Prices asked for before the pair's first quote get the first quote
+        return self._quote_prices[pair][max(quote_index, 0)]
+
+    def get_mismatched_comment_ids(self, comment_ids):
+        """
+        :param comment_ids: the replayed comments
+        :return: the sorted comment_ids whose replies differ from the recorded ones. Comments without recorded
+        replies are not compared
+        """
+        return [comment_id for comment_id in sorted(comment_ids)
+                if comment_id in self.recorded_replies and self.replies.get(comment_id) != self.recorded_replies[comment_id]]
+
+    def get_usd_prices(self, currencies, price_time = None):
+        """
+        :return: dictionary of currency to float USD price for the currencies that were quoted
+        """
+        prices = {}
+        for currency in currencies:
+            price = 1 if currency == "USD" else self.get_price(currency, "USD", price_time)
+            if price > 0:
+                prices[currency] = price
+        return prices
+
+
+class ReplayComment(object):
+    """
+    A recorded comment with the parts of praw's Comment the command code uses
+    """
+
+    def __init__(self, replay_session, comment_event):
+        self.id = comment_event["comment_id"]
+        self.body = comment_event["body"]
+        self.created_utc = comment_event["created_utc"]
+        self.parent_id = "t3_" + comment_event["submission_id"]
+        self.author = None
+        if comment_event["author"] is not None:
+            self.author = SimpleNamespace(name=comment_event["author"])
+        self._submission = SimpleNamespace(id=comment_event["submission_id"])
+        self._replay_session = replay_session
+
+    def parent(self):
+        return self._submission
+
+    def reply(self, reply_text):
+        self._replay_session.replies.setdefault(self.id, []).append(reply_text)
+
+    def __str__(self):
+        return self.id
+
+
+class GameSnapshot(object):
+    """
+    Read only view of a snapshot written by export_game_snapshot. Columns are memory mapped so loading is zero copy
+    and never touches the DB. Columns are numpy arrays when numpy is installed and memoryviews otherwise
+    """
+
+    def __init__(self, game_id, snapshot_dir):
+        """
+        :param snapshot_dir: the snapshot_dir the game was exported to
+        """
+        self.path = os.path.join(snapshot_dir, "game_{game_id}".format(game_id=game_id))
+        with open(os.path.join(self.path, "manifest.json")) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.strings = self.manifest["strings"]
+        self._mmaps = []
+        self._columns = {}
+
+    def row_count(self, table):
+        return self.manifest["tables"][table]["rows"]
+
+    def column(self, table, column):
+        """
+        :return: the column's values. String columns hold codes into self.strings
+        """
+        column_key = (table, column)
+        if column_key not in self._columns:
+            column_path = os.path.join(self.path, "{table}.{column}.npy".format(table=table, column=column))
+            if numpy is not None:
+                self._columns[column_key] = numpy.load(column_path, mmap_mode="r")
+            else:
+                column_kind = self.manifest["tables"][table]["columns"][column]
+                with open(column_path, "rb") as column_file:
+                    column_mmap = mmap.mmap(column_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._mmaps.append(column_mmap)
+                header_length = struct.unpack("<H", column_mmap[8:10])[0]
+                self._columns[column_key] = memoryview(column_mmap)[10 + header_length:].cast(
+                    SNAPSHOT_COLUMN_FORMATS[column_kind][1])
+
+        return self._columns[column_key]
+
+    def rows(self, table):
+        """
+        Yields each row as a dictionary with strings decoded. Slower than column access, meant for audits
+        """
+        columns = self.manifest["tables"][table]["columns"]
+        values = dict((column, self.column(table, column)) for column in columns)
+        for row_index in range(self.row_count(table)):
+            row = {}
+            for column, column_kind in columns.items():
+                value = values[column][row_index]
+                row[column] = self.strings[value] if column_kind == "str" else value
+            yield row
+
+    def close(self):
+        for column in self._columns.values():
+            if isinstance(column, memoryview):
+                column.release()
+        self._columns = {}
+        for column_mmap in self._mmaps:
+            column_mmap.close()
+        self._mmaps = []
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def to_bit_int(value):
+    """
+    :param value: a BIT(1) column, which MySQLdb returns as bytes
+    :return: 1 or 0
+    """
+    if isinstance(value, bytes):
+        return int.from_bytes(value, "big")
+    return int(bool(value))
+
+def to_snapshot_value(value, column_kind, string_codes):
+    """
+    Converts a DB value to the number stored in a snapshot column
+    :param string_codes: dictionary of string to code, extended with strings seen for the first time
+    """
+    if column_kind == "str":
+        return string_codes.setdefault(value, len(string_codes))
+    elif column_kind == "decimal":
+        return float(value)
+    elif column_kind == "bool":
+        return to_bit_int(value)
+    elif column_kind == "datetime":
+        return calendar.timegm(value.utctimetuple()) if value is not None else 0
+    return int(value)
+
+def write_npy_column(column_path, column_kind, values):
+    """
+    Writes values as a one dimensional version 1.0 .npy file with the data 64 byte aligned so it can be memory mapped
+    """
+    descr, value_format = SNAPSHOT_COLUMN_FORMATS[column_kind]
+    header = "{{'descr': '{descr}', 'fortran_order': False, 'shape': ({count},), }}".format(descr=descr, count=len(values))
+    header += " " * (63 - (10 + len(header)) % 64) + "\n"
+
+    column_data = array.array(value_format, values)
+    if sys.byteorder == "big":
+        column_data.byteswap()
+
+    with open(column_path, "wb") as column_file:
+        column_file.write(b"\x93NUMPY\x01\x00")
+        column_file.write(struct.pack("<H", len(header)))
+        column_file.write(header.encode("latin1"))
+        column_file.write(column_data.tobytes())
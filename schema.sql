@@ -10,6 +10,7 @@ CREATE TABLE `game_submission` (
   `game_begin_datetime` DATETIME NOT NULL,
   `game_end_datetime` DATETIME NOT NULL,
   `complete` BIT(1) NOT NULL,
+  `archived` BIT(1) NOT NULL DEFAULT 0,
   `create_timestamp` DATETIME DEFAULT CURRENT_TIMESTAMP,
   `update_timestamp` DATETIME DEFAULT NULL ON UPDATE CURRENT_TIMESTAMP,
   PRIMARY KEY (`game_id`)
@@ -82,3 +83,123 @@ CREATE TABLE `standings` (
   `update_timestamp` DATETIME DEFAULT NULL ON UPDATE CURRENT_TIMESTAMP,
   PRIMARY KEY (`standings_id`)
 );
+
+CREATE UNIQUE INDEX processed_comment_comment_id_index
+    ON processed_comment (comment_id);
+
+CREATE UNIQUE INDEX executed_trade_comment_id_index
+    ON executed_trade (comment_id);
+
+CREATE UNIQUE INDEX limit_order_comment_id_index
+    ON limit_order (comment_id);
+
+CREATE TABLE `command_queue` (
+  `command_queue_id` int(11) NOT NULL AUTO_INCREMENT,
+  `comment_id` varchar(50) NOT NULL,
+  `submission_id` varchar(10) NOT NULL,
+  `owner` varchar(50) NOT NULL,
+  `body` varchar(10000) NOT NULL,
+  `created_utc` DOUBLE NOT NULL,
+  `status` varchar(20) NOT NULL,
+  `attempts` int(11) NOT NULL DEFAULT 0,
+  `next_attempt_datetime` DATETIME NOT NULL,
+  `lease_owner` varchar(50) DEFAULT NULL,
+  `lease_expire_datetime` DATETIME DEFAULT NULL,
+  `last_error` varchar(10000) DEFAULT NULL,
+  `create_timestamp` DATETIME DEFAULT CURRENT_TIMESTAMP,
+  `update_timestamp` DATETIME DEFAULT NULL ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`command_queue_id`)
+);
+
+CREATE UNIQUE INDEX command_queue_comment_id_index
+    ON command_queue (comment_id);
+
+CREATE INDEX command_queue_claim_index
+    ON command_queue (status, next_attempt_datetime);
+
+CREATE INDEX command_queue_lease_owner_index
+    ON command_queue (lease_owner);
+
+CREATE INDEX command_queue_owner_index
+    ON command_queue (owner, command_queue_id);
+
+CREATE TABLE `command_dead_letter` (
+  `command_dead_letter_id` int(11) NOT NULL AUTO_INCREMENT,
+  `comment_id` varchar(50) NOT NULL,
+  `submission_id` varchar(10) NOT NULL,
+  `owner` varchar(50) NOT NULL,
+  `attempts` int(11) NOT NULL,
+  `last_error` varchar(10000) DEFAULT NULL,
+  `create_timestamp` DATETIME DEFAULT CURRENT_TIMESTAMP,
+  `update_timestamp` DATETIME DEFAULT NULL ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`command_dead_letter_id`)
+);
+
+CREATE UNIQUE INDEX standings_game_owner_index
+    ON standings (game_id, owner);
+
+CREATE TABLE `standings_history` (
+  `game_id` int(11) NOT NULL,
+  `owner` varchar(50) NOT NULL,
+  `resolution` char(1) NOT NULL,
+  `bucket_timestamp` int(11) NOT NULL,
+  `value_cents` bigint(20) NOT NULL,
+  `standing_rank` int(11) NOT NULL,
+  PRIMARY KEY (`game_id`, `owner`, `resolution`, `bucket_timestamp`)
+);
+
+CREATE INDEX standings_history_prune_index
+    ON standings_history (resolution, bucket_timestamp);
+
+CREATE TABLE `game_currency` (
+  `game_id` int(11) NOT NULL,
+  `currency` varchar(50) NOT NULL,
+  `holder_count` int(11) NOT NULL,
+  `open_order_count` int(11) NOT NULL,
+  PRIMARY KEY (`game_id`, `currency`)
+);
+
+CREATE TABLE `game_stats` (
+  `game_id` int(11) NOT NULL,
+  `player_count` int(11) NOT NULL,
+  `open_order_count` int(11) NOT NULL,
+  PRIMARY KEY (`game_id`)
+);
+
+CREATE INDEX standings_value_index
+    ON standings (game_id, portfolio_value);
+
+CREATE INDEX executed_trade_game_id_index
+    ON executed_trade (game_id, buy_currency, sell_currency);
+
+CREATE TABLE `trade_rollup` (
+  `game_id` int(11) NOT NULL,
+  `owner` varchar(50) NOT NULL,
+  `buy_currency` varchar(50) NOT NULL,
+  `sell_currency` varchar(50) NOT NULL,
+  `trade_count` int(11) NOT NULL,
+  `buy_volume` DECIMAL(40,20) NOT NULL,
+  `sell_volume` DECIMAL(40,20) NOT NULL,
+  `volume_usd` DECIMAL(40,20) NOT NULL,
+  `realized_pnl_usd` DECIMAL(40,20) NOT NULL,
+  `update_timestamp` DATETIME DEFAULT NULL ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`game_id`, `owner`, `buy_currency`, `sell_currency`)
+);
+
+CREATE TABLE `position_cost_basis` (
+  `game_id` int(11) NOT NULL,
+  `owner` varchar(50) NOT NULL,
+  `currency` varchar(50) NOT NULL,
+  `quantity` DECIMAL(40,20) NOT NULL,
+  `cost_basis_usd` DECIMAL(40,20) NOT NULL,
+  PRIMARY KEY (`game_id`, `owner`, `currency`)
+);
+
+CREATE INDEX limit_order_game_id_index
+    ON limit_order (game_id);
+
+CREATE TABLE `portfolio_archive` LIKE `portfolio`;
+CREATE TABLE `limit_order_archive` LIKE `limit_order`;
+CREATE TABLE `processed_comment_archive` LIKE `processed_comment`;
+CREATE TABLE `executed_trade_archive` LIKE `executed_trade`;
+CREATE TABLE `standings_archive` LIKE `standings`;
@@ -0,0 +1,259 @@
+import json
+import math
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crypto_trading_util
+from crypto_trading_util import (LIMIT_ORDER_MAX_RECHECK_SEC, LIMIT_ORDER_RECHECK_SIGMAS, TICK_LOAD_BUSY, TICK_LOAD_IDLE,
+                                 TICK_LOAD_NORMAL, GameSnapshot, LeaderBoard, LimitOrderProximityIndex, Metrics,
+                                 ReplaySession, TickScheduler, to_snapshot_value, write_npy_column)
+
+RECORDING_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "recording.jsonl")
+BTC_USD = ("BTC", "USD")
+
+
+def load_recording():
+    """
+    :return: the events of the recorded fixture, as replay_recording reads them
+    """
+    with open(RECORDING_FILE) as recording:
+        return [json.loads(line) for line in recording if line.strip()]
+
+
+class FakeClock(object):
+    """
+    Stands in for time.time so the scheduler's tick math runs on exact seconds
+    """
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_replay_get_price_prefers_the_quote_recorded_for_the_exact_call():
+    replay_session = ReplaySession(load_recording())
+
+    assert replay_session.get_price("BTC", "USD", 1700000100) == 36500.25
+    assert replay_session.get_price("BTC", "USD", 1700000101.2) == 36512.5
+
+
+def test_replay_get_price_falls_back_to_the_latest_quote_at_or_before():
+    replay_session = ReplaySession(load_recording())
+
+    assert replay_session.get_price("ETH", "USD", 1700000459.9) == 2053.0
+    assert replay_session.get_price("ETH", "USD", 1700000500) == 2053.0
+    assert replay_session.get_price("ETH", "USD", 1700000401) == 2051.75
+    assert replay_session.get_price("ETH", "USD", 1800000000) == 2040.5
+    # Before the pair's first quote
+    assert replay_session.get_price("ETH", "USD", 1600000000) == 2051.75
+    assert replay_session.get_price("DOGE", "USD", 1700000100) == -1
+
+
+def test_replay_current_price_is_the_latest_quote_before_the_replayed_event():
+    replay_session = ReplaySession(load_recording())
+
+    replay_session.now = 1700000461.88
+    assert replay_session.get_price("ETH", "USD") == 2053.0
+    replay_session.now = 1700000520.66
+    assert replay_session.get_price("ETH", "USD") == 2040.5
+    assert replay_session.get_usd_prices(["ETH", "USD", "DOGE"]) == {"ETH": 2040.5, "USD": 1}
+
+
+def test_replay_compares_replies_with_the_recording():
+    events = load_recording()
+    recorded_replies = dict((event["comment_id"], event["text"]) for event in events if event["type"] == "reply")
+    replay_session = ReplaySession(events)
+    comment_ids = ["kb1m2x0", "kb1n7q4", "kb1n9zd"]
+
+    for comment_id in comment_ids:
+        replay_session.comment(comment_id).reply(recorded_replies[comment_id])
+    assert replay_session.get_mismatched_comment_ids(comment_ids) == []
+
+    replay_session.comment("kb1n7q4").reply("I could not process your message because there were no valid commands found.")
+    assert replay_session.get_mismatched_comment_ids(comment_ids) == ["kb1n7q4"]
+
+
+def test_replay_comment_has_the_recorded_fields():
+    comment = ReplaySession(load_recording()).comment("kb1n9zd")
+
+    assert comment.body == "!limit 1 ETH USD 2045"
+    assert comment.author.name == "carol"
+    assert comment.parent_id == "t3_17x2abc"
+    assert comment.parent().id == "17x2abc"
+
+
+def test_leader_board_ties_share_a_rank():
+    leader_board = LeaderBoard({"alice": 300, "bob": 500, "carol": 300, "dave": 100})
+
+    assert leader_board.leader() == "bob"
+    assert leader_board.top(1) == [("bob", 500)]
+    assert [leader_board.rank(username) for username in ("bob", "alice", "carol", "dave")] == [1, 2, 2, 4]
+    assert leader_board.rank("erin") is None
+    assert LeaderBoard({}).leader() is None
+
+
+def test_leader_board_pages():
+    leader_board = LeaderBoard(dict(("player{index}".format(index=index), index) for index in range(5)))
+
+    assert leader_board.page_count(2) == 3
+    assert leader_board.page(1, 2) == [(1, "player4", 4), (2, "player3", 3)]
+    assert leader_board.page(3, 2) == [(5, "player0", 0)]
+    assert leader_board.page(4, 2) == []
+    assert LeaderBoard({}).page_count() == 1
+
+
+def create_scheduler(monkeypatch, loads, intervals_sec):
+    """
+    :param loads: dictionary of phase name to (load level it returns, seconds it takes), changed by the test
+    :return: tuple of (TickScheduler, its Metrics, the FakeClock it runs on, dictionary of phase name to phase)
+    """
+    clock = FakeClock(1000)
+    monkeypatch.setattr(crypto_trading_util.time, "time", clock)
+
+    def create_phase(phase_name):
+        def phase():
+            clock.now += loads[phase_name][1]
+            return loads[phase_name][0]
+        phase.__name__ = phase_name
+        return phase
+
+    phases = dict((phase_name, create_phase(phase_name)) for phase_name in intervals_sec)
+    metrics = Metrics()
+    return TickScheduler(list(phases.values()), intervals_sec, metrics), metrics, clock, phases
+
+
+def test_tick_scheduler_skips_the_ticks_an_overrun_missed(monkeypatch):
+    # 35 seconds of work on a 10 second cadence ends past the ticks due at 1010, 1020 and 1030
+    loads = {"slow_phase": (TICK_LOAD_NORMAL, 35)}
+    tick_scheduler, metrics, clock, phases = create_scheduler(monkeypatch, loads, {"slow_phase": (10, 5, 40)})
+
+    tick_scheduler.run(phases["slow_phase"])
+
+    assert metrics.snapshot()["slow_phase_tick_overruns"] == 1
+    assert metrics.snapshot()["slow_phase_tick_skipped"] == 2
+    # The tick due at 1030 runs right away
+    assert tick_scheduler.due_phases() == [phases["slow_phase"]]
+    assert tick_scheduler.seconds_until_next_tick() == 1
+
+
+def test_tick_scheduler_keeps_its_cadence_when_a_tick_runs_late(monkeypatch):
+    loads = {"phase": (TICK_LOAD_NORMAL, 2)}
+    tick_scheduler, metrics, clock, phases = create_scheduler(monkeypatch, loads, {"phase": (30, 10, 120)})
+
+    clock.now += 4
+    tick_scheduler.run(phases["phase"])
+
+    # Measured start to start from when it was due, not from when it ran
+    assert metrics.snapshot()["phase_tick_drift_sec"] == 4
+    assert tick_scheduler.seconds_until_next_tick() == 24
+    assert "phase_tick_overruns" not in metrics.snapshot()
+    assert "phase_tick_skipped" not in metrics.snapshot()
+
+
+def test_tick_scheduler_adapts_the_interval_to_the_load(monkeypatch):
+    loads = {"phase": (TICK_LOAD_BUSY, 0)}
+    tick_scheduler, metrics, clock, phases = create_scheduler(monkeypatch, loads, {"phase": (30, 10, 120)})
+    intervals = []
+
+    for load in (TICK_LOAD_BUSY, TICK_LOAD_BUSY, TICK_LOAD_IDLE, TICK_LOAD_IDLE, TICK_LOAD_IDLE, TICK_LOAD_IDLE,
+                 TICK_LOAD_NORMAL):
+        loads["phase"] = (load, 0)
+        tick_scheduler.run(phases["phase"])
+        intervals.append(metrics.snapshot()["phase_tick_interval_sec"])
+        clock.now += tick_scheduler.seconds_until_next_tick()
+
+    assert intervals == [15, 10, 20, 40, 80, 120, 30]
+
+
+def test_limit_order_is_due_every_tick_until_the_pair_has_a_volatility():
+    proximity_index = LimitOrderProximityIndex()
+
+    assert proximity_index.schedule(1, BTC_USD, 30000, 36000, 1000) == 0
+    assert proximity_index.is_due(1, 1000)
+
+    proximity_index.record_price(BTC_USD, 36000, 1000)
+    assert proximity_index.schedule(1, BTC_USD, 30000, 36000, 1000) == 0
+
+
+def test_limit_order_recheck_waits_for_a_plausible_move():
+    proximity_index = LimitOrderProximityIndex()
+    proximity_index.record_price(BTC_USD, 36000, 1000)
+    proximity_index.record_price(BTC_USD, 36360, 1100)
+    variance = (math.log(36360 / 36000.0) ** 2) / 100
+
+    recheck_sec = proximity_index.schedule(1, BTC_USD, 36300, 36360, 1100)
+    log_distance = math.log(36360 / 36300.0)
+    assert recheck_sec == pytest.approx((log_distance / LIMIT_ORDER_RECHECK_SIGMAS) ** 2 / variance)
+    assert not proximity_index.is_due(1, 1100)
+    assert proximity_index.is_due(1, 1100 + recheck_sec)
+
+    # Far from its limit price the order is still checked every LIMIT_ORDER_MAX_RECHECK_SEC
+    assert proximity_index.schedule(2, BTC_USD, 20000, 36360, 1100) == LIMIT_ORDER_MAX_RECHECK_SEC
+
+
+def test_limit_order_recheck_is_capped_for_a_pair_that_never_moves():
+    proximity_index = LimitOrderProximityIndex()
+    proximity_index.record_price(BTC_USD, 36000, 1000)
+    proximity_index.record_price(BTC_USD, 36000, 1100)
+
+    assert proximity_index.schedule(1, BTC_USD, 35990, 36000, 1100) == LIMIT_ORDER_MAX_RECHECK_SEC
+
+    proximity_index.retain([])
+    assert proximity_index.is_due(1, 1100)
+
+
+def write_snapshot(snapshot_dir, game_id):
+    """
+    Writes a one table snapshot the way export_game_snapshot does
+    """
+    columns = {"portfolio_id": "int", "owner": "str", "amount": "decimal", "is_open": "bool", "created": "datetime"}
+    rows = [{"portfolio_id": 7, "owner": "alice", "amount": 2699.95, "is_open": b"\x01",
+             "created": datetime(2023, 11, 14, 22, 15)},
+            {"portfolio_id": 8, "owner": "bob", "amount": 3844.75, "is_open": b"\x00", "created": None},
+            {"portfolio_id": 9, "owner": "alice", "amount": 0.2, "is_open": True,
+             "created": datetime(2023, 11, 14, 22, 16)}]
+    game_path = os.path.join(snapshot_dir, "game_{game_id}".format(game_id=game_id))
+    os.makedirs(game_path)
+
+    string_codes = {}
+    for column, column_kind in columns.items():
+        values = [to_snapshot_value(row[column], column_kind, string_codes) for row in rows]
+        write_npy_column(os.path.join(game_path, "portfolio.{column}.npy".format(column=column)), column_kind, values)
+
+    strings = [string for string, code in sorted(string_codes.items(), key=lambda string_code: string_code[1])]
+    with open(os.path.join(game_path, "manifest.json"), "w") as manifest_file:
+        json.dump({"game_id": game_id, "strings": strings,
+                   "tables": {"portfolio": {"rows": len(rows), "columns": columns}}}, manifest_file)
+
+
+def test_game_snapshot_reads_back_what_was_written(tmpdir, monkeypatch):
+    monkeypatch.setattr(crypto_trading_util, "numpy", None)
+    write_snapshot(str(tmpdir), 3)
+
+    game_snapshot = GameSnapshot(3, str(tmpdir))
+    assert game_snapshot.row_count("portfolio") == 3
+    assert list(game_snapshot.column("portfolio", "portfolio_id")) == [7, 8, 9]
+    assert list(game_snapshot.column("portfolio", "is_open")) == [1, 0, 1]
+    assert list(game_snapshot.column("portfolio", "created")) == [1700000100, 0, 1700000160]
+    assert list(game_snapshot.rows("portfolio"))[2] == {"portfolio_id": 9, "owner": "alice", "amount": 0.2,
+                                                        "is_open": 1, "created": 1700000160}
+    game_snapshot.close()
+
+
+def test_snapshot_columns_are_valid_npy_files(tmpdir):
+    numpy = pytest.importorskip("numpy")
+    write_snapshot(str(tmpdir), 3)
+
+    game_path = os.path.join(str(tmpdir), "game_3")
+    assert numpy.load(os.path.join(game_path, "portfolio.amount.npy")).tolist() == [2699.95, 3844.75, 0.2]
+    assert numpy.load(os.path.join(game_path, "portfolio.owner.npy")).tolist() == [0, 1, 0]
+
+    game_snapshot = GameSnapshot(3, str(tmpdir))
+    assert game_snapshot.column("portfolio", "portfolio_id").tolist() == [7, 8, 9]
@@ -0,0 +1,97 @@
+import os
+import random
+import sys
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crypto_trading_engine import (FIXED_POINT_SCALE, to_fixed, from_fixed, fixed_mul, fixed_div, fixed_percent,
+                                   fixed_to_cents, cents_to_fixed, format_fixed_2f,
+                                   parse_market_order, parse_limit_order, is_order_valid, size_order)
+
+# Every property runs against the same seeded values so a failure always reproduces
+PROPERTY_CASES = 2000
+
+
+def random_fixed(randomizer, max_digits = 12):
+    """
+    :return: a positive fixed point amount with up to max_digits whole digits and all 20 fraction digits used
+    """
+    return randomizer.randrange(1, 10 ** max_digits * FIXED_POINT_SCALE)
+
+
+def test_to_fixed_from_fixed_round_trip():
+    randomizer = random.Random(26)
+    for _ in range(PROPERTY_CASES):
+        fixed_value = random_fixed(randomizer)
+        assert to_fixed(from_fixed(fixed_value)) == fixed_value
+
+
+def test_to_fixed_parses_api_floats_by_repr():
+    assert to_fixed(0.1) == FIXED_POINT_SCALE // 10
+    assert to_fixed("0.1") == to_fixed(Decimal("0.1")) == to_fixed(0.1)
+    assert to_fixed(3) == 3 * FIXED_POINT_SCALE
+
+
+def test_fixed_percent_of_100_is_exact():
+    randomizer = random.Random(27)
+    for _ in range(PROPERTY_CASES):
+        fixed_amount = random_fixed(randomizer)
+        assert fixed_percent(fixed_amount, to_fixed(100)) == fixed_amount
+
+
+def test_fixed_mul_and_div_round_to_the_nearest_unit():
+    randomizer = random.Random(28)
+    for _ in range(PROPERTY_CASES):
+        fixed_a = random_fixed(randomizer, 6)
+        fixed_b = random_fixed(randomizer, 6)
+        assert abs(fixed_mul(fixed_a, fixed_b) * FIXED_POINT_SCALE - fixed_a * fixed_b) <= FIXED_POINT_SCALE // 2
+        assert abs(fixed_div(fixed_a, fixed_b) * fixed_b - fixed_a * FIXED_POINT_SCALE) <= fixed_b // 2 + 1
+
+
+def test_percent_orders_never_cost_more_than_the_available_funds():
+    randomizer = random.Random(29)
+    for _ in range(PROPERTY_CASES):
+        order = parse_market_order("!market {percent}% BTC USD".format(percent=randomizer.randint(1, 100)))
+        available_funds = random_fixed(randomizer)
+        price = random_fixed(randomizer, 6)
+        trade_cost, quantity_bought = size_order(order, available_funds, price)
+        assert 0 <= trade_cost <= available_funds
+        assert quantity_bought >= 0
+
+
+def test_lone_percent_and_dot_are_not_orders():
+    assert parse_market_order("!market % BTC USD") is None
+    assert parse_market_order("!market . BTC USD") is None
+    assert parse_limit_order("!limit % BTC USD 1") is None
+    assert parse_limit_order("!limit 1 BTC USD .") is None
+
+
+def test_order_validation():
+    assert is_order_valid(parse_market_order("!market 100% BTC USD"))
+    assert not is_order_valid(parse_market_order("!market 100.1% BTC USD"))
+    assert not is_order_valid(parse_market_order("!market 0 BTC USD"))
+    assert not is_order_valid(parse_limit_order("!limit 1 BTC USD 0"))
+
+
+def test_format_fixed_2f_rounds_half_up_on_the_exact_value():
+    # The float nearest 862592.315 is just below it so '{:,.2f}' rounds it down
+    assert format_fixed_2f(to_fixed("862592.315")) == "862,592.32"
+    assert "{:,.2f}".format(862592.315) == "862,592.31"
+    assert format_fixed_2f(to_fixed("-1234.005")) == "-1,234.01"
+    assert format_fixed_2f(0) == "0.00"
+
+
+def test_format_fixed_2f_matches_exact_decimal_rounding():
+    randomizer = random.Random(31)
+    for _ in range(PROPERTY_CASES):
+        fixed_value = randomizer.randrange(-10 ** 9 * FIXED_POINT_SCALE, 10 ** 9 * FIXED_POINT_SCALE)
+        expected = "{:,.2f}".format(from_fixed(fixed_value).quantize(Decimal("0.01"), rounding="ROUND_HALF_UP"))
+        assert format_fixed_2f(fixed_value) == expected
+
+
+def test_cents_round_trip():
+    randomizer = random.Random(32)
+    for _ in range(PROPERTY_CASES):
+        cents = randomizer.randrange(-10 ** 12, 10 ** 12)
+        assert fixed_to_cents(cents_to_fixed(cents)) == cents
@@ -0,0 +1,122 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crypto_trading_engine import (FIXED_POINT_SCALE, STARTING_USD_AMOUNT, TRADE_ROLLUP_GAME_OWNER, GameEngine,
+                                   InMemoryStorage, OrderResult, to_fixed, parse_market_order, parse_limit_order)
+
+GAME_ID = 1
+OWNER = "player"
+
+
+def create_engine(prices):
+    """
+    :param prices: dictionary of (from_symbol, to_symbol) to price, changed by the test to move the market
+    :return: tuple of (GameEngine with OWNER onboarded, its InMemoryStorage)
+    """
+    storage = InMemoryStorage()
+    usd_prices = lambda currencies: dict((currency, to_fixed(prices[(currency, "USD")]))
+                                         for currency in currencies if (currency, "USD") in prices)
+    engine = GameEngine(storage,
+                        lambda from_symbol, to_symbol, price_time: to_fixed(prices.get((from_symbol, to_symbol), 0)),
+                        usd_prices)
+    engine.onboard(GAME_ID, OWNER)
+    return engine, storage
+
+
+def test_market_order_moves_funds_and_updates_counters_cost_basis_and_rollups():
+    engine, storage = create_engine({("BTC", "USD"): 2000})
+
+    assert engine.market_order(GAME_ID, "c1", OWNER, parse_market_order("!market 2 BTC USD"), 0) == (OrderResult.EXECUTED, to_fixed(2000))
+
+    assert storage.get_amount(GAME_ID, OWNER, "USD") == to_fixed(STARTING_USD_AMOUNT - 4000)
+    assert storage.get_amount(GAME_ID, OWNER, "BTC") == to_fixed(2)
+    assert storage.game_stats[GAME_ID] == [1, 0]
+    assert storage.game_currencies[(GAME_ID, "BTC")] == [1, 0]
+    assert storage.get_cost_basis(GAME_ID, OWNER, "BTC") == (to_fixed(2), to_fixed(4000))
+    for owner in (OWNER, TRADE_ROLLUP_GAME_OWNER):
+        assert storage.trade_rollups[(GAME_ID, owner, "BTC", "USD")] == [1, to_fixed(2), to_fixed(4000), to_fixed(4000), 0]
+
+
+def test_selling_realizes_pnl_against_the_average_cost():
+    prices = {("BTC", "USD"): 1000, ("USD", "BTC"): 0.001}
+    engine, storage = create_engine(prices)
+    engine.market_order(GAME_ID, "c1", OWNER, parse_market_order("!market 4 BTC USD"), 0)
+
+    prices[("BTC", "USD")] = 2000
+    prices[("USD", "BTC")] = 0.0005
+    assert engine.market_order(GAME_ID, "c2", OWNER, parse_market_order("!market 50% USD BTC"), 0)[0] == OrderResult.EXECUTED
+
+    assert storage.get_amount(GAME_ID, OWNER, "BTC") == to_fixed(2)
+    assert storage.get_cost_basis(GAME_ID, OWNER, "BTC") == (to_fixed(2), to_fixed(2000))
+    # 2 BTC sold for 4000 USD that cost 2000 USD
+    assert storage.get_amount(GAME_ID, OWNER, "USD") == to_fixed(STARTING_USD_AMOUNT)
+    assert storage.trade_rollups[(GAME_ID, OWNER, "USD", "BTC")][4] == to_fixed(2000)
+
+
+def test_a_retried_command_is_applied_once():
+    engine, storage = create_engine({("BTC", "USD"): 2000})
+    order = parse_market_order("!market 1 BTC USD")
+
+    assert engine.market_order(GAME_ID, "c1", OWNER, order, 0)[0] == OrderResult.EXECUTED
+    assert engine.market_order(GAME_ID, "c1", OWNER, order, 0)[0] == OrderResult.ALREADY_APPLIED
+    assert storage.get_amount(GAME_ID, OWNER, "BTC") == to_fixed(1)
+    assert storage.trade_rollups[(GAME_ID, OWNER, "BTC", "USD")][0] == 1
+
+
+def test_rejected_orders_write_nothing():
+    engine, storage = create_engine({("BTC", "USD"): 2000})
+
+    assert engine.market_order(GAME_ID, "c1", OWNER, parse_market_order("!market 6 BTC USD"), 0)[0] == OrderResult.INSUFFICIENT_FUNDS
+    assert engine.market_order(GAME_ID, "c2", OWNER, parse_market_order("!market 1 ETH USD"), 0)[0] == OrderResult.NO_PRICE
+    assert engine.market_order(GAME_ID, "c3", OWNER, parse_market_order("!market 0 BTC USD"), 0)[0] == OrderResult.INVALID_ARGS
+    assert storage.portfolios[(GAME_ID, OWNER)] == {"USD": to_fixed(STARTING_USD_AMOUNT)}
+    assert not storage.trade_comment_ids
+    assert not storage.trade_rollups
+
+
+def test_limit_orders_reserve_funds_until_canceled():
+    engine, storage = create_engine({("BTC", "USD"): 2000})
+
+    result, current_price, limit_order_id = engine.limit_order(GAME_ID, "c1", OWNER, parse_limit_order("!limit 2 BTC USD 2500"), 0)
+    assert (result, current_price, limit_order_id) == (OrderResult.LIMIT_ABOVE_MARKET, to_fixed(2000), None)
+
+    result, current_price, limit_order_id = engine.limit_order(GAME_ID, "c2", OWNER, parse_limit_order("!limit 2 BTC USD 1500"), 0)
+    assert result == OrderResult.CREATED
+    assert storage.get_amount(GAME_ID, OWNER, "USD") == to_fixed(STARTING_USD_AMOUNT - 3000)
+    assert storage.game_stats[GAME_ID] == [1, 1]
+    assert storage.game_currencies[(GAME_ID, "BTC")] == [0, 1]
+
+    assert engine.cancel_limit_order(limit_order_id, "someone else") == OrderResult.NOT_FOUND
+    assert engine.cancel_limit_order(limit_order_id, OWNER) == OrderResult.CANCELED
+    assert engine.cancel_limit_order(limit_order_id, OWNER) == OrderResult.NOT_FOUND
+    assert storage.get_amount(GAME_ID, OWNER, "USD") == to_fixed(STARTING_USD_AMOUNT)
+    assert storage.game_stats[GAME_ID] == [1, 0]
+    assert storage.game_currencies[(GAME_ID, "BTC")] == [0, 0]
+
+
+def test_executing_a_limit_order_fills_it_with_the_reserved_funds():
+    engine, storage = create_engine({("BTC", "USD"): 2000})
+    result, current_price, limit_order_id = engine.limit_order(GAME_ID, "c1", OWNER, parse_limit_order("!limit 50% BTC USD 1000"), 0)
+
+    executed_limit_order = engine.execute_limit_order(limit_order_id)
+    assert executed_limit_order["limit_order_id"] == limit_order_id
+    assert engine.execute_limit_order(limit_order_id) is None
+
+    assert storage.get_amount(GAME_ID, OWNER, "USD") == to_fixed(STARTING_USD_AMOUNT // 2)
+    assert storage.get_amount(GAME_ID, OWNER, "BTC") == to_fixed(5)
+    assert storage.game_stats[GAME_ID] == [1, 0]
+    assert storage.game_currencies[(GAME_ID, "BTC")] == [1, 0]
+    assert storage.get_cost_basis(GAME_ID, OWNER, "BTC") == (to_fixed(5), to_fixed(5000))
+    assert storage.trade_rollups[(GAME_ID, TRADE_ROLLUP_GAME_OWNER, "BTC", "USD")][0] == 1
+
+
+def test_onboarding_is_once_per_player():
+    engine, storage = create_engine({})
+
+    assert not engine.onboard(GAME_ID, OWNER)
+    assert engine.onboard(GAME_ID, "another player")
+    assert storage.game_stats[GAME_ID] == [2, 0]
+    assert storage.game_currencies[(GAME_ID, "USD")] == [2, 0]
+    assert storage.get_amount(GAME_ID, "another player", "USD") == STARTING_USD_AMOUNT * FIXED_POINT_SCALE